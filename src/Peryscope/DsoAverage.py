@@ -0,0 +1,117 @@
+
+# Noise reduction of the 8-bit samples.
+#
+# Averager is the mean of the last count captures, placed so that their
+# trigger samples line up. HiRes is boxcar decimation: the mean of every
+# factor consecutive samples, which gives up factor times the sample
+# rate for about log2(factor) / 2 more bits.
+#
+# Both take the uint8 channel views of a capture and keep their sums in
+# integer arrays allocated once, of the narrowest type that holds 0xff
+# times the number of samples summed. The result is a new float32 array
+# of counts (2, samples), since a published frame must not change.
+
+from enum import Enum
+
+import numpy as np
+
+from PerytechDsoApi import (
+    preTrigger,
+    postTrigger,
+)
+
+
+class AcquireMode(Enum):
+    Normal = 0
+    Average = 1
+    HiRes = 2
+
+
+def sumType(count):
+    """Narrowest unsigned type of a sum of count samples."""
+    return np.min_scalar_type(0xff * count)
+
+
+def extraBits(factor):
+    """Effective bits gained by averaging factor samples of white noise."""
+    return 0.5 * np.log2(factor)
+
+
+def fitFactor(factor, width, pre):
+    """Largest HiRes factor up to factor for which a triggered capture
+    keeps all width * factor samples with pre * factor of them before
+    the trigger: at most preTrigger before it and postTrigger from it on."""
+    pre = min(max(pre, 0), width)
+    for f in range(max(1, factor), 1, -1):
+        if width * f <= postTrigger + min(pre * f, preTrigger):
+            return f
+    return 1
+
+
+class Averager:
+
+    def __init__(self, size, count, pre):
+        self.size = size
+        self.count = max(1, count)
+        # Index of the trigger sample in the result
+        self.pre = pre
+        self.sums = np.zeros((2, size), dtype=sumType(self.count))
+        self.hits = np.zeros(size, dtype=sumType(self.count))
+        self.divisor = np.zeros(size, dtype=np.float32)
+        # Last count captures as added, and the part of each that was set
+        self.history = np.zeros((self.count, 2, size), dtype=np.uint8)
+        self.ranges = [(0, 0)] * self.count
+        self.next = 0
+
+    def reset(self):
+        self.sums[:] = 0
+        self.hits[:] = 0
+        self.ranges = [(0, 0)] * self.count
+        self.next = 0
+
+    def filled(self):
+        """Captures in the average."""
+        return sum(1 for start, end in self.ranges if end > start)
+
+    def add(self, ch1, ch2, off, triggered):
+        """Add a capture with its trigger sample at off, returns the
+        average or None when the capture has no trigger to align to."""
+        if not triggered or off is None:
+            return None
+        shift = self.pre - off
+        start = max(0, shift)
+        end = min(self.size, len(ch1) + shift)
+        slot = self.history[self.next]
+        old, oldEnd = self.ranges[self.next]
+        if oldEnd > old:
+            np.subtract(self.sums[:, old:oldEnd], slot[:, old:oldEnd], out=self.sums[:, old:oldEnd])
+            self.hits[old:oldEnd] -= 1
+        if end > start:
+            slot[0, start:end] = ch1[start - shift:end - shift]
+            slot[1, start:end] = ch2[start - shift:end - shift]
+            np.add(self.sums[:, start:end], slot[:, start:end], out=self.sums[:, start:end])
+            self.hits[start:end] += 1
+        self.ranges[self.next] = (start, end)
+        self.next = (self.next + 1) % self.count
+        np.maximum(self.hits, 1, out=self.divisor)
+        average = self.sums / self.divisor
+        # Samples no capture reached are at the center
+        average[:, self.hits == 0] = 0x80
+        return average.astype(np.float32, copy=False)
+
+
+class HiRes:
+
+    def __init__(self, factor, size):
+        self.factor = max(1, factor)
+        # Samples of the result
+        self.size = size
+        self.sums = np.zeros((2, size), dtype=sumType(self.factor))
+
+    def decimate(self, ch1, ch2):
+        """Mean of every factor samples, at most size of them."""
+        n = min(len(ch1) // self.factor, self.size)
+        for i, data in enumerate((ch1, ch2)):
+            np.sum(data[:n * self.factor].reshape(n, self.factor), axis=1,
+                   dtype=self.sums.dtype, out=self.sums[i, :n])
+        return (self.sums[:, :n] / np.float32(self.factor)).astype(np.float32, copy=False)
@@ -0,0 +1,91 @@
+
+# Decoding of the interleaved ch1/ch2 bytes returned by readData.
+#
+# The channels are zero-copy strided views to the capture buffer, the
+# conversion to volts goes through a 256 entry lookup table, which is
+# cached per voltage range and calibration offset. Averaged captures have
+# fractional counts, those are converted with the slope of the table.
+
+import numpy as np
+
+from PerytechDsoApi import (
+    voltages,
+    countsPerDiv,
+)
+
+
+def channelViews(data):
+    """Return ch1 and ch2 uint8 views to interleaved capture data."""
+    raw = np.frombuffer(data, dtype=np.uint8)
+    n = len(raw) & ~1
+    return raw[0:n:2], raw[1:n:2]
+
+
+class Capture:
+    # One decoded capture. Volts are computed on first use.
+
+    def __init__(self, data, tables, voltageDIVs, raw=None, decimation=1):
+        self.data = data
+        self.raw = channelViews(data) if raw is None else raw
+        # Captured samples per sample of raw
+        self.decimation = decimation
+        self.tables = tables
+        self.voltageDIVs = voltageDIVs
+        self.__volts = [None, None]
+
+    def __len__(self):
+        return len(self.raw[0])
+
+    def counts(self, channel):
+        return self.raw[channel.value]
+
+    def volts(self, channel):
+        i = channel.value
+        if self.__volts[i] is None:
+            table = self.tables[i]
+            if self.raw[i].dtype == np.uint8:
+                self.__volts[i] = table[self.raw[i]]
+            else:
+                self.__volts[i] = table[0] + self.raw[i] * (table[1] - table[0])
+        return self.__volts[i]
+
+    def voltageDIV(self, channel):
+        return self.voltageDIVs[channel.value]
+
+
+class DsoDecoder:
+
+    def __init__(self):
+        self.tables = {}
+
+    def table(self, voltageDIV, offset=0.0):
+        # Volts for each raw A/D value
+        key = (voltageDIV, offset)
+        table = self.tables.get(key)
+        if table is None:
+            table = (np.arange(256, dtype=np.float32) - (0x80 + offset)) * \
+                np.float32(voltages[voltageDIV] / countsPerDiv)
+            self.tables[key] = table
+        return table
+
+    def channelTables(self, ch1VoltageDIV, ch2VoltageDIV, calibration):
+        offsets = [0.0, 0.0]
+        if calibration is not None:
+            offsets = [calibration(ch1VoltageDIV)[0], calibration(ch2VoltageDIV)[1]]
+        return (self.table(ch1VoltageDIV, offsets[0]),
+                self.table(ch2VoltageDIV, offsets[1]))
+
+    def decode(self, data, ch1VoltageDIV, ch2VoltageDIV, calibration=None):
+        """Decode a capture.
+
+        calibration is a function returning the (ch1, ch2) zero offsets
+        for a VoltageDIV, like PerytechDsoApi.getCalibration.
+        """
+        tables = self.channelTables(ch1VoltageDIV, ch2VoltageDIV, calibration)
+        return Capture(data, tables, (ch1VoltageDIV, ch2VoltageDIV))
+
+    def decodeCounts(self, counts, ch1VoltageDIV, ch2VoltageDIV, calibration=None, decimation=1):
+        """Decode (2, samples) fractional counts, like DsoAverage returns."""
+        tables = self.channelTables(ch1VoltageDIV, ch2VoltageDIV, calibration)
+        return Capture(None, tables, (ch1VoltageDIV, ch2VoltageDIV), raw=(counts[0], counts[1]),
+                       decimation=decimation)
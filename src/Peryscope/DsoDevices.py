@@ -0,0 +1,202 @@
+
+# Acquisition from several scopes in one process.
+#
+# Every device gets its own thread with its own PerytechDsoApi (and so its
+# own lock and register shadow); the devices share only the libusb
+# context. Captures are decoded in the device thread and handed out
+# through a FrameQueue per device. The USB transfers run in libusb and
+# the decoding in NumPy, both without holding the GIL for long, so the
+# threads of different devices overlap.
+
+import threading
+import time
+import logging
+
+import usb1
+
+from PerytechDsoApi import (
+    PerytechDsoApi,
+    Channel,
+    calibrationFile,
+)
+from DsoDecoder import DsoDecoder
+from DsoFrames import (
+    Frame,
+    FrameQueue,
+)
+from DsoMeasure import measureCapture
+
+logger = logging.getLogger('peryscope')
+
+
+def deviceName(udev):
+    return '%03d:%03d' % (udev.getBusNumber(), udev.getDeviceAddress())
+
+
+def parseDeviceName(name):
+    """(bus, address) of "BUS:ADDRESS"."""
+    try:
+        bus, address = name.split(':')
+        return int(bus), int(address)
+    except ValueError:
+        raise Exception("Bad device %s, expected BUS:ADDRESS" % name)
+
+
+def selectDevices(udevs, names=None):
+    """The devices of udevs named in names ("BUS:ADDRESS"), all if None."""
+    if not names:
+        return list(udevs)
+    byName = {(udev.getBusNumber(), udev.getDeviceAddress()): udev for udev in udevs}
+    selected = []
+    for name in names:
+        key = parseDeviceName(name)
+        if key not in byName:
+            raise Exception("Device %s not found" % name)
+        selected.append(byName[key])
+    return selected
+
+
+def findDevices(usbcontext=None):
+    """All scopes, and the USB context they were found with."""
+    if usbcontext is None:
+        usbcontext = usb1.USBContext()
+    return usbcontext, PerytechDsoApi().findDevices(usbcontext)
+
+
+class Acquisition:
+    # Settings of a DeviceWorker, the DsoConfig fields used for capturing
+
+    def __init__(self, sampleRate, ch1VoltageDIV, ch2VoltageDIV, ch1Couple, ch2Couple,
+                 trigChannel, trigEdge, ch1TrigVoltage=10, ch2TrigVoltage=10,
+                 trigOffset=0, trigTimeout=1.0, size=1000, measure=False):
+        self.sampleRate = sampleRate
+        self.ch1VoltageDIV = ch1VoltageDIV
+        self.ch2VoltageDIV = ch2VoltageDIV
+        self.ch1Couple = ch1Couple
+        self.ch2Couple = ch2Couple
+        self.trigChannel = trigChannel
+        self.trigEdge = trigEdge
+        self.ch1TrigVoltage = ch1TrigVoltage
+        self.ch2TrigVoltage = ch2TrigVoltage
+        self.trigOffset = trigOffset
+        self.trigTimeout = trigTimeout
+        self.size = size
+        self.measure = measure
+
+    def apply(self, dso):
+        with dso.transaction():
+            dso.setSampleRate(self.sampleRate)
+            dso.setVoltageDIV(Channel.Ch1, self.ch1VoltageDIV)
+            dso.setVoltageDIV(Channel.Ch2, self.ch2VoltageDIV)
+            dso.setCh1Couple(self.ch1Couple)
+            dso.setCh2Couple(self.ch2Couple)
+            dso.setTrigVoltage(Channel.Ch1, self.ch1TrigVoltage)
+            dso.setTrigVoltage(Channel.Ch2, self.ch2TrigVoltage)
+            dso.setTrigChannel(self.trigChannel)
+            dso.setTrigEdge(self.trigEdge)
+
+
+class DeviceWorker(threading.Thread):
+
+    def __init__(self, udev, acquisition, usbcontext=None, forceInit=True, frames=0,
+                 onFrame=None, debug=False, cacheFile=calibrationFile):
+        super().__init__(name='DeviceWorker-' + deviceName(udev), daemon=True)
+        self.udev = udev
+        self.device = deviceName(udev)
+        self.acquisition = acquisition
+        self.forceInit = forceInit
+        self.cacheFile = cacheFile
+        # Number of captures to take, 0 for no limit
+        self.limit = frames
+        # Called in this thread with every frame
+        self.onFrame = onFrame
+        self.dso = PerytechDsoApi()
+        self.dso.context = usbcontext
+        self.dso.setDebug(debug)
+        self.decoder = DsoDecoder()
+        self.frames = FrameQueue()
+        self.stopped = threading.Event()
+        self.error = None
+        self.captures = 0
+        self.triggered = 0
+        self.startTime = None
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        try:
+            self.dso.initDevice(self.udev, forceInit=self.forceInit, cacheFile=self.cacheFile)
+            self.acquisition.apply(self.dso)
+            self.startTime = time.time()
+            self.__acquire()
+        except Exception as e:
+            logger.error("%s: %s", self.device, e)
+            self.error = str(e)
+        finally:
+            self.dso.close()
+
+    def __acquire(self):
+        a = self.acquisition
+        i = 0
+        while not self.stopped.is_set() and (not self.limit or i < self.limit):
+            data = self.dso.readData(a.size, triggerTimeout=a.trigTimeout,
+                                     triggerOffset=a.trigOffset)
+            frame = Frame(i, data[0], triggered=data[1], off=data[2])
+            frame.capture = self.decoder.decode(frame.data, a.ch1VoltageDIV, a.ch2VoltageDIV,
+                                                self.dso.getCalibration)
+            if a.measure:
+                frame.measurements = measureCapture(frame.capture, a.sampleRate)
+            self.frames.publish(frame)
+            if self.onFrame is not None:
+                # The callback is the reader, it gets every frame
+                self.onFrame(self, self.frames.take())
+            self.captures += 1
+            self.triggered += frame.triggered
+            i += 1
+
+    def stats(self):
+        elapsed = time.time() - self.startTime if self.startTime else 0.0
+        return {
+            'captures': self.captures,
+            'triggered': self.triggered,
+            'rate': self.captures / elapsed if elapsed else 0.0,
+            'dropped': self.frames.dropped,
+            'error': self.error,
+        }
+
+
+class DsoDevices:
+    # A DeviceWorker for each selected device
+
+    def __init__(self, udevs, acquisition, **kwargs):
+        self.workers = [DeviceWorker(udev, acquisition, **kwargs) for udev in udevs]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        self.join()
+
+    def join(self, timeout=None):
+        for worker in self.workers:
+            worker.join(timeout)
+
+    def running(self):
+        return any(worker.is_alive() for worker in self.workers)
+
+    def stats(self):
+        """Per device statistics and their totals."""
+        devices = {worker.device: worker.stats() for worker in self.workers}
+        total = {
+            'devices': len(devices),
+            'captures': sum(s['captures'] for s in devices.values()),
+            'triggered': sum(s['triggered'] for s in devices.values()),
+            'rate': sum(s['rate'] for s in devices.values()),
+            'dropped': sum(s['dropped'] for s in devices.values()),
+            'errors': sum(1 for s in devices.values() if s['error']),
+        }
+        return {'devices': devices, 'total': total}
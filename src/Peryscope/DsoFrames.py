@@ -0,0 +1,135 @@
+
+# Hand-off of captures from the acquisition thread to the display.
+#
+# A Frame is built completely by the acquisition thread and not modified
+# after it is published. Publishing and taking a frame is one reference
+# assignment, which is atomic in Python, so the acquisition never waits
+# for painting and painting never sees a half-written capture. Frames the
+# display did not get to are counted as dropped.
+
+from struct import pack, unpack, calcsize
+
+import numpy as np
+
+# Binary frame encoding used by the headless capture and the server:
+# magic, frame number, host time, triggered, trigger sample index (-1 if
+# not triggered, but it can also be negative when the trigger is before
+# the window), data length, followed by the interleaved ch1/ch2 bytes
+FRAME_MAGIC = b"PFRM"
+FRAME_HEADER = "<4sIdBiI"
+FRAME_HEADER_SIZE = calcsize(FRAME_HEADER)
+
+
+class Frame:
+
+    def __init__(self, i, data, triggered=False, off=None, capture=None, measurements=None,
+                 partial=False, spectrum=None, persistence=None):
+        self.i = i
+        self.data = data
+        self.triggered = triggered
+        # Index of the trigger sample, None if not triggered
+        self.off = off
+        self.capture = capture
+        self.measurements = measurements
+        # Samples of a capture still waiting for the trigger
+        self.partial = partial
+        # DsoSpectrum.Spectra of the capture, when the spectrum view is on
+        self.spectrum = spectrum
+        # ARGB32 pixels of the persistence display, (rows, columns)
+        self.persistence = persistence
+        # time.perf_counter() when published, for the display latency
+        self.time = None
+
+
+def packFrame(frame, timestamp):
+    return pack(FRAME_HEADER, FRAME_MAGIC, frame.i & 0xffffffff, timestamp,
+                1 if frame.triggered else 0, -1 if frame.off is None else frame.off,
+                len(frame.data)) + bytes(frame.data)
+
+
+def unpackFrameHeader(header):
+    """Returns frame number, time, triggered, trigger index and data length."""
+    magic, i, timestamp, triggered, off, length = unpack(FRAME_HEADER, header)
+    if magic != FRAME_MAGIC:
+        raise Exception("Bad frame header")
+    return i, timestamp, bool(triggered), off, length
+
+
+class FrameQueue:
+    # Single writer, single reader
+
+    def __init__(self):
+        self.latest = None
+        self.lastTaken = None
+        self.published = 0
+        self.taken = 0
+        # Complete frames published and taken, partial frames are previews
+        # expected to be replaced by the complete one
+        self.completed = 0
+        self.completedTaken = 0
+
+    def publish(self, frame):
+        self.latest = frame
+        self.published += 1
+        if not frame.partial:
+            self.completed += 1
+
+    def peek(self):
+        """Latest frame, or None."""
+        return self.latest
+
+    def take(self):
+        """Latest frame if it was not taken already, otherwise None."""
+        frame = self.latest
+        if frame is None or frame is self.lastTaken:
+            return None
+        self.lastTaken = frame
+        self.taken += 1
+        if not frame.partial:
+            self.completedTaken += 1
+        return frame
+
+    @property
+    def dropped(self):
+        """Complete frames replaced by a newer one before they were taken."""
+        # Each counter has a single writer, so this is exact up to a frame
+        # being published or taken right now
+        latest = self.latest
+        pending = latest is not None and not latest.partial and latest is not self.lastTaken
+        return max(0, self.completed - self.completedTaken - pending)
+
+    def stats(self):
+        return {
+            'published': self.published,
+            'shown': self.taken,
+            'dropped': self.dropped,
+        }
+
+
+class RingBuffer:
+    # Last size samples of interleaved ch1/ch2 data, for roll mode
+
+    def __init__(self, size):
+        self.buffer = np.full(size * 2, 0x80, dtype=np.uint8)
+        self.pos = 0
+
+    def append(self, data):
+        data = np.frombuffer(data, dtype=np.uint8)
+        data = data[:len(data) & ~1]
+        size = len(self.buffer)
+        if len(data) >= size:
+            self.buffer[:] = data[-size:]
+            self.pos = 0
+            return
+        end = self.pos + len(data)
+        if end <= size:
+            self.buffer[self.pos:end] = data
+        else:
+            first = size - self.pos
+            self.buffer[self.pos:] = data[:first]
+            self.buffer[:end - size] = data[first:]
+        self.pos = end % size
+
+    def snapshot(self):
+        """Contents from oldest to newest, as a copy."""
+        return np.concatenate((self.buffer[self.pos:], self.buffer[:self.pos]))
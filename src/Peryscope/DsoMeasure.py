@@ -0,0 +1,119 @@
+
+# Waveform measurements, the CalXxx functions of the Perytech DLL.
+#
+# data is a NumPy array of volts (or counts). Times are in samples unless
+# the sample rate (samples/s, see sampleTimeDivider) is given.
+
+import numpy as np
+
+from PerytechDsoApi import (
+    Channel,
+    sampleTimeDivider,
+)
+
+# Hysteresis of the crossing detector, relative to peak to peak
+HYSTERESIS = 0.1
+
+
+def CalMaxValue(data):
+    return float(np.max(data)) if len(data) else 0.0
+
+
+def CalMinValue(data):
+    return float(np.min(data)) if len(data) else 0.0
+
+
+def CalPeak2Peak(data):
+    return float(np.ptp(data)) if len(data) else 0.0
+
+
+def CalAverage(data):
+    return float(np.mean(data)) if len(data) else 0.0
+
+
+def CalRMS(data):
+    if not len(data):
+        return 0.0
+    data = np.asarray(data, dtype=np.float64)
+    return float(np.sqrt(np.dot(data, data) / len(data)))
+
+
+def CalPeriod(data, rate=1):
+    return cycles(data)['period'] / rate
+
+
+def CalFrequency(data, rate=1):
+    period = cycles(data)['period']
+    return rate / period if period else 0.0
+
+
+def CalDutyCycle(data):
+    return cycles(data)['duty']
+
+
+def crossings(data, level, hysteresis):
+    """Indices of the rising and falling crossings of level.
+
+    The signal has to go below level - hysteresis before a rising crossing
+    is counted, and above level + hysteresis before a falling one.
+    """
+    mark = np.zeros(len(data), dtype=np.int8)
+    mark[data > level + hysteresis] = 1
+    mark[data < level - hysteresis] = -1
+    # Carry the last state over the samples inside the hysteresis band
+    idx = np.where(mark != 0, np.arange(len(data)), 0)
+    np.maximum.accumulate(idx, out=idx)
+    state = mark[idx]
+    change = np.diff(state)
+    rising = np.flatnonzero(change == 2) + 1
+    falling = np.flatnonzero(change == -2) + 1
+    return rising, falling
+
+
+def cycles(data, low=None, high=None):
+    # Period (in samples) and duty cycle from one crossing pass
+    if low is None:
+        low = CalMinValue(data)
+    if high is None:
+        high = CalMaxValue(data)
+    result = {'period': 0.0, 'duty': 0.0, 'cycles': 0}
+    if high <= low:
+        return result
+    rising, falling = crossings(data, (high + low) / 2, (high - low) * HYSTERESIS / 2)
+    if len(rising) < 2:
+        return result
+    first, last = rising[0], rising[-1]
+    n = len(rising) - 1
+    result['cycles'] = n
+    result['period'] = float(last - first) / n
+    # Time spent high between the first and the last rising edge
+    falls = falling[(falling > first) & (falling <= last)]
+    if len(falls) == n:
+        result['duty'] = float(np.sum(falls - rising[:-1])) / float(last - first)
+    return result
+
+
+def measure(data, rate=1):
+    """All measurements of one channel."""
+    if not len(data):
+        return {}
+    low = CalMinValue(data)
+    high = CalMaxValue(data)
+    c = cycles(data, low, high)
+    return {
+        'max': high,
+        'min': low,
+        'pp': high - low,
+        'average': CalAverage(data),
+        'rms': CalRMS(data),
+        'period': c['period'] / rate,
+        'frequency': rate / c['period'] if c['period'] else 0.0,
+        'duty': c['duty'],
+    }
+
+
+def measureCapture(capture, sampleRate):
+    """Measurements of both channels of a DsoDecoder capture."""
+    rate = sampleTimeDivider[sampleRate] / capture.decimation
+    return {channel: measure(capture.volts(channel), rate)
+            for channel in (Channel.Ch1, Channel.Ch2)}
@@ -0,0 +1,225 @@
+
+# Long recordings of captures to disk.
+#
+# Captures are appended as raw interleaved ch1/ch2 bytes to preallocated,
+# memory mapped segment files. Each segment starts with a header holding
+# the acquisition settings, a new segment is started when it is full or
+# the settings change. The start, length, time and trigger state of every
+# capture go to an index file next to the segment.
+#
+# Writing happens in a separate thread. If the disk does not keep up,
+# captures are dropped (and counted) instead of blocking the acquisition.
+# Segments are numbered on from the ones already recorded with the same
+# prefix, existing files are never overwritten. After a write error the
+# recording stops and later captures are dropped.
+
+import mmap
+import os
+import queue
+import threading
+import time
+from struct import pack, unpack, calcsize
+import logging
+
+import numpy as np
+
+from PerytechDsoApi import (
+    SampleRate,
+    VoltageDIV,
+    Coupling,
+    Channel,
+    TriggerEdge,
+)
+
+logger = logging.getLogger('peryscope')
+
+SEGMENT_MAGIC = b"PERYCAP1"
+HEADER_SIZE = 4096
+# magic, version, bytes used, sample rate, ch1/ch2 V/div, ch1/ch2 coupling,
+# trigger channel, trigger edge, ch1/ch2 trigger level, trigger offset
+HEADER = "<8sHQBBBBBBBhhi"
+
+INDEX = np.dtype([('offset', '<u8'), ('length', '<u4'), ('time', '<f8'), ('triggered', 'u1')])
+
+SEGMENT_SIZE = 64 << 20
+
+
+class Settings:
+    # Acquisition settings stored in a segment header
+
+    def __init__(self, sampleRate, ch1VoltageDIV, ch2VoltageDIV, ch1Couple, ch2Couple,
+                 trigChannel, trigEdge, ch1TrigVoltage=0, ch2TrigVoltage=0, trigOffset=0):
+        self.sampleRate = sampleRate
+        self.ch1VoltageDIV = ch1VoltageDIV
+        self.ch2VoltageDIV = ch2VoltageDIV
+        self.ch1Couple = ch1Couple
+        self.ch2Couple = ch2Couple
+        self.trigChannel = trigChannel
+        self.trigEdge = trigEdge
+        self.ch1TrigVoltage = ch1TrigVoltage
+        self.ch2TrigVoltage = ch2TrigVoltage
+        self.trigOffset = trigOffset
+
+    def key(self):
+        return tuple(self.__dict__.values())
+
+    def pack(self, used):
+        return pack(HEADER, SEGMENT_MAGIC, 1, used, self.sampleRate.value,
+                    self.ch1VoltageDIV.value, self.ch2VoltageDIV.value,
+                    self.ch1Couple.value, self.ch2Couple.value,
+                    self.trigChannel.value, self.trigEdge.value,
+                    int(self.ch1TrigVoltage), int(self.ch2TrigVoltage), int(self.trigOffset))
+
+    @staticmethod
+    def unpack(header):
+        values = unpack(HEADER, header[:calcsize(HEADER)])
+        if values[0] != SEGMENT_MAGIC:
+            raise Exception("Not a capture segment")
+        settings = Settings(SampleRate(values[3]), VoltageDIV(values[4]), VoltageDIV(values[5]),
+                            Coupling(values[6]), Coupling(values[7]),
+                            Channel(values[8]), TriggerEdge(values[9]),
+                            values[10], values[11], values[12])
+        return settings, values[2]
+
+
+class Segment:
+
+    def __init__(self, path, settings, size):
+        self.path = path
+        self.settings = settings
+        self.size = HEADER_SIZE + size
+        self.used = 0
+        self.file = open(path, 'x+b')
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.index = open(path + '.idx', 'wb')
+        self.__writeHeader()
+
+    def __writeHeader(self):
+        header = self.settings.pack(self.used)
+        self.map[0:len(header)] = header
+
+    def free(self):
+        return self.size - HEADER_SIZE - self.used
+
+    def append(self, data, timestamp, triggered):
+        start = HEADER_SIZE + self.used
+        self.map[start:start + len(data)] = data
+        self.index.write(np.array([(self.used, len(data), timestamp, triggered)], dtype=INDEX).tobytes())
+        self.used += len(data)
+        self.__writeHeader()
+
+    def close(self):
+        self.__writeHeader()
+        self.map.flush()
+        self.map.close()
+        # Drop the unused preallocated space
+        self.file.truncate(HEADER_SIZE + self.used)
+        self.file.close()
+        self.index.close()
+
+
+class DsoRecorder:
+
+    def __init__(self, prefix, segmentSize=SEGMENT_SIZE, queueSize=64):
+        self.prefix = prefix
+        self.segmentSize = segmentSize
+        self.queue = queue.Queue(queueSize)
+        self.segment = None
+        # Number of the next segment
+        self.segments = len(listSegments(prefix))
+        self.written = 0
+        self.dropped = 0
+        # Exception that stopped the recording
+        self.error = None
+        self.thread = threading.Thread(target=self.__run, name='DsoRecorder', daemon=True)
+        self.thread.start()
+
+    def write(self, data, settings, triggered=False, timestamp=None):
+        """Queue a capture for writing, never blocks."""
+        if self.error is not None:
+            self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait((bytes(data), settings,
+                                   time.time() if timestamp is None else timestamp, triggered))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        return {'written': self.written, 'dropped': self.dropped, 'segments': self.segments,
+                'error': self.error}
+
+    def __newSegment(self, settings, size):
+        segment, self.segment = self.segment, None
+        if segment is not None:
+            segment.close()
+        path = '%s.%04d.dso' % (self.prefix, self.segments)
+        while os.path.exists(path):
+            self.segments += 1
+            path = '%s.%04d.dso' % (self.prefix, self.segments)
+        self.segments += 1
+        logger.info('Recording to %s', path)
+        self.segment = Segment(path, settings, max(self.segmentSize, size))
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            data, settings, timestamp, triggered = item
+            if self.error is not None:
+                self.dropped += 1
+                continue
+            try:
+                if self.segment is None or self.segment.settings.key() != settings.key() or \
+                        self.segment.free() < len(data):
+                    self.__newSegment(settings, len(data))
+                self.segment.append(data, timestamp, triggered)
+                self.written += 1
+            except Exception as e:
+                logger.error('Recording failed, stopped: %s', e)
+                self.error = e
+                self.dropped += 1
+        self.__closeSegment()
+
+    def __closeSegment(self):
+        if self.segment is None:
+            return
+        try:
+            self.segment.close()
+        except Exception as e:
+            logger.error('Closing %s failed: %s', self.segment.path, e)
+            if self.error is None:
+                self.error = e
+        self.segment = None
+
+
+def openSegment(path):
+    """Open a recorded segment without copying.
+
+    Returns the settings, the samples as a (n, 2) uint8 array of ch1/ch2
+    and the capture index.
+    """
+    with open(path, 'rb') as f:
+        settings, used = Settings.unpack(f.read(HEADER_SIZE))
+    if used:
+        samples = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE, shape=(used,))
+    else:
+        samples = np.zeros(0, dtype=np.uint8)
+    index = np.fromfile(path + '.idx', dtype=INDEX) if os.path.exists(path + '.idx') \
+        else np.zeros(0, dtype=INDEX)
+    return settings, samples.reshape(-1, 2), index
+
+
+def listSegments(prefix):
+    segments = []
+    n = 0
+    while os.path.exists('%s.%04d.dso' % (prefix, n)):
+        segments.append('%s.%04d.dso' % (prefix, n))
+        n += 1
+    return segments
@@ -0,0 +1,143 @@
+
+# Trace rendering helpers. Captures longer than the drawing area are
+# reduced to a min/max envelope per pixel column, so the drawing cost
+# depends on the widget width and not on the capture length.
+
+import numpy as np
+
+
+def minMaxEnvelope(data, columns):
+    """Minimum and maximum of data for each of columns equal slices."""
+    n = len(data)
+    starts = (np.arange(columns, dtype=np.int64) * n) // columns
+    return np.minimum.reduceat(data, starts), np.maximum.reduceat(data, starts)
+
+
+def tracePoints(data, width):
+    """x and y coordinates of a polyline drawing data into width pixels.
+
+    Short captures are drawn one sample per pixel. Longer ones are drawn
+    as a zigzag between the minimum and maximum of each column, which
+    fills the envelope.
+    """
+    n = len(data)
+    if n <= width:
+        return np.arange(n, dtype=np.float64), data.astype(np.float64)
+    mins, maxs = minMaxEnvelope(data, width)
+    x = np.repeat(np.arange(width, dtype=np.float64), 2)
+    y = np.empty(width * 2, dtype=np.float64)
+    y[0::2] = mins
+    y[1::2] = maxs
+    # Alternate the order so that the line continues from the previous column
+    y[2::4], y[3::4] = maxs[1::2], mins[1::2]
+    return x, y
+
+
+# Closest grid lines, pixels
+MIN_GRID_SPACING = 8
+
+
+def gridSpacing(spacing, minimum=MIN_GRID_SPACING):
+    """Grid line distance: spacing times the smallest of 1, 2, 5, 10,
+    20, ... that is at least minimum pixels."""
+    decade = 1
+    while True:
+        for m in (1, 2, 5):
+            if spacing * m * decade >= minimum:
+                return spacing * m * decade
+        decade *= 10
+
+
+def sampleToX(sample, n, width):
+    # Pixel column of a sample index
+    if n <= width:
+        return sample
+    return int(sample * width / n)
+
+
+# Persistence colors from rare to frequent hits, no hits are transparent
+PERSISTENCE_COLORS = ((0xa0, 0xd0, 0xff), (0x00, 0x40, 0xff), (0xff, 0x00, 0x00), (0xff, 0xc0, 0x00))
+# Decayed hit counts below this are cleared
+MIN_HITS = 0.05
+
+
+def colorRamp(colors, size=256):
+    """ARGB32 lookup table through colors, entry 0 is transparent."""
+    anchors = np.linspace(0, 1, len(colors))
+    t = np.linspace(0, 1, size - 1)
+    r, g, b = (np.interp(t, anchors, [c[k] for c in colors]).astype(np.uint32) for k in range(3))
+    table = np.empty(size, dtype=np.uint32)
+    table[0] = 0
+    table[1:] = 0xff000000 | (r << 16) | (g << 8) | b
+    return table
+
+
+def columnSpans(data, width):
+    """Lowest and highest value drawn in each pixel column.
+
+    Like tracePoints, every column also reaches the previous one, so the
+    spans join up into a continuous trace.
+    """
+    n = len(data)
+    if n <= width:
+        lo = data.astype(np.int32)
+        hi = lo.copy()
+    else:
+        lo, hi = minMaxEnvelope(data, width)
+        lo = lo.astype(np.int32)
+        hi = hi.astype(np.int32)
+    lo[1:] = np.minimum(lo[1:], hi[:-1])
+    hi[1:] = np.maximum(hi[1:], lo[:-1])
+    return lo, hi
+
+
+class Persistence:
+    # Hit count histogram of the traces, height rows by width columns.
+    # Every frame adds one hit to all pixels its traces pass, older hits
+    # decay exponentially.
+
+    def __init__(self, width, height, decay=0.9):
+        self.width = width
+        self.height = height
+        self.decay = decay
+        self.colors = colorRamp(PERSISTENCE_COLORS)
+        self.reset()
+
+    def reset(self):
+        self.hits = np.zeros((self.height, self.width), dtype=np.float32)
+
+    def add(self, traces):
+        """Add one frame, traces is a list of (samples, base row) drawn
+        like tracePoints at rows base - sample."""
+        self.hits *= self.decay
+        self.hits[self.hits < MIN_HITS] = 0
+        starts = []
+        ends = []
+        for data, base in traces:
+            if not len(data):
+                continue
+            lo, hi = columnSpans(data, self.width)
+            columns = np.arange(len(lo))
+            top = np.clip(base - hi, 0, self.height - 1)
+            bottom = np.clip(base - lo, 0, self.height - 1)
+            # +1 at the top and -1 below the bottom of every span, the
+            # running sum down the rows then fills the spans
+            starts.append(top * self.width + columns)
+            ends.append((bottom + 1) * self.width + columns)
+        if not starts:
+            return
+        size = (self.height + 1) * self.width
+        spans = np.bincount(np.concatenate(starts), minlength=size) - \
+            np.bincount(np.concatenate(ends), minlength=size)
+        self.hits += np.cumsum(spans.reshape(self.height + 1, self.width)[:self.height], axis=0)
+
+    def image(self):
+        """ARGB32 pixels (height, width), colored by log hits relative
+        to the most hit pixel."""
+        top = float(self.hits.max())
+        if top <= 0:
+            return np.zeros((self.height, self.width), dtype=np.uint32)
+        level = np.log1p(self.hits) * np.float32((len(self.colors) - 2) / np.log1p(top))
+        index = level.astype(np.intp) + 1
+        index[self.hits == 0] = 0
+        return self.colors[index]
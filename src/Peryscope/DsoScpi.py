@@ -0,0 +1,360 @@
+
+# SCPI style command interface, for driving the scope from test scripts.
+#
+# Supported commands (long or short form, case insensitive, n = 1 or 2):
+#
+#   *IDN?  *RST  *OPC?  :SYSTem:ERRor?
+#   :TIMebase:SRATe <samples/s>              sample rate
+#   :CHANnel<n>:SCALe <volts/div>            vertical scale
+#   :CHANnel<n>:COUPling DC|AC
+#   :TRIGger:SOURce CHANnel1|CHANnel2
+#   :TRIGger:EDGE[:SLOPe] POSitive|NEGative
+#   :TRIGger:LEVel <volts>                   on the trigger source
+#   :TRIGger:TIMeout <seconds>               wait for a trigger in :WAV:DATA?
+#   :ACQuire:POINts <samples>                samples per capture, <= bufferSize
+#   :WAVeform:SOURce CHANnel1|CHANnel2
+#   :WAVeform:FORMat BYTE|ASCii
+#   :WAVeform:PREamble?                      points, x and y increment,
+#                                            y reference
+#   :WAVeform:DATA?                          capture, IEEE 488.2 definite
+#                                            length block
+#
+# Every setting has a query form (append "?"). Queries are answered from
+# the configuration kept here, which mirrors what was written to the
+# device, so only :WAV:DATA? talks to the device. Several commands can be
+# given on one line separated by ";".
+#
+# serveScpi exposes the interface on a TCP port, a Unix socket or a pty.
+
+import os
+import math
+import socket
+import logging
+
+import numpy as np
+
+from PerytechDsoApi import (
+    SampleRate,
+    Coupling,
+    VoltageDIV,
+    Channel,
+    TriggerEdge,
+    voltages,
+    sampleTimeDivider,
+    countsPerDiv,
+    bufferSize,
+)
+from DsoDecoder import channelViews
+from DsoServer import parseAddress
+
+logger = logging.getLogger('peryscope')
+
+IDN = "Perytech,DSO,0,peryscope"
+
+
+class ScpiError(Exception):
+
+    def __init__(self, code, message):
+        super().__init__("%d,\"%s\"" % (code, message))
+        self.code = code
+
+
+def keyword(word, spec):
+    # SCPI keyword match: the upper case part of spec or all of it
+    word = word.upper()
+    short = ''.join(c for c in spec if not c.islower())
+    return word == short or word == spec.upper()
+
+
+def nearest(table, value):
+    """Key of table whose value is closest to value."""
+    return min(table, key=lambda k: abs(table[k] - value))
+
+
+def parseNumber(value):
+    try:
+        number = float(value)
+    except ValueError:
+        raise ScpiError(-104, "Data type error")
+    if not math.isfinite(number):
+        raise ScpiError(-222, "Data out of range")
+    return number
+
+
+def definiteBlock(data):
+    """IEEE 488.2 definite length block."""
+    length = str(len(data))
+    return b"#%d%s" % (len(length), length.encode()) + bytes(data)
+
+
+class DsoScpi:
+
+    def __init__(self, dso):
+        self.dso = dso
+        self.errors = []
+        self.reset()
+
+    def reset(self):
+        self.sampleRate = SampleRate.kS100
+        self.voltageDIV = {Channel.Ch1: VoltageDIV.V1, Channel.Ch2: VoltageDIV.V1}
+        self.couple = {Channel.Ch1: Coupling.DC, Channel.Ch2: Coupling.DC}
+        # Trigger levels in A/D counts from the center
+        self.trigVoltage = {Channel.Ch1: 10, Channel.Ch2: 10}
+        self.trigChannel = Channel.Ch1
+        self.trigEdge = TriggerEdge.Rising
+        self.trigTimeout = 1.0
+        self.points = 1000
+        self.source = Channel.Ch1
+        self.ascii = False
+        with self.dso.transaction():
+            self.dso.setSampleRate(self.sampleRate)
+            for channel in (Channel.Ch1, Channel.Ch2):
+                self.dso.setVoltageDIV(channel, self.voltageDIV[channel])
+                self.dso.setTrigVoltage(channel, self.trigVoltage[channel])
+            self.dso.setCh1Couple(self.couple[Channel.Ch1])
+            self.dso.setCh2Couple(self.couple[Channel.Ch2])
+            self.dso.setTrigChannel(self.trigChannel)
+            self.dso.setTrigEdge(self.trigEdge)
+
+    def execute(self, line):
+        """Run a command line, returns the responses as bytes or None."""
+        responses = []
+        path = []
+        for command in line.strip().split(';'):
+            command = command.strip()
+            if not command:
+                continue
+            try:
+                response, path = self.__command(command, path)
+            except ScpiError as e:
+                self.errors.append(str(e))
+                continue
+            except Exception as e:
+                # Device errors go to the error queue too, the session
+                # goes on
+                logger.error("SCPI %s: %s", command, e)
+                self.errors.append(str(ScpiError(-300, "Device-specific error;%s" % e)))
+                continue
+            if response is not None:
+                responses.append(response if isinstance(response, bytes) else str(response).encode())
+        if not responses:
+            return None
+        return b';'.join(responses) + b'\n'
+
+    def __command(self, command, path):
+        header, _, argument = command.partition(' ')
+        argument = argument.strip()
+        query = header.endswith('?')
+        if query:
+            header = header[:-1]
+        if header.startswith('*'):
+            return self.__common(header.upper(), query), path
+        if header.startswith(':'):
+            nodes = header[1:].split(':')
+        else:
+            # Relative to the last command, like "CHAN1:SCAL 1;COUP AC"
+            nodes = path + header.split(':')
+        if query == bool(argument):
+            raise ScpiError(-109 if not query else -108, "Missing parameter" if not query
+                            else "Parameter not allowed")
+        return self.__dispatch(nodes, argument if not query else None), nodes[:-1]
+
+    def __common(self, header, query):
+        if header == '*IDN' and query:
+            return IDN
+        if header == '*OPC' and query:
+            return 1
+        if header == '*RST' and not query:
+            self.reset()
+            return None
+        if header == '*CLS' and not query:
+            self.errors = []
+            return None
+        raise ScpiError(-113, "Undefined header")
+
+    def __dispatch(self, nodes, value):
+        root = nodes[0]
+        rest = nodes[1:]
+        if keyword(root, 'SYSTem') and len(rest) == 1 and keyword(rest[0], 'ERRor') and value is None:
+            return self.errors.pop(0) if self.errors else '0,"No error"'
+        if keyword(root, 'TIMebase') and len(rest) == 1 and keyword(rest[0], 'SRATe'):
+            return self.__sampleRate(value)
+        if root.upper().startswith(('CHAN', 'CHANNEL')) and len(rest) == 1:
+            channel = self.__channel(root)
+            if keyword(rest[0], 'SCALe'):
+                return self.__scale(channel, value)
+            if keyword(rest[0], 'COUPling'):
+                return self.__coupling(channel, value)
+        if keyword(root, 'TRIGger') and rest:
+            if keyword(rest[0], 'SOURce') and len(rest) == 1:
+                return self.__trigSource(value)
+            if keyword(rest[0], 'EDGE') and (len(rest) == 1 or keyword(rest[1], 'SLOPe')):
+                return self.__trigEdge(value)
+            if keyword(rest[0], 'LEVel') and len(rest) == 1:
+                return self.__trigLevel(value)
+            if keyword(rest[0], 'TIMeout') and len(rest) == 1:
+                if value is None:
+                    return self.trigTimeout
+                self.trigTimeout = max(0.0, parseNumber(value))
+                return None
+        if keyword(root, 'ACQuire') and len(rest) == 1 and keyword(rest[0], 'POINts'):
+            if value is None:
+                return self.points
+            # The whole sample buffer at most
+            self.points = min(max(1, int(parseNumber(value))), bufferSize)
+            return None
+        if keyword(root, 'WAVeform') and len(rest) == 1:
+            if keyword(rest[0], 'SOURce'):
+                if value is None:
+                    return 'CHAN%d' % (self.source.value + 1)
+                self.source = self.__channel(value)
+                return None
+            if keyword(rest[0], 'FORMat'):
+                if value is None:
+                    return 'ASC' if self.ascii else 'BYTE'
+                if keyword(value, 'ASCii'):
+                    self.ascii = True
+                elif keyword(value, 'BYTE'):
+                    self.ascii = False
+                else:
+                    raise ScpiError(-224, "Illegal parameter value")
+                return None
+            if keyword(rest[0], 'PREamble') and value is None:
+                return self.__preamble()
+            if keyword(rest[0], 'DATA') and value is None:
+                return self.__data()
+        raise ScpiError(-113, "Undefined header")
+
+    def __channel(self, word):
+        word = word.upper()
+        for prefix in ('CHANNEL', 'CHAN'):
+            if word.startswith(prefix) and word[len(prefix):] in ('1', '2'):
+                return Channel(int(word[len(prefix):]) - 1)
+        raise ScpiError(-114, "Header suffix out of range")
+
+    def __sampleRate(self, value):
+        if value is None:
+            return sampleTimeDivider[self.sampleRate]
+        self.sampleRate = nearest(sampleTimeDivider, parseNumber(value))
+        self.dso.setSampleRate(self.sampleRate)
+        return None
+
+    def __scale(self, channel, value):
+        if value is None:
+            return voltages[self.voltageDIV[channel]]
+        div = nearest(voltages, parseNumber(value))
+        self.voltageDIV[channel] = div
+        self.dso.setVoltageDIV(channel, div)
+        return None
+
+    def __coupling(self, channel, value):
+        if value is None:
+            return self.couple[channel].name
+        try:
+            couple = Coupling[value.upper()]
+        except KeyError:
+            raise ScpiError(-224, "Illegal parameter value")
+        self.couple[channel] = couple
+        if channel == Channel.Ch1:
+            self.dso.setCh1Couple(couple)
+        else:
+            self.dso.setCh2Couple(couple)
+        return None
+
+    def __trigSource(self, value):
+        if value is None:
+            return 'CHAN%d' % (self.trigChannel.value + 1)
+        self.trigChannel = self.__channel(value)
+        self.dso.setTrigChannel(self.trigChannel)
+        return None
+
+    def __trigEdge(self, value):
+        if value is None:
+            return 'POS' if self.trigEdge == TriggerEdge.Rising else 'NEG'
+        if keyword(value, 'POSitive') or keyword(value, 'RISing'):
+            self.trigEdge = TriggerEdge.Rising
+        elif keyword(value, 'NEGative') or keyword(value, 'FALLing'):
+            self.trigEdge = TriggerEdge.Falling
+        else:
+            raise ScpiError(-224, "Illegal parameter value")
+        self.dso.setTrigEdge(self.trigEdge)
+        return None
+
+    def __trigLevel(self, value):
+        channel = self.trigChannel
+        scale = voltages[self.voltageDIV[channel]] / countsPerDiv
+        if value is None:
+            return self.trigVoltage[channel] * scale
+        counts = int(round(parseNumber(value) / scale))
+        if not -0x80 <= counts < 0x80:
+            raise ScpiError(-222, "Data out of range")
+        self.trigVoltage[channel] = counts
+        self.dso.setTrigVoltage(channel, counts)
+        return None
+
+    def __preamble(self):
+        yinc = voltages[self.voltageDIV[self.source]] / countsPerDiv
+        return "%d,%g,%g,%d" % (self.points, 1.0 / sampleTimeDivider[self.sampleRate], yinc, 0x80)
+
+    def __data(self):
+        data, triggered, off, regs = self.dso.readData(
+            self.points, triggerTimeout=self.trigTimeout)
+        samples = channelViews(data)[self.source.value]
+        if self.ascii:
+            return ','.join(str(v) for v in samples.tolist())
+        return definiteBlock(np.ascontiguousarray(samples).tobytes())
+
+
+def serveScpi(scpi, address):
+    """Answer commands on address ("host:port", a Unix socket path or "pty").
+
+    Clients are served one at a time, like an instrument.
+    """
+    if address == 'pty':
+        master, slave = os.openpty()
+        # Raw mode, so that binary blocks go through unchanged
+        import tty
+        tty.setraw(slave)
+        print(os.ttyname(slave), flush=True)
+        logger.info("SCPI on %s", os.ttyname(slave))
+        with os.fdopen(master, 'r+b', buffering=0) as f:
+            serveStream(scpi, f, f)
+        return
+    family, address = parseAddress(address)
+    if family == socket.AF_UNIX and os.path.exists(address):
+        os.unlink(address)
+    server = socket.socket(family, socket.SOCK_STREAM)
+    if family != socket.AF_UNIX:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(address)
+    server.listen()
+    logger.info("SCPI on %s", server.getsockname())
+    try:
+        while True:
+            sock, peer = server.accept()
+            logger.info("SCPI client %s connected", peer)
+            with sock, sock.makefile('rb') as rfile, sock.makefile('wb') as wfile:
+                serveStream(scpi, rfile, wfile)
+    finally:
+        server.close()
+        if family == socket.AF_UNIX:
+            os.unlink(address)
+
+
+def serveStream(scpi, rfile, wfile):
+    buffered = b''
+    while True:
+        try:
+            data = rfile.read1(4096) if hasattr(rfile, 'read1') else rfile.read(4096)
+        except OSError:
+            # pty closed
+            return
+        if not data:
+            return
+        buffered += data.replace(b'\r', b'\n')
+        while b'\n' in buffered:
+            line, buffered = buffered.split(b'\n', 1)
+            response = scpi.execute(line.decode('ascii', 'replace'))
+            if response is not None:
+                wfile.write(response)
+                wfile.flush()
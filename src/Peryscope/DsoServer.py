@@ -0,0 +1,316 @@
+
+# Streaming of captures to network clients.
+#
+# The server listens on a TCP port ("host:port") or a Unix socket (a path)
+# and sends every published frame to all connected clients, packed with
+# packFrame. Clients can send text commands, one per line:
+#
+#   get                 all configuration fields
+#   get <field>         one field
+#   set <field> <value> change a field, enums by name (set sampleRate MS1),
+#                       numbers within CONFIG_RANGES
+#   stats               pipeline timing as JSON, see DsoStats
+#
+# Replies are "PRPL" + uint32 length + UTF-8 text, starting with "ok" or
+# "error". Frames and replies share the connection, the magic tells them
+# apart.
+#
+# Sockets are non-blocking and served from one thread. Every client has
+# its own send queue; when a client falls behind, its oldest queued frames
+# are dropped, so a slow client only loses frames and never stalls the
+# acquisition or the other clients.
+
+import os
+import json
+import selectors
+import socket
+import threading
+from collections import deque
+from enum import Enum
+from struct import pack, unpack, calcsize
+import logging
+
+from PerytechDsoApi import (
+    SampleRate,
+    Coupling,
+    VoltageDIV,
+    Channel,
+    TriggerEdge,
+    preTrigger,
+    postTrigger,
+)
+from DsoFrames import packFrame
+
+logger = logging.getLogger('peryscope')
+
+REPLY_MAGIC = b"PRPL"
+REPLY_HEADER = "<4sI"
+REPLY_HEADER_SIZE = calcsize(REPLY_HEADER)
+
+# Configuration fields clients may change, and their types
+CONFIG_FIELDS = {
+    'sampleRate': SampleRate,
+    'ch1VoltageDIV': VoltageDIV,
+    'ch2VoltageDIV': VoltageDIV,
+    'ch1Couple': Coupling,
+    'ch2Couple': Coupling,
+    'trigChannel': Channel,
+    'trigEdge': TriggerEdge,
+    'ch1TrigVoltage': int,
+    'ch2TrigVoltage': int,
+    'trigOffset': int,
+}
+
+# Accepted values of the int fields, the device registers hold no more
+CONFIG_RANGES = {
+    'ch1TrigVoltage': (-128, 127),
+    'ch2TrigVoltage': (-128, 127),
+    'trigOffset': (-preTrigger, postTrigger),
+}
+
+# Frames queued per client before the oldest are dropped
+MAX_QUEUED = 8
+MAX_COMMAND = 1024
+
+
+def packReply(text):
+    data = text.encode('utf-8')
+    return pack(REPLY_HEADER, REPLY_MAGIC, len(data)) + data
+
+
+def unpackReplyHeader(header):
+    magic, length = unpack(REPLY_HEADER, header)
+    if magic != REPLY_MAGIC:
+        raise Exception("Bad reply header")
+    return length
+
+
+def parseAddress(address):
+    """(family, address) of "host:port", ":port" or a Unix socket path."""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return socket.AF_INET, (host or 'localhost', int(port))
+    return socket.AF_UNIX, address
+
+
+def formatValue(value):
+    return value.name if isinstance(value, Enum) else str(value)
+
+
+class Client:
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.frames = deque()
+        self.replies = deque()
+        self.sending = None
+        self.received = b''
+        self.sent = 0
+        self.dropped = 0
+
+
+class DsoServer:
+
+    def __init__(self, address, config, fields=CONFIG_FIELDS, onChange=None, maxQueued=MAX_QUEUED,
+                 getStats=None, ranges=CONFIG_RANGES):
+        self.config = config
+        self.fields = fields
+        self.ranges = ranges
+        self.onChange = onChange
+        # Returns the statistics for the stats command
+        self.getStats = getStats
+        self.maxQueued = maxQueued
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.running = True
+        family, self.address = parseAddress(address)
+        if family == socket.AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen()
+        self.sock.setblocking(False)
+        if family != socket.AF_UNIX:
+            self.address = self.sock.getsockname()
+        # Wakes up the server thread when something was queued
+        self.wakeRead, self.wakeWrite = socket.socketpair()
+        self.wakeRead.setblocking(False)
+        self.wakeWrite.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeRead, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self.__run, name='DsoServer', daemon=True)
+        self.thread.start()
+        logger.info("Serving captures on %s", self.address)
+
+    def publish(self, frame, timestamp):
+        """Queue a frame to all clients, never blocks."""
+        with self.lock:
+            if not self.clients:
+                return
+            data = packFrame(frame, timestamp)
+            for client in self.clients.values():
+                client.frames.append(data)
+                while len(client.frames) > self.maxQueued:
+                    client.frames.popleft()
+                    client.dropped += 1
+        self.__wake()
+
+    def stats(self):
+        with self.lock:
+            return {client.address: {'sent': client.sent, 'dropped': client.dropped,
+                                     'queued': len(client.frames)}
+                    for client in self.clients.values()}
+
+    def close(self):
+        self.running = False
+        self.__wake()
+        self.thread.join()
+
+    def __wake(self):
+        try:
+            self.wakeWrite.send(b'\0')
+        except BlockingIOError:
+            # Already woken up
+            pass
+
+    def __run(self):
+        try:
+            while self.running:
+                for key, events in self.selector.select():
+                    if key.fileobj is self.sock:
+                        self.__accept()
+                    elif key.fileobj is self.wakeRead:
+                        try:
+                            while self.wakeRead.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:
+                        client = key.data
+                        if events & selectors.EVENT_READ:
+                            self.__receive(client)
+                        if events & selectors.EVENT_WRITE and client.sock.fileno() >= 0:
+                            self.__send(client)
+                self.__updateEvents()
+        finally:
+            for client in list(self.clients.values()):
+                self.__disconnect(client)
+            self.selector.close()
+            self.sock.close()
+            self.wakeRead.close()
+            self.wakeWrite.close()
+            if isinstance(self.address, str):
+                os.unlink(self.address)
+
+    def __accept(self):
+        try:
+            sock, address = self.sock.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        client = Client(sock, address or 'unix:%d' % sock.fileno())
+        with self.lock:
+            self.clients[sock.fileno()] = client
+        self.selector.register(sock, selectors.EVENT_READ, client)
+        logger.info("Client %s connected", client.address)
+
+    def __disconnect(self, client):
+        with self.lock:
+            self.clients.pop(client.sock.fileno(), None)
+        self.selector.unregister(client.sock)
+        client.sock.close()
+        logger.info("Client %s disconnected, sent %d frames, dropped %d",
+                    client.address, client.sent, client.dropped)
+
+    def __updateEvents(self):
+        # Ask for writability only when there is something to send
+        with self.lock:
+            clients = list(self.clients.values())
+        for client in clients:
+            events = selectors.EVENT_READ
+            if client.sending or client.replies or client.frames:
+                events |= selectors.EVENT_WRITE
+            if self.selector.get_key(client.sock).events != events:
+                self.selector.modify(client.sock, events, client)
+
+    def __receive(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.__disconnect(client)
+            return
+        client.received += data
+        while b'\n' in client.received:
+            line, client.received = client.received.split(b'\n', 1)
+            reply = self.__command(line.decode('utf-8', 'replace').strip())
+            with self.lock:
+                client.replies.append(packReply(reply))
+        if len(client.received) > MAX_COMMAND:
+            self.__disconnect(client)
+
+    def __send(self, client):
+        while True:
+            if not client.sending:
+                with self.lock:
+                    # Replies go before queued frames
+                    if client.replies:
+                        client.sending = memoryview(client.replies.popleft())
+                    elif client.frames:
+                        client.sending = memoryview(client.frames.popleft())
+                        client.sent += 1
+                    else:
+                        return
+            try:
+                n = client.sock.send(client.sending)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.__disconnect(client)
+                return
+            client.sending = client.sending[n:]
+            if client.sending:
+                return
+
+    def __command(self, line):
+        words = line.split()
+        if not words:
+            return "error empty command"
+        try:
+            if words[0] == 'get' and len(words) == 1:
+                return "ok " + " ".join("%s=%s" % (name, formatValue(getattr(self.config, name)))
+                                        for name in self.fields)
+            if words[0] == 'get' and len(words) == 2:
+                self.__field(words[1])
+                return "ok %s=%s" % (words[1], formatValue(getattr(self.config, words[1])))
+            if words[0] == 'set' and len(words) == 3:
+                kind = self.__field(words[1])
+                value = kind[words[2]] if issubclass(kind, Enum) else kind(words[2])
+                if words[1] in self.ranges:
+                    low, high = self.ranges[words[1]]
+                    if not low <= value <= high:
+                        return "error %s out of range %d..%d" % (words[1], low, high)
+                setattr(self.config, words[1], value)
+                self.config.changed = True
+                if self.onChange is not None:
+                    self.onChange()
+                return "ok %s=%s" % (words[1], formatValue(value))
+            if words[0] == 'stats' and len(words) == 1 and self.getStats is not None:
+                return "ok " + json.dumps(self.getStats(), sort_keys=True)
+        except (KeyError, ValueError) as e:
+            return "error bad value %s" % e
+        except Exception as e:
+            return "error %s" % e
+        return "error unknown command %s" % line
+
+    def __field(self, name):
+        if name not in self.fields:
+            raise Exception("unknown field %s" % name)
+        return self.fields[name]
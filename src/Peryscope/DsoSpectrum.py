@@ -0,0 +1,163 @@
+
+# Spectrum analyzer.
+#
+# Every channel of a capture is windowed and transformed with a real FFT.
+# The window, its amplitude correction and the frequency axis depend only
+# on the capture size, the window and the sample rate, so they are built
+# once and cached; NumPy keeps the FFT twiddle factors of recent sizes
+# itself. Levels are averaged as power, so averaging lowers the noise
+# floor and not the level of a steady tone, and returned in dBV (dB
+# relative to 1 V rms).
+
+from enum import Enum
+from functools import lru_cache
+from collections import deque
+
+import numpy as np
+
+from PerytechDsoApi import (
+    Channel,
+    sampleTimeDivider,
+)
+
+# Displayed level range, dBV
+FLOOR_DB = -100.0
+CEILING_DB = 20.0
+# Power of an empty bin, keeps log10 finite
+MIN_POWER = 1e-20
+
+
+class Window(Enum):
+    # Cosine sum coefficients
+    Rect = (1.0,)
+    Hann = (0.5, 0.5)
+    BlackmanHarris = (0.35875, 0.48829, 0.14128, 0.01168)
+    FlatTop = (0.21557895, 0.41663158, 0.277263158, 0.083578947, 0.006947368)
+
+
+class Averaging(Enum):
+    Off = 0
+    Linear = 1
+    Exponential = 2
+
+
+class Plan:
+    # Window and scaling of one (size, window)
+
+    def __init__(self, size, window):
+        k = np.arange(size) * (2 * np.pi / size)
+        w = np.zeros(size)
+        for i, a in enumerate(window.value):
+            w += (-1) ** i * a * np.cos(i * k)
+        self.size = size
+        self.window = w.astype(np.float32)
+        # rms volts squared of each bin: a sine of amplitude A peaks at
+        # A * sum(w) / 2, DC and Nyquist bins are not split in two
+        scale = np.full(size // 2 + 1, 2.0 / np.sum(w) ** 2)
+        scale[0] = 1.0 / np.sum(w) ** 2
+        if size % 2 == 0:
+            scale[-1] = scale[0]
+        self.scale = scale
+
+    def power(self, volts):
+        spectrum = np.fft.rfft(volts * self.window)
+        return (spectrum.real ** 2 + spectrum.imag ** 2) * self.scale
+
+
+@lru_cache(maxsize=16)
+def plan(size, window):
+    return Plan(size, window)
+
+
+@lru_cache(maxsize=16)
+def frequencies(size, sampleRate, decimation=1):
+    """Frequency of every bin of a size sample capture, Hz."""
+    return np.fft.rfftfreq(size, decimation / sampleTimeDivider[sampleRate])
+
+
+def toDb(power):
+    return 10 * np.log10(np.maximum(power, MIN_POWER))
+
+
+def formatFrequency(hz):
+    for unit, scale in (('MHz', 1e6), ('kHz', 1e3)):
+        if hz >= scale:
+            return "%.4g %s" % (hz / scale, unit)
+    return "%.4g Hz" % hz
+
+
+class Spectra:
+    # Spectrum of one capture, levels[channel.value] in dBV
+
+    def __init__(self, frequencies, levels, peaks=None, count=1):
+        self.frequencies = frequencies
+        self.levels = levels
+        # Peak hold levels, or None
+        self.peaks = peaks
+        # Captures averaged
+        self.count = count
+
+
+class Spectrum:
+    # Averaging state across captures
+
+    def __init__(self, window=Window.Hann, averaging=Averaging.Off, count=8, peakHold=False):
+        self.window = window
+        self.averaging = averaging
+        self.count = count
+        self.peakHold = peakHold
+        self.reset()
+
+    def reset(self):
+        self.key = None
+        self.history = deque()
+        self.average = None
+        self.averaged = 0
+        self.peaks = None
+
+    def configure(self, window, averaging, count, peakHold):
+        """Change the settings, restarts averaging if they changed."""
+        settings = (window, averaging, max(1, count), peakHold)
+        if settings != (self.window, self.averaging, self.count, self.peakHold):
+            self.window, self.averaging, self.count, self.peakHold = settings
+            self.reset()
+
+    def update(self, capture, sampleRate):
+        """Add a decoded capture, returns its Spectra."""
+        size = len(capture)
+        key = (size, sampleRate, capture.decimation)
+        if key != self.key:
+            self.reset()
+            self.key = key
+        p = plan(size, self.window)
+        power = np.stack([p.power(capture.volts(channel)) for channel in (Channel.Ch1, Channel.Ch2)])
+        power = self.__average(power)
+        levels = toDb(power)
+        peaks = None
+        if self.peakHold:
+            self.peaks = levels if self.peaks is None else np.maximum(self.peaks, levels)
+            peaks = self.peaks
+        return Spectra(frequencies(*key), levels, peaks, self.averaged)
+
+    def __average(self, power):
+        if self.averaging == Averaging.Off:
+            self.averaged = 1
+            return power
+        if self.averaging == Averaging.Linear:
+            # Equal weight for the last count captures
+            self.history.append(power)
+            if self.average is None:
+                self.average = power.copy()
+            else:
+                self.average += power
+            if len(self.history) > self.count:
+                self.average -= self.history.popleft()
+            self.averaged = len(self.history)
+            return self.average / self.averaged
+        # Exponential, weight 1/count, a plain mean until count captures
+        self.averaged = min(self.averaged + 1, self.count)
+        if self.average is None:
+            self.average = power.copy()
+        else:
+            self.average += (power - self.average) / self.averaged
+        return self.average
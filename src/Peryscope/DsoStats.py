@@ -0,0 +1,137 @@
+
+# Timing of the acquisition pipeline.
+#
+# Every stage (USB arm, trigger wait, stop, bulk read, decoding, drawing,
+# ...) records its duration in a RollingHistogram, which keeps the last
+# WINDOW values, so the percentiles follow the current settings instead
+# of the whole session. Frames and their bytes are counted over the last
+# RATE_WINDOW seconds for the rates. PipelineStats is shared by the
+# acquisition and display threads.
+
+import os
+import json
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Durations kept per stage
+WINDOW = 256
+# Seconds the frame and data rates are averaged over
+RATE_WINDOW = 2.0
+
+
+def captureStages(times):
+    """Stage durations of a capture, from PerytechDsoApi.getCaptureTimes."""
+    stages = {}
+    for stage, start, end in (('arm', 'start', 'arm'), ('wait', 'arm', 'stop'),
+                              ('stop', 'stop', 'read'), ('read', 'read', 'done')):
+        if times.get(start) is not None and times.get(end) is not None:
+            stages[stage] = times[end] - times[start]
+    return stages
+
+
+class RollingHistogram:
+
+    def __init__(self, size=WINDOW):
+        self.values = np.zeros(size)
+        self.count = 0
+
+    def add(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+
+    def summary(self):
+        """Count, mean, p50, p99 and max of the kept values, seconds."""
+        values = self.values[:min(self.count, len(self.values))]
+        if not len(values):
+            return {'count': 0}
+        p50, p99 = np.percentile(values, (50, 99))
+        return {
+            'count': self.count,
+            'mean': float(values.mean()),
+            'p50': float(p50),
+            'p99': float(p99),
+            'max': float(values.max()),
+        }
+
+
+class PipelineStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        # (time.monotonic(), bytes) of the recent frames
+        self.frames = deque()
+        self.totalFrames = 0
+        self.totalBytes = 0
+
+    def add(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = RollingHistogram()
+            histogram.add(seconds)
+
+    def addCapture(self, times):
+        for stage, seconds in captureStages(times).items():
+            self.add(stage, seconds)
+
+    def frame(self, size):
+        """Count a frame of size bytes."""
+        now = time.monotonic()
+        with self.lock:
+            self.frames.append((now, size))
+            self.totalFrames += 1
+            self.totalBytes += size
+            self.__expire(now)
+
+    def __expire(self, now):
+        while self.frames and self.frames[0][0] < now - RATE_WINDOW:
+            self.frames.popleft()
+
+    def snapshot(self):
+        """Rates and per stage summaries, as plain values."""
+        now = time.monotonic()
+        with self.lock:
+            self.__expire(now)
+            frames = list(self.frames)
+            stages = {stage: h.summary() for stage, h in self.stages.items()}
+            total = {'frames': self.totalFrames, 'bytes': self.totalBytes}
+        elapsed = now - frames[0][0] if len(frames) > 1 else 0.0
+        fps = (len(frames) - 1) / elapsed if elapsed else 0.0
+        rate = sum(size for t, size in frames[1:]) / elapsed if elapsed else 0.0
+        return {
+            'time': time.time(),
+            'fps': fps,
+            'MBps': rate / 1e6,
+            'total': total,
+            'stages': stages,
+        }
+
+    def toJson(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def writeFile(self, path):
+        """Replace path with the snapshot as JSON, so that readers never
+        see half of it. Raises OSError, the old file is then kept."""
+        partial = path + '.tmp'
+        try:
+            with open(partial, 'w') as f:
+                f.write(self.toJson())
+            os.replace(partial, path)
+        except OSError:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            raise
+
+    def lines(self):
+        """Snapshot as text, one line per stage, milliseconds."""
+        s = self.snapshot()
+        lines = ["%.1f frames/s  %.3f MB/s" % (s['fps'], s['MBps'])]
+        for stage, summary in s['stages'].items():
+            if summary['count']:
+                lines.append("%-8s p50 %7.2f  p99 %7.2f ms" %
+                             (stage, summary['p50'] * 1e3, summary['p99'] * 1e3))
+        return lines
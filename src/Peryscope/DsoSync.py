@@ -0,0 +1,198 @@
+
+# Time aligned captures from several scopes.
+#
+# The devices are initialized once and then captured in rounds. In every
+# round each device runs readData in its own thread, and the threads wait
+# on a barrier right before the A/D is started, so the devices are armed
+# within a few USB round trips of each other.
+#
+# The skew between devices is estimated from the host clock first:
+# triggered captures are placed around the same event, untriggered ones
+# differ by the time they were stopped. That is only as good as the USB
+# latency, so when a reference channel carries the same signal on every
+# device, the skew is refined by cross-correlating it with the first
+# device, searching lags around the host clock estimate. The captures
+# are then cut to the part they all cover and merged into one array.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+import numpy as np
+
+from PerytechDsoApi import (
+    PerytechDsoApi,
+    Channel,
+    sampleTimeDivider,
+    calibrationFile,
+)
+from DsoDecoder import DsoDecoder
+from DsoDevices import deviceName
+
+logger = logging.getLogger('peryscope')
+
+# Correlation below this is not trusted, the host clock estimate is used
+MIN_CORRELATION = 0.5
+# Correlation peaks within this of the highest are taken as equally good
+# matches, the periods of a repeating reference
+PEAK_TOLERANCE = 0.01
+# Seconds to wait for the other devices to be ready to arm
+BARRIER_TIMEOUT = 5.0
+
+
+def estimateSkew(reference, data, around=0, maxLag=None):
+    """Lag of data against reference in samples, and the correlation.
+
+    Sample k of data is sample k + lag of reference. Only lags within
+    maxLag of around, and where the captures overlap by at least half,
+    are considered. The lag is refined to a fraction of a sample by a
+    parabola through the correlation peak. If the reference repeats
+    within maxLag, every period is a match, and the one nearest to
+    around is taken.
+    """
+    a = np.asarray(reference, dtype=np.float64)
+    b = np.asarray(data, dtype=np.float64)
+    a = a - a.mean()
+    b = b - b.mean()
+    n = 1 << int(len(a) + len(b) - 1).bit_length()
+    corr = np.fft.irfft(np.fft.rfft(a, n) * np.conj(np.fft.rfft(b, n)), n)
+    shortest = min(len(a), len(b))
+    if maxLag is None:
+        maxLag = shortest // 2
+    lo = max(around - maxLag, shortest // 2 - len(b))
+    hi = min(around + maxLag, len(a) - shortest // 2)
+    if lo > hi:
+        return around, 0.0
+    lags = np.arange(lo, hi + 1)
+    # Normalize by the energy of the overlapping parts, so that a perfect
+    # match is 1 at any lag. Negative lags wrap around to the end.
+    ea = np.concatenate(([0.0], np.cumsum(a * a)))
+    eb = np.concatenate(([0.0], np.cumsum(b * b)))
+    start = np.maximum(0, lags)
+    end = np.minimum(len(a), len(b) + lags)
+    energy = (ea[end] - ea[start]) * (eb[end - lags] - eb[start - lags])
+    values = corr[lags % n] / np.sqrt(np.maximum(energy, 1e-30))
+    best = int(np.argmax(values))
+    # Of equally good peaks (a periodic reference) take the nearest one.
+    # Only local maxima compete, the neighbours of a peak are never taken
+    # over the peak itself.
+    inner = values[1:-1]
+    peaks = np.flatnonzero((inner >= values[:-2]) & (inner > values[2:])) + 1
+    peaks = peaks[values[peaks] >= values[best] - PEAK_TOLERANCE]
+    if len(peaks):
+        nearest = peaks[np.argmin(np.abs(lags[peaks] - around))]
+        if abs(lags[nearest] - around) < abs(lags[best] - around):
+            best = int(nearest)
+    lag = float(lags[best])
+    if 0 < best < len(values) - 1:
+        y0, y1, y2 = values[best - 1:best + 2]
+        curvature = y0 - 2 * y1 + y2
+        if curvature < 0:
+            lag += 0.5 * (y0 - y2) / curvature
+    return lag, float(values[best])
+
+
+def align(arrays, skews):
+    """Cut arrays to the samples they all cover.
+
+    skews[d] is the lag of arrays[d] against the first array, rounded to
+    whole samples. Returns the cut arrays stacked, and the index in the
+    first array where they start.
+    """
+    skews = [int(round(s)) for s in skews]
+    start = max(max(skews), 0)
+    end = min(len(a) + s for a, s in zip(arrays, skews))
+    if end <= start:
+        return np.zeros((len(arrays), 0), dtype=np.float32), start
+    return np.stack([a[start - s:end - s] for a, s in zip(arrays, skews)]), start
+
+
+class SyncFrame:
+    # Merged capture of all devices
+
+    def __init__(self, i, data, start, skews, correlations, times, triggered):
+        self.i = i
+        # (devices * 2, samples) volts, ch1 and ch2 of each device in order
+        self.data = data
+        # Index of the first merged sample in the capture of the first device
+        self.start = start
+        self.skews = skews
+        self.correlations = correlations
+        # time.monotonic() of arm, trigger and stop for each device
+        self.times = times
+        self.triggered = triggered
+
+
+class DsoSync:
+
+    def __init__(self, udevs, acquisition, usbcontext=None, reference=Channel.Ch1,
+                 forceInit=True, debug=False, cacheFile=calibrationFile):
+        self.acquisition = acquisition
+        self.reference = reference
+        self.names = [deviceName(udev) for udev in udevs]
+        self.decoder = DsoDecoder()
+        self.dsos = []
+        for udev in udevs:
+            dso = PerytechDsoApi()
+            dso.context = usbcontext
+            dso.setDebug(debug)
+            self.dsos.append(dso)
+        self.pool = ThreadPoolExecutor(max_workers=len(self.dsos))
+        self.barrier = threading.Barrier(len(self.dsos), timeout=BARRIER_TIMEOUT)
+        self.i = 0
+        list(self.pool.map(lambda d: self.__init(d[0], d[1], forceInit, cacheFile),
+                           zip(self.dsos, udevs)))
+
+    def __init(self, dso, udev, forceInit, cacheFile):
+        dso.initDevice(udev, forceInit=forceInit, cacheFile=cacheFile)
+        self.acquisition.apply(dso)
+
+    def close(self):
+        self.pool.shutdown()
+        for dso in self.dsos:
+            dso.close()
+
+    def __read(self, dso):
+        a = self.acquisition
+        try:
+            data = dso.readData(a.size, triggerTimeout=a.trigTimeout,
+                                triggerOffset=a.trigOffset, beforeArm=self.barrier.wait)
+        except threading.BrokenBarrierError:
+            raise Exception("Another device failed")
+        except Exception:
+            self.barrier.abort()
+            raise
+        return data, dso.getCaptureTimes()
+
+    def capture(self):
+        """Capture all devices once, returns a SyncFrame."""
+        self.barrier.reset()
+        results = list(self.pool.map(self.__read, self.dsos))
+        a = self.acquisition
+        rate = sampleTimeDivider[a.sampleRate]
+        captures = [self.decoder.decode(data[0], a.ch1VoltageDIV, a.ch2VoltageDIV, dso.getCalibration)
+                    for (data, times), dso in zip(results, self.dsos)]
+        triggered = [data[1] for data, times in results]
+        times = [times for data, times in results]
+        ref = captures[0].volts(self.reference)
+        skews = [0]
+        correlations = [1.0]
+        for d in range(1, len(captures)):
+            # Triggered captures are placed around the trigger, which is
+            # the same event on all devices. The others end when they are
+            # stopped, and the stop is timed closely.
+            if triggered[0] and triggered[d]:
+                clock = 0
+            else:
+                clock = int(round((times[d]['stop'] - times[0]['stop']) * rate))
+            skew, c = estimateSkew(ref, captures[d].volts(self.reference), clock)
+            if c < MIN_CORRELATION:
+                skew = clock
+            skews.append(skew)
+            correlations.append(c)
+        merged, start = align([v for capture in captures
+                               for v in (capture.volts(Channel.Ch1), capture.volts(Channel.Ch2))],
+                              [s for s in skews for channel in range(2)])
+        frame = SyncFrame(self.i, merged, start, skews, correlations, times, triggered)
+        self.i += 1
+        return frame
@@ -0,0 +1,474 @@
+
+# Pluggable transports for PerytechDsoApi.
+#
+# PerytechDsoApi talks to its device handle (self.dev) only through
+# bulkRead/bulkWrite/controlRead/controlWrite, so anything that has those
+# can stand in for a real usb1 handle:
+#
+#   RecordingDevice  wraps a real device and writes every transfer to a file
+#   ReplayDevice     plays such a file back
+#   SimulatedDevice  models the registers and generates synthetic waveforms
+#
+# All of them look like a usb1.USBDevice to initDevice(), ie. they have open().
+
+import gzip
+import math
+import time
+import random
+from struct import pack, unpack, calcsize
+import logging
+
+from PerytechDsoApi import (
+    Reg,
+    SampleRate,
+    VoltageDIV,
+    Channel,
+    TriggerEdge,
+    sampleTimeDivider,
+    voltages,
+    countsPerDiv,
+    bufferSize,
+    preTrigger,
+    postTrigger,
+    coupleDivFields,
+)
+
+logger = logging.getLogger('peryscope')
+
+TRACE_MAGIC = b"PERYREC1"
+
+# kind, duration, request type/endpoint, request, value, index, data length
+TRACE_RECORD = "<BfBBHHI"
+TRACE_RECORD_SIZE = calcsize(TRACE_RECORD)
+
+CONTROL_WRITE = ord('c')
+CONTROL_READ = ord('C')
+BULK_WRITE = ord('b')
+BULK_READ = ord('B')
+
+
+def openTrace(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def readTrace(path):
+    """Read a recorded trace, returns a list of records."""
+    records = []
+    with openTrace(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise Exception("Not a trace file: " + path)
+        while True:
+            header = f.read(TRACE_RECORD_SIZE)
+            if len(header) < TRACE_RECORD_SIZE:
+                break
+            kind, duration, a, b, value, index, length = unpack(TRACE_RECORD, header)
+            records.append((kind, duration, a, b, value, index, f.read(length)))
+    return records
+
+
+class DeviceHandle:
+    # Methods of usb1.USBDeviceHandle, which PerytechDsoApi uses besides
+    # the transfers
+
+    def claimInterface(self, interface):
+        pass
+
+    def resetDevice(self):
+        pass
+
+    def close(self):
+        pass
+
+
+#
+# Recording
+#
+
+class TraceRecorder(DeviceHandle):
+
+    def __init__(self, handle, path):
+        self.handle = handle
+        self.file = openTrace(path, 'wb')
+        self.file.write(TRACE_MAGIC)
+
+    def __record(self, kind, start, a, b, value, index, data):
+        data = bytes(data)
+        self.file.write(pack(TRACE_RECORD, kind, time.perf_counter() - start,
+                             a, b, value, index, len(data)))
+        self.file.write(data)
+
+    def claimInterface(self, interface):
+        self.handle.claimInterface(interface)
+
+    def resetDevice(self):
+        self.handle.resetDevice()
+
+    def close(self):
+        self.file.close()
+        self.handle.close()
+
+    def bulkRead(self, endpoint, length, timeout=0):
+        start = time.perf_counter()
+        data = self.handle.bulkRead(endpoint, length, timeout=timeout)
+        self.__record(BULK_READ, start, endpoint, 0, 0, 0, data)
+        return data
+
+    def bulkWrite(self, endpoint, data, timeout=0):
+        start = time.perf_counter()
+        self.handle.bulkWrite(endpoint, data, timeout=timeout)
+        self.__record(BULK_WRITE, start, endpoint, 0, 0, 0, data)
+
+    def controlRead(self, bRequestType, bRequest, wValue, wIndex, wLength, timeout=0):
+        start = time.perf_counter()
+        data = self.handle.controlRead(bRequestType, bRequest, wValue, wIndex, wLength,
+                                       timeout=timeout)
+        self.__record(CONTROL_READ, start, bRequestType, bRequest, wValue, wIndex, data)
+        return data
+
+    def controlWrite(self, bRequestType, bRequest, wValue, wIndex, data, timeout=0):
+        start = time.perf_counter()
+        self.handle.controlWrite(bRequestType, bRequest, wValue, wIndex, data,
+                                 timeout=timeout)
+        self.__record(CONTROL_WRITE, start, bRequestType, bRequest, wValue, wIndex, data)
+
+
+class RecordingDevice:
+
+    def __init__(self, udev, path):
+        self.udev = udev
+        self.path = path
+
+    def getBusNumber(self):
+        return self.udev.getBusNumber()
+
+    def getDeviceAddress(self):
+        return self.udev.getDeviceAddress()
+
+    def open(self):
+        return TraceRecorder(self.udev.open(), self.path)
+
+
+#
+# Replay
+#
+
+class TraceReplay(DeviceHandle):
+
+    def __init__(self, records, latency=None):
+        # latency None: use the recorded transfer times
+        self.records = records
+        self.latency = latency
+        self.pos = 0
+        self.mismatches = 0
+
+    def __next(self, kind, a, b, value, index, data=None):
+        while self.pos < len(self.records):
+            record = self.records[self.pos]
+            self.pos += 1
+            if record[0] == kind and record[2] == a and record[3] == b and \
+                    record[4] == value and record[5] == index:
+                if data is not None and bytes(data) != record[6]:
+                    self.mismatches += 1
+                    logger.debug("Replay data mismatch at %d", self.pos - 1)
+                delay = record[1] if self.latency is None else self.latency
+                if delay > 0:
+                    time.sleep(delay)
+                return record[6]
+            self.mismatches += 1
+            logger.debug("Replay skipping record %d", self.pos - 1)
+        raise Exception("Replay trace exhausted")
+
+    def bulkRead(self, endpoint, length, timeout=0):
+        return bytearray(self.__next(BULK_READ, endpoint, 0, 0, 0))
+
+    def bulkWrite(self, endpoint, data, timeout=0):
+        self.__next(BULK_WRITE, endpoint, 0, 0, 0, data)
+
+    def controlRead(self, bRequestType, bRequest, wValue, wIndex, wLength, timeout=0):
+        return self.__next(CONTROL_READ, bRequestType, bRequest, wValue, wIndex)
+
+    def controlWrite(self, bRequestType, bRequest, wValue, wIndex, data, timeout=0):
+        self.__next(CONTROL_WRITE, bRequestType, bRequest, wValue, wIndex, data)
+
+
+class ReplayDevice:
+
+    def __init__(self, path, latency=None):
+        self.path = path
+        self.latency = latency
+
+    def getBusNumber(self):
+        return 0
+
+    def getDeviceAddress(self):
+        return 0
+
+    def open(self):
+        return TraceReplay(readTrace(self.path), self.latency)
+
+
+#
+# Simulator
+#
+
+def decodeVoltageDIV(nibble, rangeBits):
+    # Reverse of PerytechDsoApi.__setVoltageDIV
+    for v in VoltageDIV:
+        if rangeBits == 0x01 and v.value < VoltageDIV.mV100.value and (v.value & 0x0f) == nibble:
+            return v
+        if rangeBits == 0x02 and v.value >= VoltageDIV.mV100.value and \
+                v.value - VoltageDIV.mV100.value == nibble:
+            return v
+    return VoltageDIV.V1
+
+
+class Waveform:
+    # Synthetic test signal: ch1 sine, ch2 square, in volts
+
+    def __init__(self, freq1=1000.0, amplitude1=1.0, freq2=500.0, amplitude2=0.5, noise=0.0):
+        self.freq1 = freq1
+        self.amplitude1 = amplitude1
+        self.freq2 = freq2
+        self.amplitude2 = amplitude2
+        self.noise = noise
+
+    def value(self, channel, t):
+        if channel == Channel.Ch1:
+            v = self.amplitude1 * math.sin(2 * math.pi * self.freq1 * t)
+        else:
+            v = self.amplitude2 if math.fmod(t * self.freq2, 1.0) < 0.5 else -self.amplitude2
+        if self.noise:
+            v += random.gauss(0, self.noise)
+        return v
+
+
+# Words of the configuration EEPROM the init sequences read back, by address
+EEPROM_WORDS = {
+    0x04: 0x8657, 0x05: 0xb86b, 0x06: 0x8e1e, 0x07: 0xb605,
+    0x10: 0xa025, 0x11: 0xfef3, 0x12: 0xf03d, 0x13: 0xef82,
+    0x14: 0x45c1, 0x15: 0xf297, 0x16: 0xddce, 0x17: 0x85f6,
+    0x18: 0x1e25, 0x19: 0x6e2d, 0x1a: 0x4bba, 0x1b: 0xfe0e,
+    0x1c: 0xb44b, 0x1d: 0x52f4, 0x1f: 0xffff,
+    0x38: 0x310f, 0x39: 0x3032, 0x3a: 0x3032, 0x3b: 0x3830,
+    0x3c: 0x3831, 0x3d: 0x3030, 0x3e: 0x3030, 0x3f: 0x3237,
+}
+
+
+class SerialEeprom:
+    # 93C46 type serial EEPROM, 64 words of 16 bits, bit banged through
+    # control request 0x8B: bit 0 chip select, bit 1 clock, bit 2 data in.
+    # Its data out is bit 3 of the status read with request 0x8A. Only the
+    # READ instruction (start bit, opcode 10, 6 bit address) is modeled.
+
+    def __init__(self, words):
+        self.words = words
+        self.clock = 0
+        self.bits = []
+        self.word = 0
+        self.out = 0
+
+    def write(self, value):
+        if not value & 0x01:
+            # Deselected, ends the instruction
+            self.bits = []
+            self.out = 0
+        elif value & 0x02 and not self.clock:
+            self.__tick((value >> 2) & 0x01)
+        self.clock = value & 0x02
+
+    def __tick(self, bit):
+        if len(self.bits) < 9:
+            self.bits.append(bit)
+            if len(self.bits) == 9 and self.bits[:3] == [1, 1, 0]:
+                address = 0
+                for b in self.bits[3:]:
+                    address = address << 1 | b
+                self.word = self.words.get(address, 0xffff)
+            # Dummy zero before the data
+            self.out = 0
+            return
+        # Data out, most significant bit first
+        self.out = (self.word >> 15) & 0x01
+        self.word = (self.word << 1) & 0xffff
+
+    def status(self):
+        return 0x71 | self.out << 3
+
+
+class SimulatedDso(DeviceHandle):
+
+    def __init__(self, waveform=None, latency=0.0):
+        self.waveform = Waveform() if waveform is None else waveform
+        self.latency = latency
+        self.epoch = time.time()
+        self.regs = {
+            Reg.HELLO.value: 0x1101,
+            Reg.MAYBE_DEVICE_STATUS.value: 0x0001,
+            Reg.MAYBE_SOME_STATUS.value: 0x0008,
+            Reg.SAMPLE_RATE.value: SampleRate.kS100.value,
+        }
+        self.coupling = 0x2800
+        self.selected = 0
+        self.running = False
+        self.armTime = 0
+        self.armSample = 0
+        self.start = 0
+        self.written = 0
+        self.trigger = None
+        self.readPos = 0
+        self.eeprom = SerialEeprom(EEPROM_WORDS)
+
+    def __delay(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def __rate(self):
+        try:
+            return sampleTimeDivider[SampleRate(self.regs.get(Reg.SAMPLE_RATE.value))]
+        except (ValueError, KeyError):
+            return sampleTimeDivider[SampleRate.kS100]
+
+    def __voltageDIV(self, channel):
+        div = self.regs.get(Reg.VOLTAGE_DIV1.value, 0)
+        if channel == Channel.Ch1:
+            return decodeVoltageDIV(div & 0x0f, (self.coupling >> 12) & 0x03)
+        return decodeVoltageDIV((div >> 4) & 0x0f, (self.coupling >> 10) & 0x03)
+
+    def __sample(self, channel, k):
+        if self.regs.get(Reg.MAYBE_DEVICE_CONTROL.value, 0) & 0x08:
+            # Inputs connected to ground
+            return 0x80
+        t = float(self.armSample + k) / self.__rate()
+        v = self.waveform.value(channel, t)
+        raw = int(round(v * countsPerDiv / voltages[self.__voltageDIV(channel)])) + 0x80
+        return min(max(raw, 0), 0xff)
+
+    def __level(self, channel):
+        level = self.regs.get(Reg.TRIG_LEVEL.value, 0x8080)
+        return (level >> 8) & 0xff if channel == Channel.Ch2 else level & 0xff
+
+    def __findTrigger(self, first, last):
+        try:
+            channel = Channel(self.regs.get(Reg.TRIG_CHANNEL.value, 0))
+        except ValueError:
+            return None
+        if channel not in (Channel.Ch1, Channel.Ch2):
+            return None
+        level = self.__level(channel)
+        rising = self.regs.get(Reg.TRIG_EDGE.value) != TriggerEdge.Falling.value
+        prev = self.__sample(channel, first - 1)
+        for k in range(first, last):
+            cur = self.__sample(channel, k)
+            if (rising and prev < level <= cur) or (not rising and prev > level >= cur):
+                return k
+            prev = cur
+        return None
+
+    def __update(self):
+        # Advance the acquisition to the current time
+        if not self.running:
+            return
+        n = int((time.time() - self.armTime) * self.__rate())
+        if self.trigger is None and n > preTrigger:
+            # Older samples would be overwritten anyway
+            self.trigger = self.__findTrigger(max(preTrigger, self.written, n - bufferSize), n)
+        if self.trigger is not None:
+            n = min(n, self.trigger + postTrigger)
+        self.written = n
+        # 0x08 filling the pre-trigger part, 0x09 waiting for trigger,
+        # 0x0b triggered and post-trigger part done
+        status = 0x0008 if n < preTrigger else 0x0009
+        if self.trigger is not None and n >= self.trigger + postTrigger:
+            status = 0x000b
+        self.regs[Reg.MAYBE_SOME_STATUS.value] = status
+        end = (self.start + self.written) % bufferSize
+        if self.trigger is not None:
+            self.regs[Reg.MAYBE_TRIGGER_COUNT_04.value] = (self.start + self.trigger) % bufferSize
+        else:
+            self.regs[Reg.MAYBE_TRIGGER_COUNT_04.value] = (end - postTrigger) % bufferSize
+        self.regs[Reg.MAYBE_BUFFER_COUNT_06.value] = end
+
+    def __write(self, addr, value):
+        self.regs[addr] = value
+        if addr == Reg.MAYBE_DEVICE_CONTROL.value:
+            self.regs[Reg.MAYBE_DEVICE_STATUS.value] = value
+        elif addr == Reg.VOLTAGE_COUPLING.value and value:
+            for mask in coupleDivFields:
+                if value & mask:
+                    self.coupling = (self.coupling & ~mask) | (value & mask)
+        elif addr == Reg.MAYBE_AD_CONTROL.value:
+            if value & 0x01 and not self.running:
+                self.running = True
+                self.armTime = time.time()
+                self.armSample = int((self.armTime - self.epoch) * self.__rate())
+                self.start = (self.start + self.written) % bufferSize
+                self.written = 0
+                self.trigger = None
+            elif not value & 0x01:
+                self.__update()
+                self.running = False
+        elif addr == Reg.MAYBE_SOME_RESET.value and value:
+            self.regs[Reg.MAYBE_SOME_STATUS.value] = 0x0008
+
+    def __stream(self, length):
+        # Samples from the ring buffer starting at UNKNOWN_55
+        self.__update()
+        data = bytearray(length)
+        for i in range(0, length - 1, 2):
+            # Latest sample written to this position
+            k = (self.readPos - self.start) % bufferSize
+            if k < self.written:
+                k += (self.written - 1 - k) // bufferSize * bufferSize
+            else:
+                k -= bufferSize
+            if self.armSample + k >= 0:
+                data[i] = self.__sample(Channel.Ch1, k)
+                data[i + 1] = self.__sample(Channel.Ch2, k)
+            else:
+                data[i] = data[i + 1] = 0x80
+            self.readPos = (self.readPos + 1) % bufferSize
+        return data
+
+    def bulkRead(self, endpoint, length, timeout=0):
+        self.__delay()
+        if self.selected == Reg.BUFFER_VALUE_03.value:
+            return self.__stream(length)
+        self.__update()
+        return bytearray(pack('H', self.regs.get(self.selected, 0)))[:length]
+
+    def bulkWrite(self, endpoint, data, timeout=0):
+        self.__delay()
+        self.__write(self.selected, unpack('H', bytes(data[:2]))[0])
+
+    def controlRead(self, bRequestType, bRequest, wValue, wIndex, wLength, timeout=0):
+        self.__delay()
+        return bytes([self.eeprom.status()] * wLength)
+
+    def controlWrite(self, bRequestType, bRequest, wValue, wIndex, data, timeout=0):
+        self.__delay()
+        if bRequest == 0x0C and wValue == 0x0083:
+            self.selected = data[0]
+            if self.selected == Reg.BUFFER_VALUE_03.value:
+                self.readPos = self.regs.get(Reg.UNKNOWN_55.value, 0) % bufferSize
+        elif bRequest == 0x0C and wValue == 0x008B:
+            for value in data:
+                self.eeprom.write(value)
+
+
+class SimulatedDevice:
+
+    def __init__(self, waveform=None, latency=0.0, address=0):
+        self.waveform = waveform
+        self.latency = latency
+        self.address = address
+
+    def getBusNumber(self):
+        return 0
+
+    def getDeviceAddress(self):
+        return self.address
+
+    def open(self):
+        return SimulatedDso(self.waveform, self.latency)
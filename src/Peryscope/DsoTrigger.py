@@ -0,0 +1,283 @@
+
+# Software triggers.
+#
+# The hardware triggers only on an edge of one channel. These triggers
+# run over a capture that is longer than the display (or over streamed
+# data) and find the events with a few O(n) NumPy passes: level crossings
+# with hysteresis, then searchsorted to pair them up.
+#
+# Levels are A/D counts from the center, like DsoConfig.ch1TrigVoltage,
+# and times are in samples. find() returns the sample indices of all
+# events, locate() the one the display should be aligned to.
+
+import argparse
+import inspect
+
+import numpy as np
+
+from PerytechDsoApi import (
+    Channel,
+    TriggerEdge,
+)
+from DsoDecoder import channelViews
+from DsoMeasure import crossings
+
+# Hysteresis of the level crossings, A/D counts
+HYSTERESIS = 2
+# States of a channel in a pattern: high, low, don't care
+PATTERN_STATES = ('H', 'L', 'X')
+
+
+def signed(data):
+    """Channel samples as counts from the center."""
+    return data.astype(np.int16) - 0x80
+
+
+def following(events, after):
+    """For every index in after, the first of events past it, -1 if none."""
+    i = np.searchsorted(events, after, side='right')
+    result = np.full(len(after), -1, dtype=np.int64)
+    ok = i < len(events)
+    result[ok] = events[i[ok]]
+    return result
+
+
+def between(events, start, end):
+    """Number of events in [start, end) for every pair."""
+    return np.searchsorted(events, end, side='left') - np.searchsorted(events, start, side='left')
+
+
+class Trigger:
+
+    channel = Channel.Ch1
+    hysteresis = HYSTERESIS
+
+    def find(self, ch1, ch2):
+        """Indices of all trigger events, ch1 and ch2 are signed counts."""
+        raise NotImplementedError
+
+    def events(self, data):
+        # Events of interleaved raw ch1/ch2 data
+        ch1, ch2 = channelViews(data)
+        return self.find(signed(ch1), signed(ch2))
+
+    def locate(self, data, size, pre=0, near=None):
+        """Index of the event to show size samples around, or None.
+
+        The event has to leave pre samples before and size - pre from it
+        in data. The first such event is taken, or the one closest to near.
+        """
+        events = self.events(data)
+        n = len(data) >> 1
+        events = events[(events >= pre) & (events - pre + size <= n)]
+        if not len(events):
+            return None
+        if near is None:
+            return int(events[0])
+        return int(events[np.argmin(np.abs(events - near))])
+
+    def crossings(self, ch1, ch2, level):
+        data = ch1 if self.channel == Channel.Ch1 else ch2
+        return crossings(data, level, self.hysteresis)
+
+
+class EdgeTrigger(Trigger):
+
+    def __init__(self, channel=Channel.Ch1, level=0, edge=TriggerEdge.Rising):
+        self.channel = channel
+        self.level = level
+        self.edge = edge
+
+    def find(self, ch1, ch2):
+        rising, falling = self.crossings(ch1, ch2, self.level)
+        return rising if self.edge == TriggerEdge.Rising else falling
+
+
+class PulseTrigger(Trigger):
+    # Pulse width between minWidth and maxWidth, triggers at the end of it
+
+    def __init__(self, channel=Channel.Ch1, level=0, positive=True, minWidth=0, maxWidth=None):
+        self.channel = channel
+        self.level = level
+        self.positive = positive
+        self.minWidth = minWidth
+        self.maxWidth = maxWidth
+
+    def find(self, ch1, ch2):
+        rising, falling = self.crossings(ch1, ch2, self.level)
+        starts, ends = (rising, falling) if self.positive else (falling, rising)
+        stops = following(ends, starts)
+        width = stops - starts
+        ok = (stops >= 0) & (width >= self.minWidth)
+        if self.maxWidth is not None:
+            ok &= width <= self.maxWidth
+        return stops[ok]
+
+
+class RuntTrigger(Trigger):
+    # Pulse that crosses low but falls back without reaching high
+
+    def __init__(self, channel=Channel.Ch1, low=-10, high=10, positive=True):
+        self.channel = channel
+        self.low = low
+        self.high = high
+        self.positive = positive
+
+    def find(self, ch1, ch2):
+        lowRising, lowFalling = self.crossings(ch1, ch2, self.low)
+        highRising, highFalling = self.crossings(ch1, ch2, self.high)
+        if self.positive:
+            starts, ends, over = lowRising, lowFalling, highRising
+        else:
+            starts, ends, over = highFalling, highRising, lowFalling
+        stops = following(ends, starts)
+        ok = stops >= 0
+        starts, stops = starts[ok], stops[ok]
+        return stops[between(over, starts, stops) == 0]
+
+
+class WindowTrigger(Trigger):
+    # Signal leaving (or entering) the window between low and high
+
+    def __init__(self, channel=Channel.Ch1, low=-10, high=10, enter=False):
+        self.channel = channel
+        self.low = low
+        self.high = high
+        self.enter = enter
+
+    def find(self, ch1, ch2):
+        data = ch1 if self.channel == Channel.Ch1 else ch2
+        inside = (data >= self.low) & (data <= self.high)
+        change = np.diff(inside.view(np.int8))
+        return np.flatnonzero(change == (1 if self.enter else -1)) + 1
+
+
+class SlopeTrigger(Trigger):
+    # Transition between low and high taking minTime to maxTime samples
+
+    def __init__(self, channel=Channel.Ch1, low=-10, high=10, positive=True, minTime=0, maxTime=None):
+        self.channel = channel
+        self.low = low
+        self.high = high
+        self.positive = positive
+        self.minTime = minTime
+        self.maxTime = maxTime
+
+    def find(self, ch1, ch2):
+        lowRising, lowFalling = self.crossings(ch1, ch2, self.low)
+        highRising, highFalling = self.crossings(ch1, ch2, self.high)
+        if self.positive:
+            starts, ends, back = lowRising, highRising, lowFalling
+        else:
+            starts, ends, back = highFalling, lowFalling, highRising
+        # The last start before (or at) every end
+        i = np.searchsorted(starts, ends, side='right') - 1
+        ok = i >= 0
+        ends = ends[ok]
+        starts = starts[i[ok]]
+        # Not a transition if the signal went back in between
+        ok = between(back, starts, ends) == 0
+        time = ends - starts
+        ok &= time >= self.minTime
+        if self.maxTime is not None:
+            ok &= time <= self.maxTime
+        return ends[ok]
+
+
+class PatternTrigger(Trigger):
+    # ch1 and ch2 each high ('H'), low ('L') or don't care ('X') for at
+    # least minTime samples, triggers when that time is reached
+
+    def __init__(self, ch1='H', ch2='X', level1=0, level2=0, minTime=1):
+        self.pattern = (ch1.upper(), ch2.upper())
+        for state in self.pattern:
+            if state not in PATTERN_STATES:
+                raise ValueError("pattern state %s, one of %s" % (state, ", ".join(PATTERN_STATES)))
+        self.levels = (level1, level2)
+        self.minTime = max(1, minTime)
+
+    def find(self, ch1, ch2):
+        match = np.ones(len(ch1), dtype=bool)
+        for data, state, level in zip((ch1, ch2), self.pattern, self.levels):
+            if state == 'H':
+                match &= data > level
+            elif state == 'L':
+                match &= data < level
+        edges = np.diff(np.concatenate(([0], match.view(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        ok = ends - starts >= self.minTime
+        return starts[ok] + self.minTime - 1
+
+
+class NthEdgeTrigger(Trigger):
+    # Nth edge after the signal was idle for idle samples, or every nth
+    # edge when idle is 0
+
+    def __init__(self, channel=Channel.Ch1, level=0, edge=TriggerEdge.Rising, n=1, idle=0):
+        self.channel = channel
+        self.level = level
+        self.edge = edge
+        self.n = max(1, n)
+        self.idle = idle
+
+    def find(self, ch1, ch2):
+        rising, falling = self.crossings(ch1, ch2, self.level)
+        edges = rising if self.edge == TriggerEdge.Rising else falling
+        if not self.idle:
+            return edges[self.n - 1::self.n]
+        gaps = np.diff(np.concatenate(([0], edges)))
+        first = np.flatnonzero(gaps >= self.idle)
+        # Position of every edge in its burst
+        burst = np.searchsorted(first, np.arange(len(edges)), side='right') - 1
+        ok = burst >= 0
+        position = np.arange(len(edges)) - first[np.maximum(burst, 0)]
+        return edges[ok & (position == self.n - 1)]
+
+
+TRIGGERS = {
+    'edge': EdgeTrigger,
+    'pulse': PulseTrigger,
+    'runt': RuntTrigger,
+    'window': WindowTrigger,
+    'slope': SlopeTrigger,
+    'pattern': PatternTrigger,
+    'nth': NthEdgeTrigger,
+}
+
+
+def parseTrigger(spec):
+    """Trigger from "kind,name=value,...", e.g. "pulse,level=10,minWidth=20".
+
+    channel is 1 or 2, edge rising or falling, positive and enter yes or
+    no, ch1 and ch2 of a pattern H, L or X, everything else a number.
+    Raises argparse.ArgumentTypeError, so it can be an argparse type.
+    """
+    kind, *params = spec.split(',')
+    if kind not in TRIGGERS:
+        raise argparse.ArgumentTypeError("unknown trigger %s, one of %s" % (kind, ", ".join(TRIGGERS)))
+    names = list(inspect.signature(TRIGGERS[kind]).parameters)
+    kwargs = {}
+    try:
+        for param in params:
+            name, _, value = param.partition('=')
+            if name not in names:
+                raise argparse.ArgumentTypeError("unknown %s trigger parameter %s, one of %s" %
+                                                 (kind, name, ", ".join(names)))
+            if name == 'channel':
+                if value not in ('1', '2'):
+                    raise ValueError("channel %s, 1 or 2" % value)
+                kwargs[name] = Channel(int(value) - 1)
+            elif name == 'edge':
+                if value.capitalize() not in TriggerEdge.__members__:
+                    raise ValueError("edge %s, rising or falling" % value)
+                kwargs[name] = TriggerEdge[value.capitalize()]
+            elif name in ('positive', 'enter'):
+                kwargs[name] = value.lower() in ('1', 'yes', 'true')
+            elif name in ('ch1', 'ch2'):
+                kwargs[name] = value
+            else:
+                kwargs[name] = int(value)
+        return TRIGGERS[kind](**kwargs)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError("bad %s trigger: %s" % (kind, e))
@@ -1,15 +1,23 @@
 
 import binascii
+import json
+import os
 import time
 import usb1
 from datetime import datetime
 from struct import pack, unpack
 from enum import Enum
-from threading import Lock
+from threading import Lock, RLock
+from contextlib import contextmanager
 import logging
 
 logger = logging.getLogger('peryscope')
 
+# Calibration results of __dsoInitial, per device
+calibrationFile = os.path.join(os.path.expanduser('~'), '.cache', 'peryscope', 'calibration.json')
+# The calibration file is shared by all devices
+calibrationLock = Lock()
+
 class Reg(Enum):
     # Read registers
     # ==============
@@ -28,8 +36,8 @@ class Reg(Enum):
     # 0x03 Current A/D value
 
     MAYBE_TRIGGER_COUNT_04 = 0x04
-    # 0x04 Amount of data in buffer ?
-    # or trigger byte count
+    # 0x04 Buffer position of the trigger sample, when triggered
+    # (see captureWindow)
 
     MAYBE_SOME_STATUS = 0x05
     # 0x05 __dsoInitial 0x0008/0x0009/0x000b . Triggered ?
@@ -39,20 +47,20 @@ class Reg(Enum):
     # Some status
 
     MAYBE_BUFFER_COUNT_06 = 0x06
-    # 0x06 Buffer counter
-    # value = reg(0x04) + 0x03FA, when triggered
-    # truncated to 0x1fff (buffer size 0x2000 ?)
+    # 0x06 Buffer write position, the next sample goes here
+    # value = reg(0x04) + 0x03FA (postTrigger), when triggered
+    # truncated to 0x1fff (buffer size 0x2000)
 
     # Write Registers
     # ===============
 
     UNKNOWN_55 = 0x55
-    # 0x55 ???
+    # 0x55 Buffer read position, reading register 0x03 streams samples
+    # from here on, wrapping at the buffer size
     # := __get_reg(Reg.MAYBE_BUFFER_COUNT_06) - 0x7d1
     # := __get_reg(Reg.MAYBE_TRIGGER_COUNT_04) - 0x03ea
     # Always after __get_reg Reg.MAYBE_BUFFER_COUNT_06 or MAYBE_TRIGGER_COUNT_04 
     # and before bulk read
-    # Calibration ? Skip values ? Trigger offset in buffer ?
 
     MAYBE_AD_CONTROL = 0x56
     # 0x56 Reset ?
@@ -137,6 +145,90 @@ class Reg(Enum):
     # 0x6A __dsoInitial magic 'PERYTECH'
 
 
+# Write registers, which hold a configuration value and can be skipped
+# when the shadow copy already has the same value. The others are
+# strobes or part of a sequence and are always written.
+configRegs = {
+    Reg.TRIG_LEVEL.value,
+    Reg.SAMPLE_RATE.value,
+    Reg.VOLTAGE_DIV1.value,
+    Reg.TRIG_CHANNEL.value,
+    Reg.TRIG_EDGE.value,
+}
+
+# Device sample buffer size, in samples
+bufferSize = 0x2000
+# A triggered capture keeps at least preTrigger samples before the trigger
+# sample and stops postTrigger samples after it
+preTrigger = 0x03EA
+postTrigger = 0x03FA
+
+
+def limitPre(size, pre):
+    """pre limited to the samples a triggered capture keeps: at most
+    preTrigger before the trigger sample and postTrigger from it on.
+    Windows of more than preTrigger + postTrigger samples cannot be
+    filled, they get all preTrigger samples and the rest is padded."""
+    return min(max(pre, size - postTrigger), preTrigger)
+
+
+def triggerPre(size, triggerOffset=0):
+    """Samples before the trigger sample in a window of size samples.
+
+    triggerOffset moves the trigger that many samples left from the
+    middle of the window, negative values to the right. A negative
+    result puts the trigger before the start of the window.
+    """
+    return limitPre(size, size // 2 - triggerOffset)
+
+
+def captureWindow(triggerPos, writePos, triggered, size, pre):
+    """Where to read size samples of a stopped capture.
+
+    The device writes the samples to a ring buffer of bufferSize samples.
+    MAYBE_BUFFER_COUNT_06 is the write position and, when triggered,
+    MAYBE_TRIGGER_COUNT_04 the position of the trigger sample. Triggered
+    windows start pre samples before the trigger, others end at the last
+    sample written.
+
+    Returns the buffer position to read from (UNKNOWN_55) and the index
+    of the trigger sample in the window, None when not triggered. The
+    index is negative when the trigger is before the window.
+    """
+    if triggered:
+        return (triggerPos - pre) % bufferSize, pre
+    return (writePos - size) % bufferSize, None
+
+
+# Display refresh interval, for partial captures
+refreshInterval = 0.05
+# Shortest auto trigger timeout
+minTriggerTimeout = 0.1
+
+
+def captureBudget(sampleRate, size, waiting=False):
+    """Timing of a capture of size samples at sampleRate.
+
+    fill is the time it takes to record the samples. In auto mode the
+    trigger timeout is long enough to fill the pre-trigger part and
+    twice the window, when waiting for a trigger it is unlimited (None).
+    refresh is how often partial captures should be shown, None when
+    the whole capture is faster than a display refresh.
+    """
+    rate = float(sampleTimeDivider[sampleRate])
+    fill = size / rate
+    timeout = None if waiting else max(minTriggerTimeout, (preTrigger + 2 * size) / rate)
+    slow = waiting or (preTrigger + size) / rate > 2 * refreshInterval
+    return {
+        'fill': fill,
+        'timeout': timeout,
+        'refresh': refreshInterval if slow else None,
+    }
+
+# Fields of VOLTAGE_COUPLING. A write latches only the non-zero fields.
+coupleDivFields = (0xC000, 0x3000, 0x0C00, 0x0300)
+
+
 class SampleRate(Enum):
     S1 = 1
     S2 = 2
@@ -229,6 +321,10 @@ voltages = {
     VoltageDIV.V10: 10.0,
 }
 
+# A/D counts per division, the same scale as the grid in MainWindow.drawData.
+# volts = (raw - 0x80) * voltages[div] / countsPerDiv
+countsPerDiv = 14
+
 class TriggerEdge(Enum):
     Rising = 2
     Falling = 1
@@ -250,7 +346,30 @@ class PerytechDsoApi:
         self.tv2 = 0
         self.debug = True
         self.dev = None
-        self.lock = Lock()
+        self.context = None
+        # Reentrant, a transaction holds it while its setters run
+        self.lock = RLock()
+        # Shadow copy of the write registers 0x55-0x6A
+        self.shadow = {}
+        # Latched VOLTAGE_COUPLING fields, 0 = unknown
+        self.coupleDiv = 0
+        self.batchDepth = 0
+        self.pending = {}
+        self.pendingCoupleDiv = 0
+        self.pollStats = {'captures': 0, 'polls': 0, 'lastPolls': 0, 'maxPolls': 0}
+        # Zero offsets in A/D counts per VoltageDIV name: [ch1, ch2]
+        self.calibration = {}
+        self.initTimes = {}
+        # Submit the init sequences as asynchronous control batches
+        self.asyncControl = True
+        self.controlQueue = None
+        self.streamTrigChannel = None
+        # time.monotonic() of the last capture: started, armed, trigger
+        # seen, stopped, bulk read started and done
+        self.captureTimes = {}
+        # Buffer position and samples recorded, of a capture in progress
+        self.partialEnd = 0
+        self.partialCount = 0
         pass
 
     #
@@ -261,6 +380,7 @@ class PerytechDsoApi:
         with self.lock:
                 if usbcontext is None:
                         usbcontext = usb1.USBContext()
+                self.context = usbcontext
                 logger.debug('Scanning for devices...')
                 devices = []
                 for udev in usbcontext.getDeviceList(skip_on_error=True):
@@ -278,14 +398,51 @@ class PerytechDsoApi:
                         raise Exception("Failed to find a device")
                 return devices
 
-    def initDevice(self, udev, forceInit=True):
+    def initDevice(self, udev, forceInit=True, cacheFile=calibrationFile):
+        # Without forceInit the handshake is skipped when the device is
+        # already linked and cacheFile has its calibration. Devices
+        # without a serial number or port path are always initialized.
+        times = {}
+        start = time.perf_counter()
         self.dev = udev.open()
         with self.lock:
             self.dev.claimInterface(0)
             self.dev.resetDevice()
-            if (forceInit or self.__get_reg(Reg.MAYBE_DEVICE_STATUS) != 1):
+            self.shadow = {}
+            self.coupleDiv = 0
+            t = time.perf_counter()
+            times['open'] = t - start
+            linked = self.__fingerprint() == (0x1101, 0x0001)
+            times['fingerprint'] = time.perf_counter() - t
+            key = self.__deviceKey(udev)
+            calibration = None
+            if linked and not forceInit:
+                calibration = self.__loadCalibration(cacheFile, key)
+            if calibration is None:
+                t = time.perf_counter()
                 self.__linkDSO()
+                times['link'] = time.perf_counter() - t
+                t = time.perf_counter()
                 self.__dsoInitial()
+                times['initial'] = time.perf_counter() - t
+                self.__saveCalibration(cacheFile, key)
+            else:
+                logger.info('Device already linked, skipping init')
+                self.calibration = calibration
+            times['total'] = time.perf_counter() - start
+            self.initTimes = times
+            logger.info('Init times ' + ' '.join(
+                '%s=%.3fs' % (phase, secs) for phase, secs in times.items()))
+
+    def setAsyncControl(self, val):
+        self.asyncControl = val
+
+    def getInitTimes(self):
+        return dict(self.initTimes)
+
+    def getCalibration(self, voltageDIV):
+        # Zero offset of ch1 and ch2 in A/D counts
+        return tuple(self.calibration.get(voltageDIV.name, (0.0, 0.0)))
 
     def close(self):
         with self.lock:
@@ -298,7 +455,7 @@ class PerytechDsoApi:
     def setSampleRate(self, rate):
         with self.lock:
             logger.info("setSampleRate %s" % rate)
-            self.__set_reg(Reg.SAMPLE_RATE, rate.value)
+            self.__update_reg(Reg.SAMPLE_RATE, rate.value)
 
     def setCh1Couple(self, CouplingValue):
         with self.lock:
@@ -318,7 +475,7 @@ class PerytechDsoApi:
     def setTrigChannel(self, channel):
         with self.lock:
             logger.info("setTrigChannel %s" % (channel))
-            self.__set_reg(Reg.TRIG_CHANNEL, channel.value)
+            self.__update_reg(Reg.TRIG_CHANNEL, channel.value)
 
     def setTrigVoltage(self, channel, trigVoltage):
         with self.lock:
@@ -328,58 +485,122 @@ class PerytechDsoApi:
     def setTrigEdge(self, edge):
         with self.lock:
             logger.info("setTrigEdge %s" % (edge))
-            self.__set_reg(Reg.TRIG_EDGE, edge.value)
-            self.__set_reg(Reg.TRIG_LEVEL, self.tv1 | (self.tv2 << 8))
+            self.__update_reg(Reg.TRIG_EDGE, edge.value)
+            self.__update_reg(Reg.TRIG_LEVEL, self.tv1 | (self.tv2 << 8))
+
+    @contextmanager
+    def transaction(self):
+        # Collect the register writes of the setters called inside the block
+        # and write them out at the end, skipping values the device already
+        # has and merging the VOLTAGE_COUPLING sequences into one. The lock
+        # is held for the whole block, so setters of other threads wait for
+        # it instead of joining the batch.
+        with self.lock:
+            self.batchDepth += 1
+            try:
+                yield self
+            finally:
+                self.batchDepth -= 1
+                if self.batchDepth == 0:
+                    self.__flush()
+
+    def getPollStats(self):
+        return dict(self.pollStats)
+
+    def getCaptureTimes(self):
+        return dict(self.captureTimes)
+
+    def getShadowRegister(self, addr):
+        if not isinstance(addr, int):
+            addr = addr.value
+        return self.shadow.get(addr)
 
     #
     # Reading data
     #
 
-    def readData(self, size, triggerTimeout=0.1, triggerOffset=0):
-        # Write register twice ?
-        self.__controlWrite83(b"\x5A")
-        self.__data_bulk_write(b"\xF8\x03")
-        self.__data_bulk_write(b"\xF8\x03")
-        self.__set_reg(Reg.MAYBE_SOME_RESET, 0x0001)
-        self.__set_reg(Reg.MAYBE_SOME_RESET, 0x0000)
-        self.__set_reg(Reg.MAYBE_AD_CONTROL, 0x0001)
-
-        # Status goes 0x08 -> 0x09 -> 0x0b
-        """
-                0x1101 0x0001 0x91ad 0x0000 0x0008 0x0000
-                0x1101 0x0001 0x91ae 0x0404 0x0009 0x07fe
-                0x1101 0x0001 0x91ae 0x0404 0x000b 0x07fe
-                DATA b'ae91ae90ae90ad8fad8fae8eae8eae8dae8eae8dad8dae8dae8dad8dae8cae'
-                """
-        timeout = time.time() + triggerTimeout
-        while True:
-            regs = self.__getStatusRegisters()
-            if self.debug:
-                    self.showRegisters(regs)
-            triggered = (regs[Reg.MAYBE_SOME_STATUS.value] == 0x0b)
-            if triggered or time.time() > timeout:
-                break
+    def readData(self, size, triggerTimeout=0.1, triggerOffset=0, beforeArm=None, pre=None,
+                 progress=None, refresh=refreshInterval):
+        # Reads size samples with pre of them before the trigger, by
+        # default triggerPre(size, triggerOffset). pre is limited with
+        # limitPre, the samples past postTrigger from the trigger are
+        # padded with 0x80.
+        # Returns the data, if triggered, the index of the trigger sample
+        # in the data (None if not triggered) and the status registers.
+        # triggerTimeout None waits until triggered.
+        # beforeArm is called right before the capture is started, to
+        # start several devices together.
+        # While waiting, progress is called every refresh seconds with the
+        # latest (at most size) samples recorded so far. When it returns
+        # False, the capture is stopped as if it timed out.
+        pre = triggerPre(size, triggerOffset) if pre is None else limitPre(size, pre)
+        triggered, index, regs = self.__capture(triggerTimeout, size, pre, beforeArm,
+                                                progress, refresh)
+
+        buff = self.__read_samples(size)
+        self.captureTimes['done'] = time.monotonic()
+        self.__pad_stale(buff, index)
 
-        self.__set_reg(Reg.MAYBE_AD_CONTROL, 0x0000)
-        val = self.__get_reg(Reg.MAYBE_TRIGGER_COUNT_04)
-        # TODO What is  0x03EA
-        self.__set_reg(Reg.UNKNOWN_55, (val - 0x03EA + triggerOffset) & 0xffff)
-        #self.__set_reg(Reg.UNKNOWN_55, 0x0003)
+        logger.debug('DATA %s [%d] %s', ("TRIG" if triggered else "NO TRIG"), len(buff), binascii.hexlify(buff[0:31]))
+        return (buff, triggered, index, regs)
 
-        self.__controlWrite83(b"\x03")
+    def readDataAsync(self, size, triggerTimeout=0.1, triggerOffset=0, depth=4, buff=None,
+                      beforeArm=None, pre=None, progress=None, refresh=refreshInterval):
+        # Same capture as readData, but the data is drained with several
+        # queued asynchronous transfers into one preallocated buffer.
+        # buff can be given to reuse the same buffer between captures.
+        pre = triggerPre(size, triggerOffset) if pre is None else limitPre(size, pre)
+        triggered, index, regs = self.__capture(triggerTimeout, size, pre, beforeArm,
+                                                progress, refresh)
 
         b = size << 1
-        buff = bytearray()
-        while b > 0:
-            # self.controlWrite(0x40, 0x04, 0x0082, 0x0000, b"\x00\x00\x82\x00\x00\x02\x00\x00")
-            # self.controlWrite(0x40, 0x04, 0x0082, 0x0000, pack("<BBBBHBB", 0x00,0x00,0x82,0x00, min(b, 0x0200), 0x00,0x00))
-            data = self.__data_bulk_read(min(b, 0x0200))
-            # logger.debug('DATA', b, len(buff), len(data), binascii.hexlify(data[0:31]))
-            buff += data
-            b -= len(data)
+        if buff is None or len(buff) != b:
+            buff = bytearray(b)
+        self.__data_bulk_read_async(buff, depth)
+        self.captureTimes['done'] = time.monotonic()
+        self.__pad_stale(buff, index)
 
         logger.debug('DATA %s [%d] %s', ("TRIG" if triggered else "NO TRIG"), len(buff), binascii.hexlify(buff[0:31]))
-        return (buff, triggered, triggerOffset*-1, regs)
+        return (buff, triggered, index, regs)
+
+    #
+    # Streaming (roll mode)
+    #
+
+    def startStream(self):
+        # Start free running acquisition, returns the buffer position
+        with self.lock:
+            self.streamTrigChannel = self.shadow.get(Reg.TRIG_CHANNEL.value)
+            self.__set_reg(Reg.TRIG_CHANNEL, Channel.Ext.value)
+            self.__set_reg(Reg.MAYBE_SOME_RESET, 0x0001)
+            self.__set_reg(Reg.MAYBE_SOME_RESET, 0x0000)
+            self.__set_reg(Reg.MAYBE_AD_CONTROL, 0x0001)
+            return self.__get_reg(Reg.MAYBE_BUFFER_COUNT_06)
+
+    def readStream(self, pos, maxSize=0x0100):
+        # Read at most maxSize samples written after buffer position pos.
+        # Returns the data and the new position.
+        with self.lock:
+            end = self.__get_reg(Reg.MAYBE_BUFFER_COUNT_06) % bufferSize
+            n = (end - pos) % bufferSize
+            if n == 0:
+                return (bytearray(), pos)
+            if n > maxSize:
+                if n > bufferSize - maxSize:
+                    # Overrun, skip to the latest samples
+                    logger.debug('Stream overrun %d', n)
+                    pos = (end - maxSize) % bufferSize
+                n = maxSize
+            self.__set_reg(Reg.UNKNOWN_55, pos)
+            self.__controlWrite83(b"\x03")
+            data = self.__data_bulk_read(n << 1)
+            return (data, (pos + (len(data) >> 1)) % bufferSize)
+
+    def stopStream(self):
+        with self.lock:
+            self.__set_reg(Reg.MAYBE_AD_CONTROL, 0x0000)
+            if self.streamTrigChannel is not None:
+                self.__set_reg(Reg.TRIG_CHANNEL, self.streamTrigChannel)
 
     def readData2(self, size=2000, triggerTimeout=0.1):
         with self.lock:
@@ -407,40 +628,7 @@ class PerytechDsoApi:
             logger.debug('DATA [%d] %s', len(data), binascii.hexlify(data[0:31]))
             return (data, False)
 
-    """
-        def CalMaxValue(self):
-                pass
-        #DLLEXPORT double CalMaxValue(double *data, int DataCount);
-        #// Calculate the maximum value in the buffer
-        def CalMinValue(self):
-                pass
-        #DLLEXPORT double CalMinValue(double *data, int DataCount);
-        #// Calculate the Minimum value in the buffer
-        def CalPeak2Peak(self):
-                pass
-        #DLLEXPORT double CalPeak2Peak(double *data, int DataCount);
-        #// Calculate the Peak to Peak in the buffer
-        def CalPeriod(self):
-                pass
-        #DLLEXPORT double CalPeriod(double *data, int DataCount);
-        #// Calculate the Period in the buffer
-        def CalFrequency(self):
-                pass
-        #DLLEXPORT double CalFrequency(double *data, int DataCount);
-        #// Calculate the Frequency in the buffer
-        def CalRMS(self):
-                pass
-        #DLLEXPORT double CalRMS(double *data, int DataCount);
-        #// Calculate the RMS value in the buffer
-        def CalAverage(self):
-                pass
-        #DLLEXPORT double CalAverage(double *data, int DataCount);
-        #// Calculate the Average value in the buffer
-        def CalDutyCycle(self):
-                pass
-        #DLLEXPORT double CalDutyCycle(double *data, int DataCount);
-        #// Calculate the Duty Cycle in the buffer
-        """
+    # Measurements (CalMaxValue, CalRMS, ...) are in DsoMeasure
 
     def getRegister(self, addr):
         with self.lock:
@@ -479,11 +667,16 @@ class PerytechDsoApi:
 
     def __controlWrite8B(self, data, timeout=None):
         for d in data:
-            self.controlWrite(0x40, 0x0C, 0x008B,  0x0000,
-                              pack('B', d), timeout)
+            self.__controlWriteQueued(0x008B, pack('B', d), timeout)
 
     def __controlWrite89(self, data):
-        self.controlWrite(0x40, 0x0C, 0x0089, 0x0000, data)
+        self.__controlWriteQueued(0x0089, data)
+
+    def __controlWriteQueued(self, wValue, data, timeout=None):
+        if self.controlQueue is not None:
+            self.controlQueue.append((0x40, 0x0C, wValue, 0x0000, data, None))
+        else:
+            self.controlWrite(0x40, 0x0C, wValue, 0x0000, data, timeout)
 
     def __controlWrite83(self, data):
         self.controlWrite(0x40, 0x0C, 0x0083, 0x0000, data)
@@ -504,6 +697,294 @@ class PerytechDsoApi:
             "<BBBBHBB", 0x01, 0x00, 0x82, 0x00, size, 0x00, 0x00))
         self.bulkWrite(0x02, data)  # b"\x01\x00"
 
+    def __data_bulk_read_async(self, buff, depth=4, chunkSize=0x0200, timeout=None):
+        # Keep up to depth (setup, bulk read) pairs queued. The setups are
+        # serialized on the control endpoint and the reads complete in
+        # submission order, so the chunks land in buff in order. The next
+        # setup of a pair goes out only when its read is done, like in the
+        # recorded sequence.
+        if not hasattr(self.dev, 'getTransfer'):
+            # Not a usb1 handle, eg. a simulated device
+            off = 0
+            while off < len(buff):
+                data = self.__data_bulk_read(min(len(buff) - off, chunkSize))
+                buff[off:off + len(data)] = data
+                off += len(data)
+            return buff
+        timeout = 1000 if timeout is None else timeout
+        view = memoryview(buff)
+        chunks = [(off, min(chunkSize, len(buff) - off))
+                  for off in range(0, len(buff), chunkSize)]
+        state = {'setup': 0, 'read': 0, 'done': 0, 'error': None}
+
+        # Setup transfer of each read transfer
+        pairs = {}
+
+        def nextSetup(transfer):
+            if state['error'] is not None or state['setup'] >= len(chunks):
+                return False
+            size = chunks[state['setup']][1]
+            transfer.setControl(0x40, 0x04, 0x0082, 0x0000, pack(
+                "<BBBBHBB", 0x00, 0x00, 0x82, 0x00, size, 0x00, 0x00),
+                callback=setupHelper, timeout=timeout)
+            state['setup'] += 1
+            return True
+
+        def setupDone(transfer):
+            # Resubmitted by readDone
+            return False
+
+        def nextRead(transfer):
+            if state['error'] is not None or state['read'] >= len(chunks):
+                return False
+            off, size = chunks[state['read']]
+            transfer.setBulk(0x81, view[off:off + size],
+                             callback=readHelper, timeout=timeout)
+            state['read'] += 1
+            return True
+
+        def readDone(transfer):
+            if transfer.getActualLength() != len(transfer.getBuffer()):
+                state['error'] = 'short read %d' % transfer.getActualLength()
+                return False
+            state['done'] += 1
+            setup = pairs[transfer]
+            if setup.isSubmitted():
+                state['error'] = 'setup still pending'
+                return False
+            if not nextSetup(setup):
+                return False
+            setup.submit()
+            return nextRead(transfer)
+
+        def failed(transfer):
+            if state['error'] is None:
+                state['error'] = 'transfer status %d' % transfer.getStatus()
+            return False
+
+        setupHelper = usb1.USBTransferHelper()
+        setupHelper.setEventCallback(usb1.TRANSFER_COMPLETED, setupDone)
+        setupHelper.setDefaultCallback(failed)
+        readHelper = usb1.USBTransferHelper()
+        readHelper.setEventCallback(usb1.TRANSFER_COMPLETED, readDone)
+        readHelper.setDefaultCallback(failed)
+
+        transfers = []
+        for _ in range(min(depth, len(chunks))):
+            setup = self.dev.getTransfer()
+            if nextSetup(setup):
+                setup.submit()
+                transfers.append(setup)
+            read = self.dev.getTransfer()
+            pairs[read] = setup
+            if nextRead(read):
+                read.submit()
+                transfers.append(read)
+
+        self.__wait_transfers(transfers, state, len(chunks), timeout)
+        if state['error'] is not None:
+            raise Exception("Async bulk read failed: " + state['error'])
+        return buff
+
+    def __wait_transfers(self, transfers, state, count, timeout):
+        # Run libusb events until count transfers are done or one failed
+        while state['done'] < count and state['error'] is None:
+            self.context.handleEventsTimeout(timeout / 1000.0)
+            if not any(t.isSubmitted() for t in transfers):
+                break
+        for t in transfers:
+            if t.isSubmitted():
+                t.cancel()
+        while any(t.isSubmitted() for t in transfers):
+            self.context.handleEventsTimeout(timeout / 1000.0)
+        if state['error'] is None and state['done'] < count:
+            state['error'] = 'got %d of %d transfers' % (state['done'], count)
+
+    @contextmanager
+    def __control_batch(self):
+        # Queue the init sequence control transfers and submit them all at
+        # the end, pipelined on the control endpoint
+        if not self.asyncControl or self.context is None or \
+                not hasattr(self.dev, 'getTransfer') or self.controlQueue is not None:
+            yield
+            return
+        self.controlQueue = []
+        try:
+            yield
+            queue = self.controlQueue
+        finally:
+            self.controlQueue = None
+        self.__submit_control_batch(queue)
+
+    def __submit_control_batch(self, queue, depth=32, timeout=1000):
+        start = time.perf_counter()
+        results = [None] * len(queue)
+        state = {'next': 0, 'done': 0, 'error': None}
+
+        def submitNext(transfer):
+            i = state['next']
+            if state['error'] is not None or i >= len(queue):
+                return False
+            requestType, request, value, index, data, expected = queue[i]
+            transfer.setControl(requestType, request, value, index, data,
+                                callback=helper, user_data=i, timeout=timeout)
+            state['next'] += 1
+            return True
+
+        def done(transfer):
+            i = transfer.getUserData()
+            if queue[i][5] is not None:
+                results[i] = bytes(transfer.getBuffer()[:transfer.getActualLength()])
+            state['done'] += 1
+            return submitNext(transfer)
+
+        def failed(transfer):
+            if state['error'] is None:
+                state['error'] = 'transfer status %d' % transfer.getStatus()
+            return False
+
+        helper = usb1.USBTransferHelper()
+        helper.setEventCallback(usb1.TRANSFER_COMPLETED, done)
+        helper.setDefaultCallback(failed)
+
+        transfers = []
+        for _ in range(min(depth, len(queue))):
+            transfer = self.dev.getTransfer()
+            if submitNext(transfer):
+                transfer.submit()
+                transfers.append(transfer)
+        self.__wait_transfers(transfers, state, len(queue), timeout)
+        if state['error'] is not None:
+            raise Exception("Control batch failed: " + state['error'])
+
+        for i, entry in enumerate(queue):
+            if entry[5] is not None:
+                self.validate_read(entry[5], results[i])
+        logger.info('Control batch: %d transfers in %.3fs',
+                     len(queue), time.perf_counter() - start)
+
+    def __capture(self, triggerTimeout, size, pre, beforeArm=None, progress=None, refresh=None):
+        start = time.monotonic()
+        # Write register twice ?
+        self.__controlWrite83(b"\x5A")
+        self.__data_bulk_write(b"\xF8\x03")
+        self.__data_bulk_write(b"\xF8\x03")
+        self.__set_reg(Reg.MAYBE_SOME_RESET, 0x0001)
+        self.__set_reg(Reg.MAYBE_SOME_RESET, 0x0000)
+        if beforeArm is not None:
+            beforeArm()
+        # The A/D starts with this write, take the time around it
+        t = time.monotonic()
+        self.__set_reg(Reg.MAYBE_AD_CONTROL, 0x0001)
+        self.captureTimes = {'start': start, 'arm': (t + time.monotonic()) / 2, 'trigger': None}
+
+        # Status goes 0x08 -> 0x09 -> 0x0b
+        """
+                0x1101 0x0001 0x91ad 0x0000 0x0008 0x0000
+                0x1101 0x0001 0x91ae 0x0404 0x0009 0x07fe
+                0x1101 0x0001 0x91ae 0x0404 0x000b 0x07fe
+                DATA b'ae91ae90ae90ad8fad8fae8eae8eae8dae8eae8dad8dae8dae8dad8dae8cae'
+                """
+        triggered, regs = self.__waitTrigger(triggerTimeout, size, progress, refresh)
+
+        self.__set_reg(Reg.MAYBE_AD_CONTROL, 0x0000)
+        self.captureTimes['stop'] = time.monotonic()
+        if triggered:
+            pos, index = captureWindow(self.__get_reg(Reg.MAYBE_TRIGGER_COUNT_04), 0, True, size, pre)
+        else:
+            pos, index = captureWindow(0, self.__get_reg(Reg.MAYBE_BUFFER_COUNT_06), False, size, pre)
+        self.__set_reg(Reg.UNKNOWN_55, pos)
+
+        self.__controlWrite83(b"\x03")
+        self.captureTimes['read'] = time.monotonic()
+        return (triggered, index, regs)
+
+    def __waitTrigger(self, triggerTimeout, size=0, progress=None, refresh=None):
+        # Only the status register tells if we triggered, so poll just that
+        # and back off. All status registers are read every poll only for
+        # debugging, otherwise once at the end for the caller.
+        timeout = None if triggerTimeout is None else time.time() + triggerTimeout
+        interval, maxInterval = self.__pollIntervals()
+        if progress is not None:
+            # Partial captures start at the arm position
+            self.partialEnd = self.__get_reg(Reg.MAYBE_BUFFER_COUNT_06) % bufferSize
+            self.partialCount = 0
+            nextRefresh = time.time() + refresh
+            maxInterval = min(maxInterval, refresh)
+        polls = 0
+        regs = None
+        while True:
+            status = self.__get_reg(Reg.MAYBE_SOME_STATUS)
+            polls += 1
+            if self.debug:
+                    regs = self.__getStatusRegisters()
+                    self.showRegisters(regs)
+            triggered = (status == 0x0b)
+            if triggered:
+                self.captureTimes['trigger'] = time.monotonic()
+            now = time.time()
+            if triggered or (timeout is not None and now >= timeout):
+                break
+            if progress is not None and now >= nextRefresh:
+                if progress(self.__read_partial(size)) is False:
+                    break
+                now = time.time()
+                nextRefresh = now + refresh
+            # progress may have taken us past the timeout, poll once more
+            time.sleep(interval if timeout is None else max(0.0, min(interval, timeout - now)))
+            interval = min(interval * 2, maxInterval)
+        if regs is None:
+            regs = self.__getStatusRegisters()
+
+        stats = self.pollStats
+        stats['captures'] += 1
+        stats['polls'] += polls
+        stats['lastPolls'] = polls
+        stats['maxPolls'] = max(stats['maxPolls'], polls)
+        return (triggered, regs)
+
+    def __read_partial(self, size):
+        # Latest samples of a running capture, at most size
+        end = self.__get_reg(Reg.MAYBE_BUFFER_COUNT_06) % bufferSize
+        self.partialCount += (end - self.partialEnd) % bufferSize
+        self.partialEnd = end
+        n = min(self.partialCount, size)
+        if n == 0:
+            return bytearray()
+        self.__set_reg(Reg.UNKNOWN_55, (end - n) % bufferSize)
+        self.__controlWrite83(b"\x03")
+        return self.__read_samples(n)
+
+    def __pad_stale(self, buff, index):
+        # Past postTrigger samples from the trigger the buffer still holds
+        # an older capture
+        if index is not None:
+            end = (index + postTrigger) << 1
+            if end < len(buff):
+                buff[end:] = b"\x80" * (len(buff) - end)
+
+    def __read_samples(self, size):
+        # Stream size samples from the read position
+        b = size << 1
+        buff = bytearray()
+        while b > 0:
+            # self.controlWrite(0x40, 0x04, 0x0082, 0x0000, b"\x00\x00\x82\x00\x00\x02\x00\x00")
+            # self.controlWrite(0x40, 0x04, 0x0082, 0x0000, pack("<BBBBHBB", 0x00,0x00,0x82,0x00, min(b, 0x0200), 0x00,0x00))
+            data = self.__data_bulk_read(min(b, 0x0200))
+            # logger.debug('DATA', b, len(buff), len(data), binascii.hexlify(data[0:31]))
+            buff += data
+            b -= len(data)
+        return buff
+
+    def __pollIntervals(self):
+        # First poll interval is the time to collect a few samples, the
+        # back-off is limited to the time of a screenful of samples
+        try:
+            divider = sampleTimeDivider[SampleRate(self.shadow.get(Reg.SAMPLE_RATE.value))]
+        except (ValueError, KeyError):
+            return (0.001, 0.01)
+        return (min(16.0 / divider, 0.01), min(max(512.0 / divider, 0.001), 0.05))
+
     def __set_reg(self, addr, data):
         if not isinstance(addr, int):
             addr = addr.value
@@ -512,6 +993,29 @@ class PerytechDsoApi:
         logger.debug("Set register 0x%x : 0x%04x" % (addr, data))
         self.__controlWrite83(pack('B', addr))
         self.__data_bulk_write(pack('H', data))
+        self.shadow[addr] = data
+
+    def __update_reg(self, addr, data, force=False):
+        # Write a configuration register, unless it already has the value
+        if not isinstance(addr, int):
+            addr = addr.value
+        if self.batchDepth and not force:
+            self.pending.pop(addr, None)
+            self.pending[addr] = data
+        elif force or addr not in configRegs or self.shadow.get(addr) != data:
+            self.__set_reg(addr, data)
+        else:
+            logger.debug("Skip register 0x%x : 0x%04x" % (addr, data))
+
+    def __flush(self):
+        pending = self.pending
+        self.pending = {}
+        for addr, data in pending.items():
+            self.__update_reg(addr, data)
+        if self.pendingCoupleDiv:
+            val = self.pendingCoupleDiv
+            self.pendingCoupleDiv = 0
+            self.__set_couple_div(val)
 
     def __get_reg(self, addr, expected=None, comment=''):
         if not isinstance(addr, int):
@@ -537,15 +1041,15 @@ class PerytechDsoApi:
                 values.append(data)
             return values
 
-    def __setCh1Couple(self, CouplingValue):
+    def __setCh1Couple(self, CouplingValue, force=False):
         b = 0x8000 if CouplingValue == Coupling.AC else 0x4000
-        self.__set_couple_div(b)
+        self.__set_couple_div(b, force)
 
-    def __setCh2Couple(self, CouplingValue):
+    def __setCh2Couple(self, CouplingValue, force=False):
         b = 0x0200 if CouplingValue == Coupling.AC else 0x0100
-        self.__set_couple_div(b)
+        self.__set_couple_div(b, force)
 
-    def __setVoltageDIV(self, channel, voltageDIV):
+    def __setVoltageDIV(self, channel, voltageDIV, force=False):
         if (voltageDIV.value < VoltageDIV.mV100.value):
             b1 = voltageDIV.value
             b2 = 0x01
@@ -565,17 +1069,31 @@ class PerytechDsoApi:
         else:
             raise "Invalid channel: " + str(channel)
             # TODO other channels ?
-        self.__set_reg(Reg.VOLTAGE_DIV1, self.b1s)
-        self.__set_couple_div(self.b2s)
+        self.__update_reg(Reg.VOLTAGE_DIV1, self.b1s, force)
+        self.__set_couple_div(self.b2s, force)
 
     def __setTrigVoltage(self, channel, trigVoltage):
         if channel == Channel.Ch1:
             self.tv1 = int(trigVoltage) + 0x80
         if channel == Channel.Ch2:
             self.tv2 = int(trigVoltage) + 0x80
-        self.__set_reg(Reg.TRIG_LEVEL, self.tv1 | (self.tv2 << 8))
-
-    def __set_couple_div(self, val):
+        self.__update_reg(Reg.TRIG_LEVEL, self.tv1 | (self.tv2 << 8))
+
+    def __merge_couple_div(self, state, val):
+        for mask in coupleDivFields:
+            if val & mask:
+                state = (state & ~mask) | (val & mask)
+        return state
+
+    def __set_couple_div(self, val, force=False):
+        if self.batchDepth and not force:
+            self.pendingCoupleDiv = self.__merge_couple_div(self.pendingCoupleDiv, val)
+            return
+        latched = self.__merge_couple_div(self.coupleDiv, val)
+        if not force and latched == self.coupleDiv:
+            logger.debug("Skip coupling 0x%04x" % val)
+            return
+        self.coupleDiv = latched
         self.__set_reg(Reg.MAYBE_AD_CONTROL, 0x0000)
         self.__set_reg(Reg.VOLTAGE_COUPLING, val)
         self.__set_reg(Reg.VOLTAGE_COUPLING, val)
@@ -590,7 +1108,8 @@ class PerytechDsoApi:
         # with self.lock:
         logger.info('__linkDSO init')
 
-        self.__link_init_seq()
+        with self.__control_batch():
+            self.__link_init_seq()
 
         val = self.__get_reg(Reg.HELLO, 0x1101)
         val = self.__get_reg(Reg.MAYBE_DEVICE_STATUS, 0x0001)
@@ -647,7 +1166,8 @@ class PerytechDsoApi:
         val = self.__get_reg(Reg.MAYBE_DEVICE_STATUS, 0x0009)
         self.__set_reg(Reg.MAYBE_DEVICE_CONTROL, 0x0009)
 
-        self.__dso_init_seq1()
+        with self.__control_batch():
+            self.__dso_init_seq1()
 
         self.__set_reg(Reg.PERYTECH_MAGIC, 0x0050)  # P
         self.__data_bulk_write(b"\x45\x00")  # E
@@ -669,12 +1189,13 @@ class PerytechDsoApi:
         self.__set_reg(Reg.SAMPLE_RATE, SampleRate.MS200.value)
         # __set_reg(Reg.SAMPLE_RATE, 0x001A)
 
-        self.__dso_init_seq2()
+        with self.__control_batch():
+            self.__dso_init_seq2()
 
-        self.__setCh1Couple(Coupling.AC)
+        self.__setCh1Couple(Coupling.AC, True)
         # __set_couple_div(b"\x00\x80")
 
-        self.__setCh2Couple(Coupling.AC)
+        self.__setCh2Couple(Coupling.AC, True)
         # __set_couple_div(b"\x00\x02")
 
         self.__set_reg(Reg.TRIG_CHANNEL, Channel.Ch1.value)
@@ -684,11 +1205,12 @@ class PerytechDsoApi:
 
         self.__set_reg(Reg.UNKNOWN_5A, 0x03F8)
 
+        self.calibration = {}
         for v in [VoltageDIV.mV10, VoltageDIV.mV20, VoltageDIV.mV50, VoltageDIV.mV100,
                   VoltageDIV.mV200, VoltageDIV.mV500, VoltageDIV.V1, VoltageDIV.V5, VoltageDIV.V10]:
             # FIXME calibration ??
-            self.__setVoltageDIV(Channel.Ch1, v)
-            self.__setVoltageDIV(Channel.Ch2, v)
+            self.__setVoltageDIV(Channel.Ch1, v, True)
+            self.__setVoltageDIV(Channel.Ch2, v, True)
 
             self.__set_reg(Reg.MAYBE_SOME_RESET, 0x0001)
             self.__set_reg(Reg.MAYBE_SOME_RESET, 0x0000)
@@ -705,20 +1227,29 @@ class PerytechDsoApi:
             # __set_reg(Reg.UNKNOWN_55, 0x1547)
             self.__controlWrite83(b"\x03")
             b = 2000
+            buff = bytearray()
             while b > 0:
                 data = self.__data_bulk_read(min(b, 0x0200))
                 if b == 2000:
                     logger.info('DATA %s', binascii.hexlify(data[0:31]))
+                buff += data
                 b -= 0x200
 
-        self.__setCh1Couple(Coupling.DC)
+            # Inputs are grounded here, so the average is the zero offset
+            n = len(buff) >> 1
+            if n:
+                self.calibration[v.name] = [sum(buff[0::2]) / n - 0x80,
+                                            sum(buff[1::2]) / n - 0x80]
+
+        self.__setCh1Couple(Coupling.DC, True)
         # __set_couple_div(b"\x00\x40")
 
-        self.__setCh2Couple(Coupling.DC)
+        self.__setCh2Couple(Coupling.DC, True)
         # ?? TYPO
         # __set_couple_div(b"\x01\x00")
 
-        self.__dso_init_seq2()
+        with self.__control_batch():
+            self.__dso_init_seq2()
 
         self.__set_reg(Reg.UNKNOWN_67, 0x0000)
         self.__data_bulk_write(b"\x00\x00")
@@ -757,9 +1288,9 @@ class PerytechDsoApi:
                         xactual = actual[0:32]
                 else:
                         xactual = actual
-                print('Failed %d %d' % (len(expected), len(actual)))
-                print('  Expected; %s' % binascii.hexlify(xexpected,))
-                print('  Actual:   %s' % binascii.hexlify(xactual,))
+                # Not to stdout, peryscope-cli may be streaming captures there
+                logger.warning('Failed %d %d expected %s actual %s', len(expected), len(actual),
+                               binascii.hexlify(xexpected), binascii.hexlify(xactual))
                 # raise Exception('failed validate: %s' % msg)
 
     def print_values(self, values):
@@ -794,12 +1325,70 @@ class PerytechDsoApi:
 
     #
 
+    def __fingerprint(self):
+        # Only registers the init sequence itself reads back.
+        # MAYBE_DEVICE_STATUS follows MAYBE_DEVICE_CONTROL, which is 0x0009
+        # from the end of __linkDSO until the last step of __dsoInitial, so
+        # an interrupted init is not taken as linked. What a device reads
+        # right after power on is not recorded, so initDevice also wants
+        # a cached calibration before it skips the init.
+        return (self.__get_reg(Reg.HELLO), self.__get_reg(Reg.MAYBE_DEVICE_STATUS))
+
+    def __deviceKey(self, udev):
+        # Stable name of the device in the calibration cache, None when
+        # there is none
+        try:
+            serial = udev.getSerialNumber()
+            if serial:
+                return 'serial-' + serial
+        except Exception:
+            pass
+        try:
+            ports = udev.getPortNumberList()
+            if ports:
+                return 'port-%03d-%s' % (udev.getBusNumber(), '.'.join(str(p) for p in ports))
+        except Exception:
+            pass
+        return None
+
+    def __readCalibrationFile(self, cacheFile):
+        try:
+            with open(cacheFile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def __loadCalibration(self, cacheFile, key):
+        if cacheFile is None or key is None:
+            return None
+        calibration = self.__readCalibrationFile(cacheFile).get(key)
+        if calibration is None:
+            logger.info('No cached calibration for %s', key)
+        return calibration
+
+    def __saveCalibration(self, cacheFile, key):
+        if cacheFile is None or key is None:
+            return
+        with calibrationLock:
+            cache = self.__readCalibrationFile(cacheFile)
+            cache[key] = self.calibration
+            try:
+                os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+                with open(cacheFile, 'w') as f:
+                    json.dump(cache, f, indent=1)
+            except OSError as e:
+                logger.error('Cannot save calibration: %s', e)
+
     def __get_status(self):
         return self.controlRead(0xC0, 0x0C, 0x008A, 0x0000, 1)
 
     def __check_status(self, st):
         for s in st:
             self.__controlWrite8B(b"\x03" b"\x01")
+            if self.controlQueue is not None:
+                # Checked when the batch is done
+                self.controlQueue.append((0xC0, 0x0C, 0x008A, 0x0000, 1, pack('B', s)))
+                continue
             buff = self.__get_status()
             self.validate_read(pack('B', s), buff)
 
@@ -11,12 +11,65 @@ from PerytechDsoApi import (
     Channel,
     TriggerEdge,
     voltages,
+    countsPerDiv,
     sampleTimeDivider,
+    preTrigger,
+    postTrigger,
+    limitPre,
+    captureBudget,
+    calibrationFile,
 )
-from time import sleep
+from DsoDecoder import (
+    DsoDecoder,
+    channelViews,
+)
+from DsoAverage import (
+    AcquireMode,
+    Averager,
+    HiRes,
+    fitFactor,
+)
+from DsoDevices import selectDevices
+from DsoFrames import (
+    Frame,
+    FrameQueue,
+    RingBuffer,
+)
+from DsoMeasure import measureCapture
+from DsoStats import PipelineStats
+from DsoSpectrum import (
+    Spectrum,
+    Window,
+    Averaging,
+    FLOOR_DB,
+    CEILING_DB,
+    formatFrequency,
+)
+from DsoRecorder import (
+    DsoRecorder,
+    Settings,
+)
+from DsoTrigger import parseTrigger
+from DsoServer import (
+    DsoServer,
+    CONFIG_FIELDS,
+)
+from DsoRender import (
+    Persistence,
+    gridSpacing,
+    tracePoints,
+    sampleToX,
+)
+from DsoTransport import (
+    SimulatedDevice,
+    RecordingDevice,
+    ReplayDevice,
+)
+from time import sleep, time, perf_counter
 import signal
 import socket
 from enum import Enum
+import numpy as np
 
 from PyQt5 import QtNetwork
 from PyQt5 import (
@@ -37,6 +90,7 @@ from PyQt5.QtCore import (
 from PyQt5.QtGui import (
     QKeySequence,
     QPolygon,
+    QPolygonF,
     QPen,
     QBrush,
 )
@@ -60,19 +114,37 @@ from PyQt5.QtWidgets import (
 )
 
 
+def makePolygon(x, y):
+    # Fill a QPolygonF directly from NumPy arrays
+    n = len(x)
+    polygon = QPolygonF(n)
+    ptr = polygon.data()
+    ptr.setsize(n * 2 * 8)
+    points = np.frombuffer(ptr, dtype=np.float64).reshape(n, 2)
+    points[:, 0] = x
+    points[:, 1] = y
+    return polygon
+
+
 class RunMode(Enum):
     Stopped = 0,
     Continuous = 1,
     Waiting = 2,
+    Roll = 3,
 
 
 class DsoData:
     initialized = False
-    data = ''
-    off = 0
-    triggered = False
+    # Run the full init on the next initDevice, even if already linked
+    forceInit = False
     i = -1
     error = None
+    # Index of the trigger sample in the captures being shown
+    pre = None
+
+    def __init__(self):
+        # Captures from the worker
+        self.frames = FrameQueue()
 
 
 class DsoConfig:
@@ -87,9 +159,45 @@ class DsoConfig:
     ch2TrigVoltage = 10
     trigOffset = 0
     width = 500
+    # Samples per capture, None for the drawing area width
+    captureSize = None
     changed = True
     runMode = RunMode.Continuous
     debug = False
+    measure = True
+    asyncRead = False
+    simulate = False
+    record = None
+    replay = None
+    coldStart = False
+    # File name prefix for recording the captures
+    captureLog = None
+    # Address to serve the captures on
+    serve = None
+    # Device to use as "BUS:ADDRESS", None for the first one
+    device = None
+    # DsoTrigger to align the captures with, None for the hardware trigger
+    softTrigger = None
+    # Spectrum view instead of the traces
+    spectrum = False
+    spectrumWindow = Window.Hann
+    spectrumAveraging = Averaging.Off
+    # Captures averaged
+    spectrumCount = 8
+    peakHold = False
+    acquireMode = AcquireMode.Normal
+    # Captures averaged in Average mode
+    averageCount = 16
+    # Samples averaged into one in HiRes mode
+    hiResFactor = 4
+    # Intensity graded traces of all captures
+    persistence = False
+    # Weight of the previous captures, per capture
+    persistenceDecay = 0.9
+    # Show the pipeline timing over the traces
+    statsOverlay = False
+    # File to write the pipeline timing to every second, as JSON
+    statsFile = None
     exit = False
 
 class MainWindow(QtWidgets.QMainWindow):
@@ -97,6 +205,9 @@ class MainWindow(QtWidgets.QMainWindow):
         super().__init__()
         self.data = DsoData()
         self.config = DsoConfig()
+        # Grid layer of drawData, and what it was drawn for
+        self.graticule = None
+        self.graticuleKey = None
         self.initGUI()
         self.startWorker()
         self.configChanged()
@@ -128,6 +239,14 @@ class MainWindow(QtWidgets.QMainWindow):
         device.triggered[QAction].connect(self.resetDevice)
         reset.setShortcut(QKeySequence("Ctrl+R"))
 
+        view = bar.addMenu("View")
+        self.overlay = QAction("Statistics", self)
+        self.overlay.setCheckable(True)
+        self.overlay.setChecked(self.config.statsOverlay)
+        self.overlay.setShortcut(QKeySequence("I"))
+        self.overlay.toggled.connect(self.statsOverlay)
+        view.addAction(self.overlay)
+
         layoutTop = QHBoxLayout()
 
         # self.b1 = QCheckBox("Enable")
@@ -153,19 +272,45 @@ class MainWindow(QtWidgets.QMainWindow):
         self.sr.currentIndexChanged.connect(self.sampleRate)
         layoutTop.addWidget(self.sr)
 
+        layoutTop.addWidget(QtWidgets.QLabel('Acquire'))
+        self.am = QComboBox()
+        for idx, e in enumerate(AcquireMode):
+            self.am.addItem(e.name, e)
+            if e == self.config.acquireMode:
+                self.am.setCurrentIndex(idx)
+        self.am.currentIndexChanged.connect(self.acquireMode)
+        layoutTop.addWidget(self.am)
+
+        # Captures to average, or samples per sample in HiRes mode
+        self.ac = QSpinBox()
+        self.ac.setMinimum(2)
+        self.ac.setMaximum(256)
+        self.ac.setValue(self.config.hiResFactor if self.config.acquireMode == AcquireMode.HiRes
+                         else self.config.averageCount)
+        self.ac.setEnabled(self.config.acquireMode != AcquireMode.Normal)
+        self.ac.valueChanged.connect(self.acquireCount)
+        layoutTop.addWidget(self.ac)
+
         layoutTop.addWidget(QtWidgets.QLabel("Status:"))
         self.status = QtWidgets.QLabel('')
         self.status.setMinimumWidth(100)
         layoutTop.addWidget(self.status)
         layoutTop.addStretch()
 
+        # Samples the trigger is left of the middle, as far as the device
+        # keeps samples around it
         self.off = QSpinBox()
-        self.off.setMinimum(-200)
-        self.off.setMaximum(200)
+        self.off.setMinimum(-preTrigger)
+        self.off.setMaximum(postTrigger)
         self.off.setValue(int(self.config.trigOffset))
         self.off.valueChanged.connect(self.trigOffset)
         layoutTop.addWidget(self.off)
 
+        self.ps = QCheckBox("Persistence")
+        self.ps.setChecked(self.config.persistence)
+        self.ps.stateChanged.connect(self.persistence)
+        layoutTop.addWidget(self.ps)
+
         self.db = QCheckBox("Debug")
         self.db.setChecked(self.config.debug)
         self.db.stateChanged.connect(self.debug)
@@ -292,6 +437,45 @@ class MainWindow(QtWidgets.QMainWindow):
         self.tc.currentIndexChanged.connect(self.triggerChannel)
         layoutRight.addWidget(self.tc)
 
+        layoutRight.addWidget(QtWidgets.QLabel('Spectrum'))
+
+        self.sp = QCheckBox("Spectrum")
+        self.sp.setChecked(self.config.spectrum)
+        self.sp.stateChanged.connect(self.spectrum)
+        layoutRight.addWidget(self.sp)
+
+        self.sw = QComboBox()
+        for idx, e in enumerate(Window):
+            self.sw.addItem(e.name, e)
+            if e == self.config.spectrumWindow:
+                self.sw.setCurrentIndex(idx)
+        self.sw.currentIndexChanged.connect(self.spectrumWindow)
+        layoutRight.addWidget(self.sw)
+
+        self.sa = QComboBox()
+        for idx, e in enumerate(Averaging):
+            self.sa.addItem(e.name, e)
+            if e == self.config.spectrumAveraging:
+                self.sa.setCurrentIndex(idx)
+        self.sa.currentIndexChanged.connect(self.spectrumAveraging)
+        layoutRight.addWidget(self.sa)
+
+        self.sn = QSpinBox()
+        self.sn.setMinimum(1)
+        self.sn.setMaximum(1000)
+        self.sn.setValue(self.config.spectrumCount)
+        self.sn.valueChanged.connect(self.spectrumCount)
+        layoutRight.addWidget(self.sn)
+
+        self.ph = QCheckBox("Peak hold")
+        self.ph.setChecked(self.config.peakHold)
+        self.ph.stateChanged.connect(self.peakHold)
+        layoutRight.addWidget(self.ph)
+
+        self.readout = QtWidgets.QLabel('')
+        self.readout.setMinimumWidth(150)
+        layoutRight.addWidget(self.readout)
+
         layoutRight.addStretch()
         layout1.addLayout(layoutRight)
         layout.addLayout(layout1)
@@ -311,6 +495,8 @@ class MainWindow(QtWidgets.QMainWindow):
         QShortcut(QKeySequence('T'), self).activated.connect(self.rollTrigger1)
         QShortcut(QKeySequence('Shift+T'),
                   self).activated.connect(self.rollTrigger2)
+        QShortcut(QKeySequence('P'), self).activated.connect(self.ps.toggle)
+        QShortcut(QKeySequence('F'), self).activated.connect(self.sp.toggle)
         QShortcut(QKeySequence('1'), self).activated.connect(self.v1.setFocus)
         QShortcut(QKeySequence('2'), self).activated.connect(self.v2.setFocus)
 
@@ -343,6 +529,22 @@ class MainWindow(QtWidgets.QMainWindow):
         self.config.sampleRate = self.sr.itemData(i)
         self.configChanged()
 
+    def acquireMode(self, i):
+        self.config.acquireMode = self.am.itemData(i)
+        self.ac.blockSignals(True)
+        self.ac.setValue(self.config.hiResFactor if self.config.acquireMode == AcquireMode.HiRes
+                         else self.config.averageCount)
+        self.ac.blockSignals(False)
+        self.ac.setEnabled(self.config.acquireMode != AcquireMode.Normal)
+        self.configChanged()
+
+    def acquireCount(self, value):
+        if self.config.acquireMode == AcquireMode.HiRes:
+            self.config.hiResFactor = value
+        else:
+            self.config.averageCount = value
+        self.configChanged()
+
     def ch1VoltageDIV(self, i):
         self.config.ch1VoltageDIV = self.v1.itemData(i)
         self.configChanged()
@@ -379,6 +581,31 @@ class MainWindow(QtWidgets.QMainWindow):
         self.config.trigOffset = value
         self.configChanged()
 
+    # The spectrum settings do not touch the device, the worker picks
+    # them up with the next capture
+    def spectrum(self):
+        self.config.spectrum = self.sp.isChecked()
+        self.drawData(self.data.frames.peek())
+
+    def spectrumWindow(self, i):
+        self.config.spectrumWindow = self.sw.itemData(i)
+
+    def spectrumAveraging(self, i):
+        self.config.spectrumAveraging = self.sa.itemData(i)
+
+    def spectrumCount(self, value):
+        self.config.spectrumCount = value
+
+    def peakHold(self):
+        self.config.peakHold = self.ph.isChecked()
+
+    def persistence(self):
+        self.config.persistence = self.ps.isChecked()
+
+    def statsOverlay(self, checked):
+        self.config.statsOverlay = checked
+        self.drawData(self.data.frames.peek())
+
     # def running(self):
     #    self.config.running = self.b1.isChecked()
     #    self.configChanged()
@@ -391,7 +618,28 @@ class MainWindow(QtWidgets.QMainWindow):
             logger.setLevel(logging.INFO)
         self.configChanged()
 
+    def showConfig(self):
+        # Update the widgets to a configuration changed elsewhere, without
+        # calling their handlers
+        for combo, value in ((self.rm, self.config.runMode), (self.sr, self.config.sampleRate),
+                             (self.v1, self.config.ch1VoltageDIV), (self.v2, self.config.ch2VoltageDIV),
+                             (self.coupling1, self.config.ch1Couple),
+                             (self.coupling2, self.config.ch2Couple),
+                             (self.te, self.config.trigEdge), (self.tc, self.config.trigChannel)):
+            for idx in range(combo.count()):
+                if combo.itemData(idx) == value:
+                    combo.blockSignals(True)
+                    combo.setCurrentIndex(idx)
+                    combo.blockSignals(False)
+        for spin, value in ((self.tv1, self.config.ch1TrigVoltage),
+                            (self.tv2, self.config.ch2TrigVoltage),
+                            (self.off, self.config.trigOffset)):
+            spin.blockSignals(True)
+            spin.setValue(int(value))
+            spin.blockSignals(False)
+
     def resetDevice(self):
+        self.data.forceInit = True
         self.data.initialized = False
         self.configChanged()
 
@@ -402,63 +650,141 @@ class MainWindow(QtWidgets.QMainWindow):
         logger.debug("Resized, width=", self.drawArea.size().width())
         QtWidgets.QMainWindow.resizeEvent(self, event)
         self.config.width = self.drawArea.size().width()
-        self.drawData([])
+        self.drawData(self.data.frames.peek())
 
     # def closeEvent(self, e):
     #    self.config.exit = True
     #    self.configChanged()
 
-    def drawData(self, data):
-        # self.drawArea.pixmap().fill()
-
-        canvas = QtGui.QPixmap(self.config.width, 512)
+    def drawData(self, frame):
+        if self.config.spectrum:
+            self.drawSpectrum(frame)
+            return
+        canvas = self.canvas()
         canvas.fill(Qt.white)
 
-        painter = QtGui.QPainter(canvas)  # self.drawArea.pixmap()
+        painter = QtGui.QPainter(canvas)
 
+        ch1, ch2 = channelViews(b'') if frame is None or frame.capture is None else frame.capture.raw
+        # The trigger marker is where triggered captures have the trigger
+        off = -1 if self.data.pre is None else sampleToX(self.data.pre, len(ch1), self.config.width - 10)
+        painter.drawPixmap(0, 0, self.drawGraticule(off))
+
+        persistence = None if frame is None else frame.persistence
+        if persistence is not None:
+            height, width = persistence.shape
+            image = QtGui.QImage(persistence.data, width, height, width * 4,
+                                 QtGui.QImage.Format_ARGB32)
+            painter.drawImage(0, 0, image)
+
+        painter.setPen(QtGui.QPen(Qt.black, 1, Qt.SolidLine))
+        for samples, base in ((ch1, 256), (ch2, 512)):
+            if len(samples) < 2 or persistence is not None:
+                continue
+            x, y = tracePoints(samples, self.config.width - 10)
+            painter.drawPolyline(makePolygon(x, base - y))
+        self.drawOverlay(painter)
+        painter.end()
+        self.drawArea.update()
+
+    def canvas(self):
+        # The pixmap of drawArea, painted in place like the markers; a new
+        # one only when the width changes
+        canvas = self.drawArea.pixmap()
+        if canvas is None or canvas.width() != self.config.width:
+            self.drawArea.setPixmap(QtGui.QPixmap(self.config.width, 512))
+            canvas = self.drawArea.pixmap()
+        return canvas
+
+    def drawGraticule(self, triggerX):
+        # Grid lines and the trigger marker on a transparent layer, redrawn
+        # only when they move
+        key = (self.config.width, self.config.ch1VoltageDIV, self.config.ch2VoltageDIV, triggerX)
+        if key == self.graticuleKey:
+            return self.graticule
+        width = self.config.width
+        layer = QtGui.QPixmap(width, 512)
+        layer.fill(Qt.transparent)
+        painter = QtGui.QPainter(layer)
         painter.setPen(QtGui.QPen(Qt.lightGray, 2, Qt.SolidLine))
-        painter.drawLine(0, 128, self.config.width, 128)
-        painter.drawLine(0, 128 + 256, self.config.width, 128 + 256)
+        painter.drawLine(0, 128, width, 128)
+        painter.drawLine(0, 128 + 256, width, 128 + 256)
         painter.setPen(QtGui.QPen(Qt.lightGray, 1, Qt.SolidLine))
-        i = 0
-        while i < 128:
-            painter.drawLine(0, int(128+i), self.config.width, int(128+i))
-            painter.drawLine(0, int(128-i), self.config.width, int(128-i))
-            i += 14 / voltages[self.config.ch1VoltageDIV]
-        i = 0
-        while i < 128:
-            painter.drawLine(0, int(128 + 256+i),
-                             self.config.width, int(128 + 256+i))
-            painter.drawLine(0, int(128 + 256-i),
-                             self.config.width, int(128 + 256-i))
-            i += 14 / voltages[self.config.ch2VoltageDIV]
-
-        painter.drawLine(self.data.off, 0, self.data.off, 512)
-
-        x = 0
-        x = 1
-        lines1 = []
-        lines2 = []
-        for i in range(2, len(data), 2):
-            # for i in range(0, len(data), 2):
-            # lines1.append(QPoint(x, 256-data[i]))
-            # lines2.append(QPoint(x, 512-data[i+1]))
-            lines1.append(QLineF(x-1, 256-data[i-2], x, 256-data[i]))
-            lines2.append(QLineF(x-1, 512-data[i-1], x, 512-data[i+1]))
-            x += 1
-            if x >= self.config.width - 10:
-                break
-        if len(lines1):
-            painter.setPen(QtGui.QPen(Qt.black, 1, Qt.SolidLine))
-            # painter.drawLines(*lines1)
-            painter.drawLines(lines1)
-        if len(lines2):
-            painter.setPen(QtGui.QPen(Qt.black, 1, Qt.SolidLine))
-            # painter.drawLines(*lines2)
-            painter.drawLines(lines2)
+        for center, voltageDIV in ((128, self.config.ch1VoltageDIV), (128 + 256, self.config.ch2VoltageDIV)):
+            # A line every volt, or every 2, 5, 10, ... volts when those
+            # would be too dense
+            step = gridSpacing(countsPerDiv / voltages[voltageDIV])
+            i = step
+            while i < 128:
+                painter.drawLine(0, int(center + i), width, int(center + i))
+                painter.drawLine(0, int(center - i), width, int(center - i))
+                i += step
+        painter.drawLine(triggerX, 0, triggerX, 512)
         painter.end()
-        self.drawArea.setPixmap(canvas)
-        # self.drawArea.update()
+        self.graticule = layer
+        self.graticuleKey = key
+        return layer
+
+    def drawSpectrum(self, frame):
+        # ch1 in the upper and ch2 in the lower half, FLOOR_DB to
+        # CEILING_DB, 0 Hz to half the sample rate
+        width = self.config.width
+        canvas = self.canvas()
+        canvas.fill(Qt.white)
+        painter = QtGui.QPainter(canvas)
+
+        dbScale = 256 / (CEILING_DB - FLOOR_DB)
+        painter.setPen(QtGui.QPen(Qt.lightGray, 1, Qt.SolidLine))
+        db = FLOOR_DB
+        while db <= CEILING_DB:
+            for base in (256, 512):
+                y = int(base - (db - FLOOR_DB) * dbScale)
+                painter.drawLine(0, y, width, y)
+                if db > FLOOR_DB:
+                    painter.drawText(2, y + 12, "%+.0f dBV" % db)
+            db += 20
+        spectra = None if frame is None else frame.spectrum
+        if spectra is not None and len(spectra.frequencies) > 1:
+            nyquist = spectra.frequencies[-1]
+            for i in range(1, 10):
+                x = int(i * (width - 10) / 10)
+                painter.drawLine(x, 0, x, 512)
+                painter.drawText(x + 2, 508, formatFrequency(nyquist * i / 10))
+            for levels, color in ((spectra.peaks, Qt.gray), (spectra.levels, Qt.black)):
+                if levels is None:
+                    continue
+                painter.setPen(QtGui.QPen(color, 1, Qt.SolidLine))
+                for channel, base in ((0, 256), (1, 512)):
+                    x, y = tracePoints(levels[channel], width - 10)
+                    x = x * ((width - 10) / max(x[-1], 1))
+                    y = np.clip(base - (y - FLOOR_DB) * dbScale, base - 256, base)
+                    painter.drawPolyline(makePolygon(x, y))
+        self.drawOverlay(painter)
+        painter.end()
+        self.drawArea.update()
+
+    def drawOverlay(self, painter):
+        # Pipeline timing in the top right corner
+        if not self.config.statsOverlay:
+            return
+        lines = self.worker.stats.lines()
+        painter.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        metrics = painter.fontMetrics()
+        width = max(metrics.horizontalAdvance(line) for line in lines) + 8
+        height = metrics.height() * len(lines) + 8
+        x = max(self.config.width - width - 10, 0)
+        painter.fillRect(x, 0, width, height, QtGui.QColor(255, 255, 255, 200))
+        painter.setPen(QtGui.QPen(Qt.black, 1, Qt.SolidLine))
+        for n, line in enumerate(lines):
+            painter.drawText(x + 4, 4 + metrics.ascent() + n * metrics.height(), line)
+
+    def writeStats(self):
+        try:
+            self.worker.stats.writeFile(self.config.statsFile)
+        except OSError as e:
+            # Do not raise out of the timer every second
+            logger.error("Writing stats stopped: %s", e)
+            self.statsTimer.stop()
 
     def drawMarkers(self):
         self.markers.pixmap().fill()
@@ -491,8 +817,16 @@ class MainWindow(QtWidgets.QMainWindow):
         self.markers.update()
 
     def reportProgress(self, i):
-        data = self.data.data
-        self.drawData(data)
+        frame = self.data.frames.take()
+        if frame is not None and not (frame.partial and self.config.spectrum):
+            start = perf_counter()
+            if frame.time is not None:
+                self.worker.stats.add('latency', start - frame.time)
+            self.drawData(frame)
+            if not frame.partial:
+                self.drawReadout(frame.measurements)
+            self.worker.stats.add('draw', perf_counter() - start)
+        frame = self.data.frames.peek()
         # Show status
         if self.data.error is not None:
             status = self.data.error
@@ -501,15 +835,33 @@ class MainWindow(QtWidgets.QMainWindow):
             status = "Initializing"
         elif self.config.runMode == RunMode.Stopped:
             status = "Stopped"
-        elif self.data.triggered:
+        elif self.config.runMode == RunMode.Roll:
+            status = "Roll"
+        elif frame is not None and frame.triggered:
             status = "Triggered"
         elif self.config.runMode == RunMode.Waiting:
             status = "Waiting"
         else:
             status = "Running"
         self.status.setText(status)
-        if self.data.i != i:
-            logger.error("Drawing too slow")
+        stats = self.data.frames.stats()
+        self.status.setToolTip("Frames %(published)d, shown %(shown)d, dropped %(dropped)d" % stats)
+
+    def drawReadout(self, measurements):
+        if not measurements:
+            self.readout.setText('')
+            return
+        lines = []
+        for channel, m in measurements.items():
+            if not m:
+                continue
+            lines.append(channel.name)
+            lines.append("Vpp %+.3f V" % m['pp'])
+            lines.append("Vrms %.3f V" % m['rms'])
+            lines.append("Avg %+.3f V" % m['average'])
+            lines.append("Freq %.4g Hz" % m['frequency'])
+            lines.append("Duty %.1f %%" % (m['duty'] * 100))
+        self.readout.setText("\n".join(lines))
 
     def configChanged(self):
         self.drawMarkers()
@@ -522,25 +874,48 @@ class MainWindow(QtWidgets.QMainWindow):
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.run)
         self.worker.progress.connect(self.reportProgress)
+        self.worker.remoteChanged.connect(self.showConfig)
+        if self.config.serve is not None:
+            fields = dict(CONFIG_FIELDS, runMode=RunMode)
+            self.worker.server = DsoServer(self.config.serve, self.config, fields,
+                                           onChange=self.worker.remoteChange,
+                                           getStats=self.worker.stats.snapshot)
+        if self.config.statsFile is not None:
+            self.statsTimer = QtCore.QTimer(self)
+            self.statsTimer.timeout.connect(self.writeStats)
+            self.statsTimer.start(1000)
         self.thread.start()
 
     def cleanup(self):
         self.config.exit = True
         self.thread.quit()
         self.thread.wait()
+        if self.worker.server is not None:
+            self.worker.server.close()
         # sys.exit(0)
 
 
 class Worker(QObject):
     progress = pyqtSignal(int)
-    mutex = QMutex()
-    configChanged = QWaitCondition()
+    # The configuration was changed by a server client
+    remoteChanged = pyqtSignal()
 
     def __init__(self, config, data):
         super().__init__()
+        self.mutex = QMutex()
+        self.configChanged = QWaitCondition()
         self.data = data
         self.config = config
         self.dso = PerytechDsoApi()
+        self.decoder = DsoDecoder()
+        self.recorder = None
+        self.server = None
+        self.spectrum = Spectrum()
+        self.persistence = None
+        self.averager = None
+        self.hiRes = None
+        # Timing of the capture, processing and drawing stages
+        self.stats = PipelineStats()
 
     def initDevice(self):
         self.sampleRate = None
@@ -553,46 +928,65 @@ class Worker(QObject):
         self.trigChannel = None
         self.trigEdge = None
 
-        udevs = self.dso.findDevices()
-        self.dso.initDevice(udevs[0], forceInit=True)
+        # Simulated and replayed devices have no calibration to keep
+        cacheFile = None
+        if self.config.simulate:
+            udev = SimulatedDevice()
+        elif self.config.replay is not None:
+            udev = ReplayDevice(self.config.replay)
+        else:
+            cacheFile = calibrationFile
+            udev = selectDevices(self.dso.findDevices(),
+                                 self.config.device and [self.config.device])[0]
+            if self.config.record is not None:
+                udev = RecordingDevice(udev, self.config.record)
+        self.dso.initDevice(udev, forceInit=self.config.coldStart or self.data.forceInit,
+                            cacheFile=cacheFile)
         self.dso.show_registers()
+        self.data.forceInit = False
         self.data.initialized = True
 
     def setConfig(self):
         self.dso.setDebug(self.config.debug)
         if self.config.debug:
             self.dso.show_registers()
-        if self.sampleRate != self.config.sampleRate:
-            self.dso.setSampleRate(self.config.sampleRate)
-            self.sampleRate = self.config.sampleRate
-        if self.ch1VoltageDIV != self.config.ch1VoltageDIV:
-            self.dso.setVoltageDIV(Channel.Ch1, self.config.ch1VoltageDIV)
-            self.ch1VoltageDIV = self.config.ch1VoltageDIV
-        if self.ch2VoltageDIV != self.config.ch2VoltageDIV:
-            self.dso.setVoltageDIV(Channel.Ch2, self.config.ch2VoltageDIV)
-            self.ch2VoltageDIV = self.config.ch2VoltageDIV
-        if self.ch1Couple != self.config.ch1Couple:
-            self.dso.setCh1Couple(self.config.ch1Couple)
-            self.ch1Couple = self.config.ch1Couple
-        if self.ch2Couple != self.config.ch2Couple:
-            self.dso.setCh2Couple(self.config.ch2Couple)
-            self.ch2Couple = self.config.ch2Couple
-        if self.ch1TrigVoltage != self.config.ch1TrigVoltage:
-            self.dso.setTrigVoltage(Channel.Ch1, self.config.ch1TrigVoltage)
-            self.ch1TrigVoltage = self.config.ch1TrigVoltage
-        if self.ch2TrigVoltage != self.config.ch2TrigVoltage:
-            self.dso.setTrigVoltage(Channel.Ch2, self.config.ch2TrigVoltage)
-            self.ch2TrigVoltage = self.config.ch2TrigVoltage
-        if self.trigChannel != self.config.trigChannel:
-            self.dso.setTrigChannel(self.config.trigChannel)
-            self.trigChannel = self.config.trigChannel
-        if self.trigEdge != self.config.trigEdge:
-            self.dso.setTrigEdge(self.config.trigEdge)
-            self.trigEdge = self.config.trigEdge
+        with self.dso.transaction():
+            if self.sampleRate != self.config.sampleRate:
+                self.dso.setSampleRate(self.config.sampleRate)
+                self.sampleRate = self.config.sampleRate
+            if self.ch1VoltageDIV != self.config.ch1VoltageDIV:
+                self.dso.setVoltageDIV(Channel.Ch1, self.config.ch1VoltageDIV)
+                self.ch1VoltageDIV = self.config.ch1VoltageDIV
+            if self.ch2VoltageDIV != self.config.ch2VoltageDIV:
+                self.dso.setVoltageDIV(Channel.Ch2, self.config.ch2VoltageDIV)
+                self.ch2VoltageDIV = self.config.ch2VoltageDIV
+            if self.ch1Couple != self.config.ch1Couple:
+                self.dso.setCh1Couple(self.config.ch1Couple)
+                self.ch1Couple = self.config.ch1Couple
+            if self.ch2Couple != self.config.ch2Couple:
+                self.dso.setCh2Couple(self.config.ch2Couple)
+                self.ch2Couple = self.config.ch2Couple
+            if self.ch1TrigVoltage != self.config.ch1TrigVoltage:
+                self.dso.setTrigVoltage(Channel.Ch1, self.config.ch1TrigVoltage)
+                self.ch1TrigVoltage = self.config.ch1TrigVoltage
+            if self.ch2TrigVoltage != self.config.ch2TrigVoltage:
+                self.dso.setTrigVoltage(Channel.Ch2, self.config.ch2TrigVoltage)
+                self.ch2TrigVoltage = self.config.ch2TrigVoltage
+            if self.trigChannel != self.config.trigChannel:
+                self.dso.setTrigChannel(self.config.trigChannel)
+                self.trigChannel = self.config.trigChannel
+            if self.trigEdge != self.config.trigEdge:
+                self.dso.setTrigEdge(self.config.trigEdge)
+                self.trigEdge = self.config.trigEdge
         logger.info("Config set")
         if self.config.debug:
             self.dso.show_registers()
 
+    def remoteChange(self):
+        # Called from the server thread
+        self.configChanged.wakeAll()
+        self.remoteChanged.emit()
+
     def waitConfigChange(self):
         while not self.config.exit and not self.config.changed:
             self.mutex.lock()
@@ -601,9 +995,133 @@ class Worker(QObject):
             finally:
                 self.mutex.unlock()
 
+    def recordFrame(self, frame):
+        if self.recorder is None:
+            return
+        settings = Settings(self.sampleRate, self.ch1VoltageDIV, self.ch2VoltageDIV,
+                            self.ch1Couple, self.ch2Couple, self.trigChannel, self.trigEdge,
+                            self.ch1TrigVoltage, self.ch2TrigVoltage, self.config.trigOffset)
+        self.recorder.write(frame.data, settings, frame.triggered)
+
+    def partialFrame(self, i, data):
+        # Show the samples of a capture still waiting for the trigger,
+        # returns False to stop waiting
+        if self.config.changed or self.config.exit:
+            return False
+        if len(data):
+            frame = Frame(i, data, partial=True)
+            frame.capture = self.decoder.decode(
+                frame.data, self.ch1VoltageDIV, self.ch2VoltageDIV,
+                self.dso.getCalibration)
+            self.data.frames.publish(frame)
+            self.progress.emit(i)
+        return True
+
+    def alignFrame(self, frame, width, pre):
+        # Cut width samples with the software trigger pre samples in out of
+        # the whole capture window
+        pre = min(max(pre, 0), width - 1)
+        index = self.config.softTrigger.locate(frame.data, width, pre)
+        frame.triggered = index is not None
+        if index is None:
+            frame.data = frame.data[:width << 1]
+            frame.off = None
+            return
+        frame.data = frame.data[(index - pre) << 1:(index - pre + width) << 1]
+        frame.off = pre
+
+    def reduceNoise(self, frame, width, pre, factor):
+        # Replace the capture of the frame by the average of the last
+        # captures, or by its HiRes decimation
+        mode = self.config.acquireMode
+        ch1, ch2 = channelViews(frame.data)
+        if mode == AcquireMode.HiRes:
+            if self.hiRes is None or (self.hiRes.factor, self.hiRes.size) != (factor, width):
+                self.hiRes = HiRes(factor, width)
+            counts = self.hiRes.decimate(ch1, ch2)
+        elif mode == AcquireMode.Average:
+            if self.averager is None or (self.averager.size, self.averager.pre) != (width, pre):
+                self.averager = Averager(width, self.config.averageCount, pre)
+            counts = self.averager.add(ch1, ch2, frame.off, frame.triggered)
+            if counts is None:
+                # Not triggered, nothing to line it up with
+                return
+        else:
+            return
+        frame.capture = self.decoder.decodeCounts(
+            counts, self.ch1VoltageDIV, self.ch2VoltageDIV,
+            self.dso.getCalibration, decimation=factor)
+
+    def analyzeSpectrum(self, frame):
+        if not self.config.spectrum:
+            return
+        self.spectrum.configure(self.config.spectrumWindow, self.config.spectrumAveraging,
+                                self.config.spectrumCount, self.config.peakHold)
+        frame.spectrum = self.spectrum.update(frame.capture, self.sampleRate)
+
+    def accumulate(self, frame):
+        # Add the capture to the persistence histogram, and attach its
+        # image to the frame
+        if not self.config.persistence:
+            self.persistence = None
+            return
+        width = self.config.width - 10
+        if self.persistence is None or self.persistence.width != width:
+            self.persistence = Persistence(width, 512, self.config.persistenceDecay)
+        ch1, ch2 = frame.capture.raw
+        self.persistence.add([(ch1, 256), (ch2, 512)])
+        frame.persistence = self.persistence.image()
+
+    def publishFrame(self, frame, start):
+        # start is the perf_counter() when the processing of the capture
+        # started
+        frame.time = perf_counter()
+        self.stats.add('process', frame.time - start)
+        self.stats.frame(len(frame.data))
+        self.data.frames.publish(frame)
+
+    def serveFrame(self, frame):
+        if self.server is not None:
+            self.server.publish(frame, time())
+
+    def roll(self, i):
+        """Stream samples into a ring buffer until the config changes."""
+        width = self.config.width if self.config.captureSize is None else self.config.captureSize
+        ring = RingBuffer(width)
+        # Free running, no trigger to mark
+        self.data.pre = None
+        idle = min(64.0 / sampleTimeDivider[self.sampleRate], 0.05)
+        pos = self.dso.startStream()
+        try:
+            while not self.config.exit and not self.config.changed:
+                data, pos = self.dso.readStream(pos)
+                if not len(data):
+                    sleep(idle)
+                    continue
+                start = perf_counter()
+                ring.append(data)
+                self.recordFrame(Frame(i, data))
+                frame = Frame(i, ring.snapshot())
+                frame.capture = self.decoder.decode(
+                    frame.data, self.ch1VoltageDIV, self.ch2VoltageDIV,
+                    self.dso.getCalibration)
+                if self.config.measure:
+                    frame.measurements = measureCapture(frame.capture, self.sampleRate)
+                self.analyzeSpectrum(frame)
+                self.publishFrame(frame, start)
+                self.serveFrame(frame)
+                self.data.i = i
+                self.progress.emit(i)
+                i += 1
+        finally:
+            self.dso.stopStream()
+        return i
+
     def run(self):
         """Data aquisition task."""
         i = 0
+        if self.config.captureLog is not None:
+            self.recorder = DsoRecorder(self.config.captureLog)
         while not self.config.exit:
             if not self.data.initialized:
                 try:
@@ -620,41 +1138,139 @@ class Worker(QObject):
             if self.config.changed:
                 self.setConfig()
                 self.config.changed = False
+                # Do not average over captures of different settings
+                self.spectrum.reset()
+                if self.persistence is not None:
+                    self.persistence.reset()
+                self.averager = None
                 self.progress.emit(self.data.i)
             if self.config.runMode == RunMode.Stopped:
                 self.waitConfigChange()
                 continue
-            # FIXME find a correct offset from registers
-            # offset = 902 if self.config.runMode == RunMode.Waiting else 2
-            offset = self.config.trigOffset
-            # TODO set trigger timeout according to sample rate
-            # Or draw partial data
-            size = self.config.width if self.config.runMode != RunMode.Waiting else self.config.width + 0x780
-            timeout = 1 if self.config.runMode != RunMode.Waiting else 10.0
-            data = self.dso.readData(
-                size, triggerTimeout=timeout, triggerOffset=offset)
-            self.data.triggered = data[1]
-            self.data.data = data[0]
-            if self.data.triggered and self.config.runMode == RunMode.Waiting:
-                # 0x3e6<<1 is just some picked random value
-                self.data.data = self.data.data[0x3e6 << 1:]
-                pass
-            self.data.off = data[2]
+            if self.config.runMode == RunMode.Roll:
+                i = self.roll(i)
+                continue
+            width = self.config.width if self.config.captureSize is None else self.config.captureSize
+            # The trigger is shown at the marker, trigOffset samples left
+            # of the middle, see triggerPre
+            pre = width // 2 - self.config.trigOffset
+            # HiRes captures factor samples for every one shown, as many
+            # as the capture keeps around the trigger
+            factor = 1
+            if self.config.acquireMode == AcquireMode.HiRes:
+                factor = fitFactor(self.config.hiResFactor, width, pre)
+            size = width * factor
+            if self.config.softTrigger is None:
+                pre = limitPre(size, pre * factor) // factor
+            else:
+                pre = min(max(pre, 0), width - 1)
+            self.data.pre = pre
+            if self.config.softTrigger is not None:
+                size = max(size, preTrigger + postTrigger)
+            budget = captureBudget(self.sampleRate, size, self.config.runMode == RunMode.Waiting)
+            progress = None
+            if budget['refresh'] is not None:
+                progress = lambda data: self.partialFrame(i, data)
+            read = self.dso.readDataAsync if self.config.asyncRead else self.dso.readData
+            if self.config.softTrigger is None:
+                data = read(width * factor, triggerTimeout=budget['timeout'], pre=pre * factor,
+                            progress=progress, refresh=budget['refresh'])
+            else:
+                # Search the whole capture window
+                data = read(size, triggerTimeout=budget['timeout'], pre=preTrigger,
+                            progress=progress, refresh=budget['refresh'])
+            if self.config.changed and self.config.runMode == RunMode.Waiting and not data[1]:
+                # Waiting was cancelled
+                continue
+            start = perf_counter()
+            self.stats.addCapture(self.dso.getCaptureTimes())
+            frame = Frame(i, data[0], triggered=data[1], off=data[2])
+            if self.config.softTrigger is not None:
+                self.alignFrame(frame, width * factor, pre * factor)
+            frame.capture = self.decoder.decode(
+                frame.data, self.ch1VoltageDIV, self.ch2VoltageDIV,
+                self.dso.getCalibration)
+            self.reduceNoise(frame, width, pre, factor)
+            if self.config.measure:
+                frame.measurements = measureCapture(frame.capture, self.sampleRate)
+            self.analyzeSpectrum(frame)
+            self.accumulate(frame)
+            self.publishFrame(frame, start)
+            self.serveFrame(frame)
+            self.recordFrame(frame)
             self.data.i = i
             self.progress.emit(i)
             i += 1
-            if self.data.triggered and self.config.runMode == RunMode.Waiting:
+            if frame.triggered and self.config.runMode == RunMode.Waiting:
                 # self.data.data = self.data.data[0x380*2:]
                 logger.info("Triggered and stopped")
                 # self.dso.print_values(self.data.data)
                 self.waitConfigChange()
         logger.info("worker exiting")
+        if self.recorder is not None:
+            self.recorder.close()
+            stats = self.recorder.stats()
+            logger.info("Recorded %(written)d captures, dropped %(dropped)d" % stats)
+            if stats['error'] is not None:
+                logger.error("Recording stopped: %s", stats['error'])
         self.dso.close()
         logger.info("worker exited")
 
 
 parser = argparse.ArgumentParser(description='peryscope')
+parser.add_argument('--async-read', action='store_true',
+                    help='read captures with queued asynchronous transfers')
+parser.add_argument('--simulate', action='store_true',
+                    help='use a simulated device')
+parser.add_argument('--record', metavar='FILE',
+                    help='record all USB transfers to a file')
+parser.add_argument('--replay', metavar='FILE',
+                    help='replay recorded USB transfers instead of a device')
+parser.add_argument('--cold-start', action='store_true',
+                    help='always run the full init handshake')
+parser.add_argument('--capture-size', type=int, metavar='SAMPLES',
+                    help='samples per capture, default is the window width')
+parser.add_argument('--log-captures', metavar='PREFIX',
+                    help='record all captures to PREFIX.NNNN.dso files')
+parser.add_argument('--device', metavar='BUS:ADDRESS',
+                    help='use this device instead of the first one found')
+parser.add_argument('--trigger', metavar='SPEC', type=parseTrigger,
+                    help='software trigger, e.g. pulse,channel=1,level=10,minWidth=20')
+parser.add_argument('--average', type=int, metavar='N',
+                    help='show the average of the last N triggered captures')
+parser.add_argument('--hires', type=int, metavar='N',
+                    help='show the mean of every N samples, for N times fewer but finer samples')
+parser.add_argument('--persistence', action='store_true',
+                    help='start with intensity graded persistent traces')
+parser.add_argument('--spectrum', action='store_true',
+                    help='start in the spectrum view')
+parser.add_argument('--stats', metavar='FILE',
+                    help='write the pipeline timing to FILE every second, as JSON')
+parser.add_argument('--stats-overlay', action='store_true',
+                    help='show the pipeline timing over the traces')
+parser.add_argument('--serve', metavar='ADDRESS',
+                    help='stream captures to clients on HOST:PORT or a Unix socket path')
 args = parser.parse_args()
+DsoConfig.asyncRead = args.async_read
+DsoConfig.simulate = args.simulate
+DsoConfig.record = args.record
+DsoConfig.replay = args.replay
+DsoConfig.coldStart = args.cold_start
+DsoConfig.captureSize = args.capture_size
+DsoConfig.captureLog = args.log_captures
+DsoConfig.serve = args.serve
+DsoConfig.device = args.device
+DsoConfig.softTrigger = args.trigger
+DsoConfig.spectrum = args.spectrum
+DsoConfig.persistence = args.persistence
+DsoConfig.statsFile = args.stats
+DsoConfig.statsOverlay = args.stats_overlay
+if args.average:
+    DsoConfig.acquireMode = AcquireMode.Average
+    DsoConfig.averageCount = args.average
+elif args.hires:
+    DsoConfig.acquireMode = AcquireMode.HiRes
+    DsoConfig.hiResFactor = args.hires
 
 logging.basicConfig(encoding='utf-8', level=logging.INFO)
 # filename='example.log',
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+# Headless acquisition, without Qt. Captures are written to a file or
+# stdout in the DsoFrames binary frame format.
+
+import sys
+import time
+import logging
+import argparse
+from PerytechDsoApi import (
+    PerytechDsoApi,
+    SampleRate,
+    Coupling,
+    VoltageDIV,
+    Channel,
+    TriggerEdge,
+    calibrationFile,
+)
+from DsoDevices import (
+    Acquisition,
+    DsoDevices,
+    findDevices,
+    selectDevices,
+)
+from DsoFrames import (
+    Frame,
+    packFrame,
+)
+
+logger = logging.getLogger('peryscope')
+
+
+def enumArg(enum):
+    def parse(name):
+        try:
+            return enum[name]
+        except KeyError:
+            raise argparse.ArgumentTypeError(
+                "%s is not one of %s" % (name, ", ".join(e.name for e in enum)))
+    return parse
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='peryscope headless capture')
+    parser.add_argument('--sample-rate', type=enumArg(SampleRate), default=SampleRate.kS100)
+    parser.add_argument('--ch1-div', type=enumArg(VoltageDIV), default=VoltageDIV.V1)
+    parser.add_argument('--ch2-div', type=enumArg(VoltageDIV), default=VoltageDIV.V1)
+    parser.add_argument('--ch1-couple', type=enumArg(Coupling), default=Coupling.DC)
+    parser.add_argument('--ch2-couple', type=enumArg(Coupling), default=Coupling.DC)
+    parser.add_argument('--trig-channel', type=enumArg(Channel), default=Channel.Ch1)
+    parser.add_argument('--trig-edge', type=enumArg(TriggerEdge), default=TriggerEdge.Rising)
+    parser.add_argument('--ch1-trig-voltage', type=int, default=10)
+    parser.add_argument('--ch2-trig-voltage', type=int, default=10)
+    parser.add_argument('--trig-offset', type=int, default=0,
+                        help='samples the trigger is left of the middle of the capture')
+    parser.add_argument('--trig-timeout', type=float, default=1.0,
+                        help='seconds to wait for a trigger')
+    parser.add_argument('--size', type=int, default=1000,
+                        help='samples per capture')
+    parser.add_argument('--triggered', action='store_true',
+                        help='output only triggered captures')
+    parser.add_argument('--frames', type=int, default=0,
+                        help='number of captures, 0 for no limit')
+    parser.add_argument('--duration', type=float, default=0,
+                        help='seconds to run, 0 for no limit')
+    parser.add_argument('--output', '-o', default='-',
+                        help='output file, - for stdout, {device} is replaced by the device')
+    parser.add_argument('--simulate', type=int, nargs='?', const=1, default=0, metavar='N',
+                        help='use N simulated devices')
+    parser.add_argument('--device', action='append', metavar='BUS:ADDRESS',
+                        help='capture from this device, can be repeated, default is all')
+    parser.add_argument('--scpi', metavar='ADDRESS',
+                        help='accept SCPI commands on HOST:PORT, a Unix socket path or '
+                        '"pty" instead of capturing')
+    parser.add_argument('--sync', action='store_true',
+                        help='capture all devices together and write time aligned '
+                        '(channels, samples) volts as consecutive .npy arrays')
+    parser.add_argument('--cold-start', action='store_true',
+                        help='always run the full init handshake')
+    parser.add_argument('--debug', action='store_true')
+    return parser.parse_args(argv)
+
+
+def acquisition(args):
+    return Acquisition(args.sample_rate, args.ch1_div, args.ch2_div,
+                       args.ch1_couple, args.ch2_couple, args.trig_channel, args.trig_edge,
+                       args.ch1_trig_voltage, args.ch2_trig_voltage, args.trig_offset,
+                       args.trig_timeout, args.size)
+
+
+def cacheFile(args):
+    # Simulated devices have no calibration to keep
+    return None if args.simulate else calibrationFile
+
+
+def openOutput(args, device, multiple):
+    if args.output == '-':
+        if multiple:
+            sys.exit("peryscope-cli: several devices need an --output with {device}")
+        return sys.stdout.buffer
+    if multiple and '{device}' not in args.output:
+        sys.exit("peryscope-cli: several devices need an --output with {device}")
+    return open(args.output.format(device=device.replace(':', '-')), 'wb')
+
+
+class FrameWriter:
+    # Writes the frames of one device, called in the device thread
+
+    def __init__(self, out, triggered, limit):
+        self.out = out
+        self.triggered = triggered
+        self.limit = limit
+        self.written = 0
+
+    def __call__(self, worker, frame):
+        if self.triggered and not frame.triggered:
+            return
+        try:
+            self.out.write(packFrame(Frame(self.written, frame.data, frame.triggered, frame.off),
+                                     time.time()))
+        except BrokenPipeError:
+            worker.stop()
+            return
+        self.written += 1
+        if self.limit and self.written >= self.limit:
+            worker.stop()
+
+
+def sync(args, udevs, usbcontext):
+    from DsoSync import DsoSync
+    import numpy as np
+    dso = DsoSync(udevs, acquisition(args), usbcontext=usbcontext,
+                  forceInit=args.cold_start, debug=args.debug, cacheFile=cacheFile(args))
+    out = openOutput(args, 'sync', False)
+    end = time.time() + args.duration if args.duration else None
+    n = 0
+    try:
+        while (not args.frames or n < args.frames) and (end is None or time.time() < end):
+            frame = dso.capture()
+            if args.triggered and not all(frame.triggered):
+                continue
+            logger.info("Frame %d skews %s correlations %s", frame.i, frame.skews,
+                        ' '.join('%.2f' % c for c in frame.correlations))
+            np.save(out, frame.data.astype(np.float32))
+            n += 1
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        dso.close()
+        if out is not sys.stdout.buffer:
+            out.close()
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    if args.simulate:
+        from DsoTransport import SimulatedDevice
+        usbcontext = None
+        udevs = [SimulatedDevice(address=n + 1) for n in range(args.simulate)]
+    else:
+        usbcontext, udevs = findDevices()
+    try:
+        udevs = selectDevices(udevs, args.device)
+    except Exception as e:
+        sys.exit("peryscope-cli: %s" % e)
+
+    if args.scpi is not None:
+        from DsoScpi import DsoScpi, serveScpi
+        dso = PerytechDsoApi()
+        dso.context = usbcontext
+        dso.setDebug(args.debug)
+        dso.initDevice(udevs[0], forceInit=args.cold_start, cacheFile=cacheFile(args))
+        try:
+            serveScpi(DsoScpi(dso), args.scpi)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            dso.close()
+        return
+
+    if args.sync:
+        sync(args, udevs, usbcontext)
+        return
+
+    devices = DsoDevices(udevs, acquisition(args), usbcontext=usbcontext,
+                         forceInit=args.cold_start, debug=args.debug, cacheFile=cacheFile(args))
+    outputs = []
+    try:
+        for worker in devices.workers:
+            out = openOutput(args, worker.device, len(udevs) > 1)
+            outputs.append(out)
+            # The writer stops the worker after --frames written frames
+            worker.onFrame = FrameWriter(out, args.triggered, args.frames)
+        end = time.time() + args.duration if args.duration else None
+        devices.start()
+        try:
+            while devices.running() and (end is None or time.time() < end):
+                devices.join(0.1)
+        except KeyboardInterrupt:
+            pass
+        devices.stop()
+        total = devices.stats()['total']
+        logger.info("%(captures)d captures from %(devices)d devices, %(rate).1f/s" % total)
+    finally:
+        for out in outputs:
+            try:
+                out.flush()
+            except BrokenPipeError:
+                pass
+            if out is not sys.stdout.buffer:
+                out.close()
+    if any(worker.error for worker in devices.workers):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules import each other as top level modules, like the launchers
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src', 'Peryscope'))
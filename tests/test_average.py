@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+
+from DsoAverage import (
+    AcquireMode,
+    Averager,
+    HiRes,
+    extraBits,
+    fitFactor,
+    sumType,
+)
+from PerytechDsoApi import (
+    preTrigger,
+    postTrigger,
+)
+
+
+def test_enum_values():
+    assert [m.value for m in AcquireMode] == [0, 1, 2]
+
+
+def test_sum_type():
+    assert sumType(1) == np.uint8
+    assert sumType(257) == np.uint16
+    assert sumType(0x10000) == np.uint32
+
+
+def test_extra_bits():
+    assert extraBits(4) == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize('width,pre', [(800, 400), (500, 0), (500, -200), (300, 300), (100, 50)])
+def test_fit_factor_keeps_window(width, pre):
+    factor = fitFactor(16, width, pre)
+    before = min(max(pre, 0), width) * factor
+    assert width * factor <= postTrigger + min(before, preTrigger) or factor == 1
+    # The next factor up would not fit
+    if factor < 16:
+        after = factor + 1
+        assert width * after > postTrigger + min(min(max(pre, 0), width) * after, preTrigger)
+
+
+def test_fit_factor_bounds():
+    # Centered, both sides fill
+    assert fitFactor(8, 500, 250) == 4
+    # Trigger left of the window, only the samples after it are kept
+    assert fitFactor(8, 500, -10) == postTrigger // 500
+    assert fitFactor(8, 100, 50) == 8
+    assert fitFactor(0, 100, 50) == 1
+    assert fitFactor(8, 4000, 2000) == 1
+
+
+def counts(average):
+    return np.rint(average).astype(int)
+
+
+def test_average_aligns_trigger():
+    averager = Averager(8, 2, 4)
+    a = np.arange(10, dtype=np.uint8) + 100
+    # Trigger at 5, shifted one sample left
+    result = averager.add(a, a, 5, True)
+    assert counts(result[0]).tolist() == list(range(101, 109))
+    b = np.full(10, 110, dtype=np.uint8)
+    result = averager.add(b, b, 4, True)
+    assert counts(result[0] * 2).tolist() == [v + 110 for v in range(101, 109)]
+    assert averager.filled() == 2
+
+
+def test_average_drops_oldest():
+    averager = Averager(4, 2, 0)
+    for value in (100, 120, 140):
+        data = np.full(4, value, dtype=np.uint8)
+        result = averager.add(data, data, 0, True)
+    assert result[1].tolist() == [130] * 4
+
+
+def test_average_partial_overlap():
+    averager = Averager(6, 2, 3)
+    data = np.full(6, 100, dtype=np.uint8)
+    # Trigger sample at 0, nothing before it
+    result = averager.add(data, data, 0, True)
+    assert result[0].tolist() == [0x80] * 3 + [100] * 3
+
+
+def test_average_untriggered():
+    averager = Averager(4, 2, 0)
+    data = np.full(4, 100, dtype=np.uint8)
+    assert averager.add(data, data, 0, False) is None
+    assert averager.add(data, data, None, True) is None
+    assert averager.filled() == 0
+
+
+def test_average_reset():
+    averager = Averager(4, 3, 0)
+    data = np.full(4, 100, dtype=np.uint8)
+    averager.add(data, data, 0, True)
+    averager.reset()
+    assert averager.filled() == 0
+    other = np.full(4, 50, dtype=np.uint8)
+    assert averager.add(other, other, 0, True)[0].tolist() == [50] * 4
+
+
+def test_hires():
+    hiRes = HiRes(4, 3)
+    ch1 = np.array([0, 4, 8, 12] * 4, dtype=np.uint8)
+    ch2 = np.full(16, 0xff, dtype=np.uint8)
+    result = hiRes.decimate(ch1, ch2)
+    assert result.shape == (2, 3)
+    assert result[0].tolist() == [6.0] * 3
+    assert result[1].tolist() == [255.0] * 3
+
+
+def test_hires_short_capture():
+    hiRes = HiRes(4, 10)
+    data = np.arange(9, dtype=np.uint8)
+    result = hiRes.decimate(data, data)
+    assert result[0].tolist() == [1.5, 5.5]
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from DsoDecoder import (
+    DsoDecoder,
+    channelViews,
+)
+from PerytechDsoApi import (
+    Channel,
+    VoltageDIV,
+    countsPerDiv,
+    voltages,
+)
+
+
+def test_channel_views():
+    ch1, ch2 = channelViews(bytes([1, 2, 3, 4, 5]))
+    assert ch1.tolist() == [1, 3]
+    assert ch2.tolist() == [2, 4]
+    ch1, ch2 = channelViews(b'')
+    assert len(ch1) == len(ch2) == 0
+
+
+@pytest.mark.parametrize('voltageDIV', list(VoltageDIV))
+def test_table(voltageDIV):
+    table = DsoDecoder().table(voltageDIV)
+    assert table.dtype == np.float32
+    assert len(table) == 256
+    assert table[0x80] == 0.0
+    # One division is countsPerDiv counts
+    assert table[0x80 + countsPerDiv] == pytest.approx(voltages[voltageDIV])
+    assert table[0x80 - countsPerDiv] == pytest.approx(-voltages[voltageDIV])
+
+
+def test_table_cached():
+    decoder = DsoDecoder()
+    assert decoder.table(VoltageDIV.V1) is decoder.table(VoltageDIV.V1)
+    assert decoder.table(VoltageDIV.V1, 1.5) is not decoder.table(VoltageDIV.V1)
+
+
+def test_table_offset():
+    table = DsoDecoder().table(VoltageDIV.V1, 2.0)
+    # The zero moves by the offset in counts
+    assert table[0x82] == 0.0
+    assert table[0x80] == pytest.approx(-2.0 * voltages[VoltageDIV.V1] / countsPerDiv)
+
+
+def test_decode():
+    data = bytes([0x80, 0x80 + countsPerDiv, 0x80 - countsPerDiv, 0x80])
+    capture = DsoDecoder().decode(data, VoltageDIV.V1, VoltageDIV.V2)
+    assert len(capture) == 2
+    assert capture.counts(Channel.Ch1).tolist() == [0x80, 0x80 - countsPerDiv]
+    assert capture.volts(Channel.Ch1).tolist() == pytest.approx([0.0, -1.0])
+    assert capture.volts(Channel.Ch2).tolist() == pytest.approx([2.0, 0.0])
+    assert capture.voltageDIV(Channel.Ch2) == VoltageDIV.V2
+
+
+def test_decode_calibration():
+    offsets = {VoltageDIV.V1: (1.0, -3.0), VoltageDIV.V2: (4.0, 2.0)}
+    data = bytes([0x81, 0x7d])
+    capture = DsoDecoder().decode(data, VoltageDIV.V1, VoltageDIV.V1, offsets.get)
+    # Each channel takes its own offset of its own range
+    assert capture.volts(Channel.Ch1)[0] == 0.0
+    assert capture.volts(Channel.Ch2)[0] == 0.0
+    capture = DsoDecoder().decode(data, VoltageDIV.V1, VoltageDIV.V2, offsets.get)
+    assert capture.volts(Channel.Ch2)[0] == pytest.approx(-5.0 * 2.0 / countsPerDiv)
+
+
+def test_decode_counts():
+    counts = np.array([[0x80, 0x80 + 0.5], [0x80 + countsPerDiv * 1.5, 0x80]], dtype=np.float32)
+    capture = DsoDecoder().decodeCounts(counts, VoltageDIV.V1, VoltageDIV.V1, decimation=4)
+    assert capture.decimation == 4
+    assert capture.data is None
+    # float32 slope, a small fraction of a count off
+    assert capture.volts(Channel.Ch1).tolist() == pytest.approx([0.0, 0.5 / countsPerDiv], abs=1e-4)
+    assert capture.volts(Channel.Ch2).tolist() == pytest.approx([1.5, 0.0], abs=1e-4)
+
+
+def test_decode_counts_calibration():
+    counts = np.array([[0x81], [0x80]], dtype=np.float32)
+    capture = DsoDecoder().decodeCounts(counts, VoltageDIV.V1, VoltageDIV.V1,
+                                        lambda voltageDIV: (1.0, 0.5))
+    assert capture.volts(Channel.Ch1)[0] == pytest.approx(0.0, abs=1e-4)
+    assert capture.volts(Channel.Ch2)[0] == pytest.approx(-0.5 / countsPerDiv, abs=1e-4)
@@ -0,0 +1,58 @@
+from DsoFrames import (
+    FRAME_HEADER_SIZE,
+    Frame,
+    FrameQueue,
+    packFrame,
+    unpackFrameHeader,
+)
+
+
+def test_pack():
+    data = packFrame(Frame(3, bytes([1, 2]), True, 5), 2.5)
+    assert unpackFrameHeader(data[:FRAME_HEADER_SIZE]) == (3, 2.5, 1, 5, 2)
+    assert data[FRAME_HEADER_SIZE:] == bytes([1, 2])
+
+
+def test_take_once():
+    frames = FrameQueue()
+    assert frames.take() is None
+    frame = Frame(0, b'')
+    frames.publish(frame)
+    assert frames.peek() is frame
+    assert frames.take() is frame
+    assert frames.take() is None
+
+
+def test_dropped():
+    frames = FrameQueue()
+    for i in range(3):
+        frames.publish(Frame(i, b''))
+    # The latest frame is not dropped yet
+    assert frames.dropped == 2
+    frames.take()
+    frames.publish(Frame(3, b''))
+    assert frames.dropped == 2
+    frames.publish(Frame(4, b''))
+    assert frames.stats() == {'published': 5, 'shown': 1, 'dropped': 3}
+
+
+def test_partial_not_dropped():
+    frames = FrameQueue()
+    frames.publish(Frame(0, b'', partial=True))
+    frames.publish(Frame(0, b'', partial=True))
+    frames.publish(Frame(0, b''))
+    frames.take()
+    assert frames.dropped == 0
+
+
+def test_every_frame_taken():
+    frames = FrameQueue()
+    for i in range(10):
+        frames.publish(Frame(i, b''))
+        frames.take()
+    assert frames.dropped == 0
+
+
+def test_pack_untriggered():
+    data = packFrame(Frame(0, b''), 0.0)
+    assert unpackFrameHeader(data[:FRAME_HEADER_SIZE]) == (0, 0.0, 0, -1, 0)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from DsoMeasure import (
+    CalAverage,
+    CalDutyCycle,
+    CalFrequency,
+    CalPeak2Peak,
+    CalPeriod,
+    CalRMS,
+    crossings,
+    measure,
+)
+
+
+def square(period, duty, n, low=-1.0, high=1.0):
+    t = np.arange(n) % period
+    return np.where(t < period * duty, high, low)
+
+
+def test_empty():
+    assert CalRMS([]) == 0.0
+    assert CalAverage([]) == 0.0
+    assert measure(np.array([])) == {}
+
+
+def test_sine():
+    n = 10000
+    data = 2.0 * np.sin(2 * np.pi * np.arange(n) / 100.0)
+    assert CalPeak2Peak(data) == pytest.approx(4.0, rel=1e-3)
+    assert CalRMS(data) == pytest.approx(2.0 / np.sqrt(2), rel=1e-3)
+    assert CalAverage(data) == pytest.approx(0.0, abs=1e-9)
+    assert CalPeriod(data) == pytest.approx(100.0)
+    assert CalFrequency(data, rate=1e5) == pytest.approx(1000.0)
+
+
+def test_duty_cycle():
+    assert CalDutyCycle(square(50, 0.2, 1000)) == pytest.approx(0.2)
+
+
+def test_hysteresis():
+    data = square(100, 0.5, 1000)
+    # Noise around the level must not count as crossings
+    data[20:30] = [0.05, -0.05] * 5
+    rising, falling = crossings(data, 0.0, 0.2)
+    assert list(rising) == list(range(100, 1000, 100))
+    assert list(falling) == list(range(50, 1000, 100))
+
+
+def test_measure():
+    m = measure(square(40, 0.25, 400, 0.0, 5.0), rate=1000)
+    assert m['max'] == 5.0
+    assert m['min'] == 0.0
+    assert m['period'] == pytest.approx(0.04)
+    assert m['frequency'] == pytest.approx(25.0)
+    assert m['duty'] == pytest.approx(0.25)
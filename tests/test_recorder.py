@@ -0,0 +1,66 @@
+import DsoRecorder
+from DsoRecorder import (
+    DsoRecorder as Recorder,
+    Settings,
+    listSegments,
+    openSegment,
+)
+from PerytechDsoApi import (
+    Channel,
+    Coupling,
+    SampleRate,
+    TriggerEdge,
+    VoltageDIV,
+)
+
+
+def settings(rate=SampleRate.kS100):
+    return Settings(rate, VoltageDIV.V1, VoltageDIV.V1, Coupling.DC, Coupling.DC,
+                    Channel.Ch1, TriggerEdge.Rising)
+
+
+def record(prefix, captures, **kwargs):
+    recorder = Recorder(prefix, **kwargs)
+    for data, s in captures:
+        recorder.write(data, s, True, 1.0)
+    recorder.close()
+    return recorder.stats()
+
+
+def test_round_trip(tmp_path):
+    prefix = str(tmp_path / 'rec')
+    stats = record(prefix, [(bytes([1, 2, 3, 4]), settings()), (bytes([5, 6]), settings())])
+    assert stats == {'written': 2, 'dropped': 0, 'segments': 1, 'error': None}
+    s, samples, index = openSegment(prefix + '.0000.dso')
+    assert s.key() == settings().key()
+    assert samples.tolist() == [[1, 2], [3, 4], [5, 6]]
+    assert index['length'].tolist() == [4, 2]
+    assert index['triggered'].tolist() == [1, 1]
+
+
+def test_new_segment_on_change(tmp_path):
+    prefix = str(tmp_path / 'rec')
+    record(prefix, [(bytes(2), settings()), (bytes(2), settings(SampleRate.MS1))])
+    assert len(listSegments(prefix)) == 2
+
+
+def test_numbering_continues(tmp_path):
+    prefix = str(tmp_path / 'rec')
+    record(prefix, [(bytes([1, 1]), settings())])
+    record(prefix, [(bytes([2, 2]), settings())])
+    segments = listSegments(prefix)
+    assert len(segments) == 2
+    # The first recording is kept
+    assert openSegment(segments[0])[1].tolist() == [[1, 1]]
+    assert openSegment(segments[1])[1].tolist() == [[2, 2]]
+
+
+def test_error_stops_recording(tmp_path, monkeypatch):
+    def fail(self, data, timestamp, triggered):
+        raise ValueError('broken')
+    monkeypatch.setattr(DsoRecorder.Segment, 'append', fail)
+    prefix = str(tmp_path / 'rec')
+    stats = record(prefix, [(bytes(2), settings())] * 3)
+    assert stats['written'] == 0
+    assert stats['dropped'] == 3
+    assert isinstance(stats['error'], ValueError)
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from DsoRender import (
+    PERSISTENCE_COLORS,
+    Persistence,
+    colorRamp,
+    gridSpacing,
+    minMaxEnvelope,
+    sampleToX,
+    tracePoints,
+)
+
+
+def test_envelope():
+    data = np.array([5, 1, 9, 3, 7, 2, 8, 4], dtype=np.uint8)
+    mins, maxs = minMaxEnvelope(data, 4)
+    assert list(mins) == [1, 3, 2, 4]
+    assert list(maxs) == [5, 9, 7, 8]
+
+
+def test_envelope_uneven():
+    data = np.arange(10)
+    mins, maxs = minMaxEnvelope(data, 3)
+    assert list(mins) == [0, 3, 6]
+    assert list(maxs) == [2, 5, 9]
+
+
+def test_short_trace():
+    data = np.array([1, 2, 3], dtype=np.uint8)
+    x, y = tracePoints(data, 10)
+    assert list(x) == [0, 1, 2]
+    assert list(y) == [1, 2, 3]
+
+
+def test_long_trace():
+    data = np.random.default_rng(1).integers(0, 256, 10000).astype(np.uint8)
+    width = 100
+    x, y = tracePoints(data, width)
+    assert len(x) == len(y) == 2 * width
+    mins, maxs = minMaxEnvelope(data, width)
+    # Every column spans its envelope
+    assert list(np.minimum(y[0::2], y[1::2])) == list(mins)
+    assert list(np.maximum(y[0::2], y[1::2])) == list(maxs)
+    # and continues from the end of the previous column
+    assert list(y[2::4]) == list(maxs[1::2])
+
+
+def test_grid_spacing():
+    assert gridSpacing(14) == pytest.approx(14)
+    assert gridSpacing(2.8) == pytest.approx(14)
+    assert gridSpacing(1.4) == pytest.approx(14)
+    assert gridSpacing(0.7) == pytest.approx(14)
+    assert gridSpacing(0.14) == pytest.approx(14)
+    assert gridSpacing(0.028) == pytest.approx(14)
+    assert gridSpacing(3, minimum=8) == pytest.approx(15)
+
+
+def test_sample_to_x():
+    assert sampleToX(5, 100, 200) == 5
+    assert sampleToX(500, 1000, 100) == 50
+
+
+def test_persistence():
+    p = Persistence(4, 10, decay=0.5)
+    # A flat trace at row 5 - 2 = 3
+    p.add([(np.full(4, 2, dtype=np.uint8), 5)])
+    assert list(np.flatnonzero(p.hits[:, 0])) == [3]
+    p.add([(np.full(4, 2, dtype=np.uint8), 5)])
+    assert p.hits[3, 0] == 1.5
+    image = p.image()
+    assert image.shape == (10, 4)
+    # Only the hit pixels are opaque
+    assert list(np.flatnonzero(image[:, 0] >> 24)) == [3]
+
+
+def test_persistence_spans():
+    p = Persistence(2, 10)
+    # A step joins the columns with a vertical span
+    p.add([(np.array([1, 4], dtype=np.uint8), 8)])
+    assert list(np.flatnonzero(p.hits[:, 0])) == [7]
+    assert list(np.flatnonzero(p.hits[:, 1])) == [4, 5, 6, 7]
+
+
+def test_persistence_decay():
+    p = Persistence(1, 4, decay=0.1)
+    p.add([(np.array([1], dtype=np.uint8), 2)])
+    p.add([])
+    p.add([])
+    # 0.01 hits are below MIN_HITS
+    assert not p.hits.any()
+    assert not p.image().any()
+
+
+def test_color_ramp():
+    table = colorRamp(PERSISTENCE_COLORS, 16)
+    assert table[0] == 0
+    assert table[1] == 0xff000000 | 0xa0d0ff
+    assert table[-1] == 0xff000000 | 0xffc000
@@ -0,0 +1,136 @@
+import io
+
+import pytest
+
+from DsoScpi import (
+    IDN,
+    DsoScpi,
+    definiteBlock,
+    serveStream,
+)
+from DsoTransport import SimulatedDevice
+from PerytechDsoApi import (
+    Channel,
+    Coupling,
+    PerytechDsoApi,
+    SampleRate,
+    VoltageDIV,
+    bufferSize,
+    sampleTimeDivider,
+)
+
+
+@pytest.fixture(scope='module')
+def device(tmp_path_factory):
+    # Initializing takes a while, the tests share the device
+    dso = PerytechDsoApi()
+    dso.initDevice(SimulatedDevice(), cacheFile=str(tmp_path_factory.mktemp('cache') / 'calibration.json'))
+    yield dso
+    dso.close()
+
+
+@pytest.fixture
+def scpi(device):
+    return DsoScpi(device)
+
+
+def ask(scpi, line):
+    return scpi.execute(line).decode().rstrip('\n')
+
+
+def errors(scpi):
+    found = []
+    while True:
+        error = ask(scpi, ':SYST:ERR?')
+        if error.startswith('0,'):
+            return found
+        found.append(int(error.split(',')[0]))
+
+
+def test_common(scpi):
+    assert ask(scpi, '*IDN?') == IDN
+    assert ask(scpi, '*OPC?') == '1'
+    assert scpi.execute('*RST') is None
+    assert errors(scpi) == []
+
+
+def test_settings(scpi):
+    assert scpi.execute(':TIMebase:SRATe 1e6') is None
+    assert scpi.sampleRate == SampleRate.MS1
+    assert float(ask(scpi, ':TIM:SRAT?')) == sampleTimeDivider[SampleRate.MS1]
+    scpi.execute(':chan2:scal 0.5')
+    assert scpi.voltageDIV[Channel.Ch2] == VoltageDIV.mV500
+    scpi.execute(':TRIG:SOUR CHAN2;:TRIG:EDGE:SLOP NEG')
+    assert ask(scpi, ':TRIG:SOUR?;:TRIG:EDGE?') == 'CHAN2;NEG'
+    assert errors(scpi) == []
+
+
+def test_relative_path(scpi):
+    scpi.execute(':CHANnel1:SCALe 2;COUPling AC')
+    assert scpi.voltageDIV[Channel.Ch1] == VoltageDIV.V2
+    assert scpi.couple[Channel.Ch1] == Coupling.AC
+    # Relative to the last command, not to the root
+    assert ask(scpi, ':CHAN1:COUP?;SCAL?') == 'AC;2.0'
+    assert errors(scpi) == []
+
+
+def test_error_queue(scpi):
+    scpi.execute(':NOPE 1')
+    scpi.execute(':ACQ:POIN')
+    scpi.execute(':WAV:FORM?  x')
+    scpi.execute(':CHAN3:SCAL 1')
+    scpi.execute(':CHAN1:COUP XY')
+    assert errors(scpi) == [-113, -109, -108, -114, -224]
+    scpi.execute(':NOPE 1')
+    scpi.execute('*CLS')
+    assert errors(scpi) == []
+
+
+@pytest.mark.parametrize('command', [':ACQ:POIN nan', ':ACQ:POIN 1e400', ':ACQ:POIN -inf',
+                                     ':TRIG:TIM nan', ':TRIG:TIM inf', ':TRIG:LEV 1e400'])
+def test_not_finite(scpi, command):
+    assert scpi.execute(command) is None
+    assert errors(scpi) == [-222]
+    assert scpi.points == 1000
+    assert scpi.trigTimeout == 1.0
+
+
+def test_points_limited(scpi):
+    scpi.execute(':ACQ:POIN 1e9')
+    assert int(ask(scpi, ':ACQ:POIN?')) == bufferSize
+    scpi.execute(':ACQ:POIN 0')
+    assert scpi.points == 1
+
+
+def test_data_block(scpi):
+    scpi.execute(':TIM:SRAT 1e6;:TRIG:TIM 0.2;:ACQ:POIN 500;:WAV:SOUR CHAN2')
+    response = scpi.execute(':WAV:DATA?')
+    assert response.startswith(b'#3500')
+    assert len(response) == 5 + 500 + 1
+    assert response.endswith(b'\n')
+    points, xinc, yinc, yref = ask(scpi, ':WAV:PRE?').split(',')
+    assert (int(points), float(xinc), int(yref)) == (500, 1e-6, 0x80)
+    scpi.execute(':WAV:FORM ASC')
+    values = ask(scpi, ':WAV:DATA?').split(',')
+    assert len(values) == 500
+    assert all(0 <= int(v) <= 0xff for v in values)
+    assert errors(scpi) == []
+
+
+def test_definite_block():
+    assert definiteBlock(b'abc') == b'#13abc'
+    assert definiteBlock(bytes(12)) == b'#212' + bytes(12)
+
+
+def test_device_error(scpi, monkeypatch):
+    def fail(*args, **kwargs):
+        raise OSError("USB gone")
+    monkeypatch.setattr(scpi.dso, 'readData', fail)
+    assert scpi.execute(':WAV:DATA?;*IDN?') == IDN.encode() + b'\n'
+    assert ask(scpi, ':SYST:ERR?') == '-300,"Device-specific error;USB gone"'
+
+
+def test_serve_stream(scpi):
+    out = io.BytesIO()
+    serveStream(scpi, io.BytesIO(b'*IDN?\r:ACQ:POIN nan\n:SYST:ERR?\n'), out)
+    assert out.getvalue() == IDN.encode() + b'\n-222,"Data out of range"\n'
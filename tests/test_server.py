@@ -0,0 +1,121 @@
+import json
+import socket
+import threading
+
+import pytest
+
+from DsoFrames import (
+    FRAME_HEADER_SIZE,
+    Frame,
+    unpackFrameHeader,
+)
+from DsoServer import (
+    CONFIG_FIELDS,
+    REPLY_HEADER_SIZE,
+    DsoServer,
+    unpackReplyHeader,
+)
+from PerytechDsoApi import (
+    SampleRate,
+    VoltageDIV,
+)
+
+
+class Config:
+    sampleRate = SampleRate.kS100
+    ch1VoltageDIV = VoltageDIV.V1
+    ch2VoltageDIV = VoltageDIV.V1
+    ch1Couple = None
+    ch2Couple = None
+    trigChannel = None
+    trigEdge = None
+    ch1TrigVoltage = 10
+    ch2TrigVoltage = 10
+    trigOffset = 0
+    changed = False
+
+
+class Connection:
+
+    def __init__(self, address):
+        self.sock = socket.create_connection(address, timeout=5)
+        self.buffer = b''
+
+    def read(self, n):
+        while len(self.buffer) < n:
+            data = self.sock.recv(65536)
+            assert data, 'connection closed'
+            self.buffer += data
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def command(self, line):
+        self.sock.sendall(line.encode('utf-8') + b'\n')
+        length = unpackReplyHeader(self.read(REPLY_HEADER_SIZE))
+        return self.read(length).decode('utf-8')
+
+    def frame(self):
+        header = unpackFrameHeader(self.read(FRAME_HEADER_SIZE))
+        return header, self.read(header[-1])
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def server():
+    changed = threading.Event()
+    server = DsoServer(':0', Config(), CONFIG_FIELDS, onChange=changed.set,
+                       getStats=lambda: {'fps': 1.0})
+    server.changed = changed
+    yield server
+    server.close()
+
+
+def test_get_set(server):
+    client = Connection(server.address)
+    assert client.command('get sampleRate') == 'ok sampleRate=kS100'
+    assert client.command('set sampleRate MS1') == 'ok sampleRate=MS1'
+    assert server.config.sampleRate == SampleRate.MS1
+    assert server.config.changed
+    assert server.changed.wait(1)
+    assert client.command('set trigOffset 100') == 'ok trigOffset=100'
+    assert server.config.trigOffset == 100
+    assert 'ch1VoltageDIV=V1' in client.command('get')
+    client.close()
+
+
+def test_errors(server):
+    client = Connection(server.address)
+    assert client.command('set sampleRate fast').startswith('error')
+    assert client.command('get nothing').startswith('error')
+    assert client.command('frobnicate').startswith('error unknown command')
+    assert server.config.sampleRate == SampleRate.kS100
+    assert client.command('set ch2TrigVoltage 300') == 'error ch2TrigVoltage out of range -128..127'
+    assert client.command('set ch1TrigVoltage -129').startswith('error')
+    assert client.command('set trigOffset -5000').startswith('error')
+    assert client.command('set trigOffset 1x').startswith('error bad value')
+    assert (server.config.ch1TrigVoltage, server.config.ch2TrigVoltage) == (10, 10)
+    assert server.config.trigOffset == 0
+    assert not server.config.changed
+    assert client.command('set ch2TrigVoltage -128') == 'ok ch2TrigVoltage=-128'
+    client.close()
+
+
+def test_stats(server):
+    client = Connection(server.address)
+    reply = client.command('stats')
+    assert reply.startswith('ok ')
+    assert json.loads(reply[3:]) == {'fps': 1.0}
+    client.close()
+
+
+def test_frames(server):
+    client = Connection(server.address)
+    # Connected once a command is answered
+    client.command('get sampleRate')
+    server.publish(Frame(7, bytes([1, 2, 3, 4]), True, 1), 123.0)
+    (i, timestamp, triggered, off, length), data = client.frame()
+    assert (i, timestamp, triggered, off) == (7, 123.0, 1, 1)
+    assert data == bytes([1, 2, 3, 4])
+    client.close()
@@ -0,0 +1,386 @@
+import json
+import threading
+import time
+
+import pytest
+
+import PerytechDsoApi
+from PerytechDsoApi import (
+    Channel,
+    Coupling,
+    Reg,
+    SampleRate,
+    TriggerEdge,
+    VoltageDIV,
+    captureWindow,
+    limitPre,
+    postTrigger,
+    preTrigger,
+    triggerPre,
+)
+from DsoTransport import (
+    EEPROM_WORDS,
+    SerialEeprom,
+    SimulatedDevice,
+    SimulatedDso,
+)
+
+# Generous bounds, these catch order of magnitude regressions only
+INIT_SECONDS = 5.0
+CAPTURE_SECONDS = 0.5
+
+
+@pytest.fixture
+def mismatches(monkeypatch):
+    found = []
+    validate = PerytechDsoApi.PerytechDsoApi.validate_read
+
+    def record(self, expected, actual):
+        if expected != actual:
+            found.append((expected, actual))
+        validate(self, expected, actual)
+    monkeypatch.setattr(PerytechDsoApi.PerytechDsoApi, 'validate_read', record)
+    return found
+
+
+@pytest.fixture
+def dso(tmp_path):
+    api = PerytechDsoApi.PerytechDsoApi()
+    api.initDevice(SimulatedDevice(), cacheFile=str(tmp_path / 'calibration.json'))
+    api.setSampleRate(SampleRate.MS1)
+    api.setTrigChannel(Channel.Ch1)
+    api.setTrigEdge(TriggerEdge.Rising)
+    api.setTrigVoltage(Channel.Ch1, 0.0)
+    yield api
+    api.close()
+
+
+def readWord(eeprom, address):
+    def clock(cs, di):
+        eeprom.write(cs | di << 2)
+        eeprom.write(cs | 0x02 | di << 2)
+    eeprom.write(0)
+    for bit in [1, 1, 0] + [(address >> i) & 1 for i in range(5, -1, -1)]:
+        clock(1, bit)
+    word = 0
+    for i in range(16):
+        clock(1, 0)
+        word = word << 1 | (eeprom.status() >> 3) & 1
+    return word
+
+
+def test_eeprom_read():
+    eeprom = SerialEeprom(EEPROM_WORDS)
+    assert readWord(eeprom, 0x38) == 0x310f
+    assert readWord(eeprom, 0x3f) == 0x3237
+    # Erased
+    assert readWord(eeprom, 0x00) == 0xffff
+
+
+def test_cold_init_status(tmp_path, mismatches):
+    api = PerytechDsoApi.PerytechDsoApi()
+    api.initDevice(SimulatedDevice(), forceInit=True, cacheFile=str(tmp_path / 'calibration.json'))
+    api.close()
+    assert mismatches == []
+
+
+class PoweredDevice(SimulatedDevice):
+    # Keeps its state between opens, like a scope left plugged in
+
+    def __init__(self):
+        SimulatedDevice.__init__(self)
+        self.handle = SimulatedDso()
+
+    def getSerialNumber(self):
+        return 'SIM1'
+
+    def open(self):
+        return self.handle
+
+
+def test_status_mismatch_logged(capsys, caplog):
+    api = PerytechDsoApi.PerytechDsoApi()
+    api.validate_read(b"\x79", b"\x71")
+    assert capsys.readouterr().out == ''
+    assert '79' in caplog.text
+
+
+def test_warm_start(tmp_path):
+    udev = PoweredDevice()
+    cacheFile = str(tmp_path / 'calibration.json')
+    api = PerytechDsoApi.PerytechDsoApi()
+    # Registers as right after the link sequence, not yet initialized
+    api.initDevice(udev, forceInit=False, cacheFile=cacheFile)
+    assert 'link' in api.getInitTimes()
+    api.initDevice(udev, forceInit=False, cacheFile=cacheFile)
+    assert 'link' not in api.getInitTimes()
+    with open(cacheFile) as f:
+        assert list(json.load(f)) == ['serial-SIM1']
+    api.initDevice(udev, forceInit=True, cacheFile=cacheFile)
+    assert 'link' in api.getInitTimes()
+
+
+def test_warm_start_needs_calibration(tmp_path):
+    udev = PoweredDevice()
+    api = PerytechDsoApi.PerytechDsoApi()
+    api.initDevice(udev, forceInit=False, cacheFile=str(tmp_path / 'calibration.json'))
+    api.initDevice(udev, forceInit=False, cacheFile=str(tmp_path / 'other.json'))
+    assert 'link' in api.getInitTimes()
+    api.initDevice(udev, forceInit=False, cacheFile=None)
+    assert 'link' in api.getInitTimes()
+
+
+def test_interrupted_init(tmp_path):
+    udev = PoweredDevice()
+    cacheFile = str(tmp_path / 'calibration.json')
+    api = PerytechDsoApi.PerytechDsoApi()
+    api.initDevice(udev, forceInit=False, cacheFile=cacheFile)
+    # As left between the end of __linkDSO and the end of __dsoInitial
+    udev.handle.regs[PerytechDsoApi.Reg.MAYBE_DEVICE_STATUS.value] = 0x0009
+    api.initDevice(udev, forceInit=False, cacheFile=cacheFile)
+    assert 'link' in api.getInitTimes()
+
+
+def test_no_device_key(tmp_path):
+    # Nothing to tell simulated devices apart, so nothing is cached
+    cacheFile = tmp_path / 'calibration.json'
+    api = PerytechDsoApi.PerytechDsoApi()
+    api.initDevice(SimulatedDevice(), forceInit=False, cacheFile=str(cacheFile))
+    api.close()
+    assert not cacheFile.exists()
+
+
+def test_trigger_pre():
+    assert triggerPre(1000) == 500
+    assert triggerPre(1000, 100) == 400
+    # Only preTrigger samples are kept before the trigger
+    assert triggerPre(2000, -500) == preTrigger
+    # and postTrigger from it on
+    assert triggerPre(1000, 900) == 1000 - postTrigger
+    assert limitPre(100, -50) == -50
+    assert limitPre(4000, 0) == preTrigger
+
+
+def test_capture_window():
+    assert captureWindow(100, 0, True, 1000, 200) == ((100 - 200) % 0x2000, 200)
+    assert captureWindow(0, 500, False, 1000, 200) == ((500 - 1000) % 0x2000, None)
+
+
+def test_triggered_capture(dso):
+    buff, triggered, index, regs = dso.readData(2000, triggerTimeout=1.0)
+    assert len(buff) == 2 * 2000
+    assert triggered
+    assert index == 1000
+    ch1 = buff[0::2]
+    # Rising through the level at the trigger sample
+    assert ch1[index - 1] < 0x80 <= ch1[index]
+
+
+def test_trigger_before_window(dso):
+    buff, triggered, index, regs = dso.readData(500, triggerTimeout=1.0, pre=-100)
+    assert triggered
+    assert index == -100
+
+
+def test_stale_samples_padded(dso):
+    size = preTrigger + postTrigger + 100
+    buff, triggered, index, regs = dso.readData(size, triggerTimeout=1.0)
+    assert index == preTrigger
+    ch1 = buff[0::2]
+    assert set(ch1[index + postTrigger:]) == {0x80}
+    assert len(set(ch1[:index + postTrigger])) > 1
+
+
+def test_slow_progress(dso):
+    # A progress callback outlasting the timeout must not sleep negative
+    dso.setSampleRate(SampleRate.kS1)
+    dso.setTrigChannel(Channel.Ext)
+
+    def progress(data):
+        time.sleep(0.05)
+    buff, triggered, index, regs = dso.readData(100, triggerTimeout=0.03, progress=progress,
+                                                refresh=0.001)
+    assert not triggered
+
+
+def test_untriggered_capture(dso):
+    dso.setTrigChannel(Channel.Ext)
+    buff, triggered, index, regs = dso.readData(500, triggerTimeout=0.01)
+    assert not triggered
+    assert index is None
+
+
+def test_init_time(tmp_path):
+    api = PerytechDsoApi.PerytechDsoApi()
+    start = time.perf_counter()
+    api.initDevice(SimulatedDevice(), forceInit=True, cacheFile=str(tmp_path / 'calibration.json'))
+    elapsed = time.perf_counter() - start
+    api.close()
+    assert elapsed < INIT_SECONDS
+
+
+def test_capture_time(dso):
+    dso.readData(2000, triggerTimeout=1.0)
+    start = time.perf_counter()
+    for i in range(5):
+        dso.readData(2000, triggerTimeout=1.0)
+    assert (time.perf_counter() - start) / 5 < CAPTURE_SECONDS
+
+
+class CountingDso(SimulatedDso):
+    # Records the register writes
+
+    def __init__(self):
+        SimulatedDso.__init__(self)
+        self.writes = []
+
+    def bulkWrite(self, endpoint, data, timeout=0):
+        self.writes.append(self.selected)
+        SimulatedDso.bulkWrite(self, endpoint, data, timeout)
+
+    def count(self, reg):
+        return self.writes.count(reg.value)
+
+
+@pytest.fixture
+def counted():
+    handle = CountingDso()
+    udev = SimulatedDevice()
+    udev.open = lambda: handle
+    api = PerytechDsoApi.PerytechDsoApi()
+    api.initDevice(udev, cacheFile=None)
+    handle.writes = []
+    yield api, handle
+    api.close()
+
+
+def test_unchanged_writes_skipped(counted):
+    api, handle = counted
+    api.setSampleRate(SampleRate.MS1)
+    api.setSampleRate(SampleRate.MS1)
+    api.setTrigEdge(TriggerEdge.Rising)
+    api.setTrigEdge(TriggerEdge.Rising)
+    assert handle.count(Reg.SAMPLE_RATE) == 1
+    assert handle.count(Reg.TRIG_EDGE) == 1
+    assert handle.count(Reg.TRIG_LEVEL) <= 1
+
+
+def test_transaction_coalesces(counted):
+    api, handle = counted
+    with api.transaction():
+        api.setSampleRate(SampleRate.kS100)
+        api.setSampleRate(SampleRate.MS1)
+        api.setTrigVoltage(Channel.Ch1, 20)
+        api.setTrigVoltage(Channel.Ch2, -20)
+        assert handle.writes == []
+    assert handle.count(Reg.SAMPLE_RATE) == 1
+    assert handle.count(Reg.TRIG_LEVEL) == 1
+    assert api.getShadowRegister(Reg.SAMPLE_RATE) == SampleRate.MS1.value
+    assert api.getShadowRegister(Reg.TRIG_LEVEL) == (20 + 0x80) | (-20 + 0x80) << 8
+
+
+def test_transaction_merges_coupling(counted):
+    api, handle = counted
+
+    def configure():
+        api.setVoltageDIV(Channel.Ch1, VoltageDIV.V2)
+        api.setVoltageDIV(Channel.Ch2, VoltageDIV.V5)
+        api.setCh1Couple(Coupling.AC)
+        api.setCh2Couple(Coupling.AC)
+    configure()
+    single = handle.count(Reg.VOLTAGE_COUPLING)
+    api.setCh1Couple(Coupling.DC)
+    api.setCh2Couple(Coupling.DC)
+    handle.writes = []
+    with api.transaction():
+        configure()
+    assert 0 < handle.count(Reg.VOLTAGE_COUPLING) < single
+
+
+def test_transaction_other_thread(counted):
+    # A setter of another thread is not deferred into the open batch
+    api, handle = counted
+    done = threading.Event()
+
+    def setEdge():
+        api.setTrigEdge(TriggerEdge.Falling)
+        done.set()
+    with api.transaction():
+        api.setSampleRate(SampleRate.MS1)
+        thread = threading.Thread(target=setEdge)
+        thread.start()
+        assert not done.wait(0.2)
+        assert handle.writes == []
+    thread.join(5)
+    assert done.is_set()
+    assert handle.writes.index(Reg.SAMPLE_RATE.value) < handle.writes.index(Reg.TRIG_EDGE.value)
+    assert api.getShadowRegister(Reg.TRIG_EDGE) == TriggerEdge.Falling.value
+
+
+class FakeClock:
+    # Stands in for the time module of PerytechDsoApi: sleeping advances
+    # time.time() without waiting
+
+    def __init__(self):
+        self.now = time.time()
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        assert seconds >= 0
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def perf_counter(self):
+        return time.perf_counter()
+
+
+def test_status_registers_returned(dso):
+    dso.setDebug(False)
+    buff, triggered, index, regs = dso.readData(500, triggerTimeout=1.0)
+    assert triggered
+    assert regs[Reg.HELLO.value] == 0x1101
+    assert regs[Reg.MAYBE_SOME_STATUS.value] == 0x000b
+    dso.setTrigChannel(Channel.Ext)
+    buff, triggered, index, regs = dso.readData(500, triggerTimeout=0.01)
+    assert not triggered
+    assert regs[Reg.MAYBE_SOME_STATUS.value] != 0x000b
+
+
+@pytest.mark.parametrize('sampleRate', [SampleRate.kS100, SampleRate.MS1, SampleRate.MS200])
+def test_poll_backoff(dso, monkeypatch, sampleRate):
+    clock = FakeClock()
+    monkeypatch.setattr(PerytechDsoApi, 'time', clock)
+    dso.setDebug(False)
+    dso.setSampleRate(sampleRate)
+    dso.setTrigChannel(Channel.Ext)
+    buff, triggered, index, regs = dso.readData(100, triggerTimeout=0.1)
+    assert not triggered
+    divider = PerytechDsoApi.sampleTimeDivider[sampleRate]
+    first = min(16.0 / divider, 0.01)
+    longest = min(max(512.0 / divider, 0.001), 0.05)
+    sleeps = clock.sleeps
+    assert sleeps[0] == pytest.approx(first)
+    # Doubling up to the longest interval, the last one ends at the timeout
+    for previous, interval in zip(sleeps[:-2], sleeps[1:-1]):
+        assert interval == pytest.approx(min(previous * 2, longest))
+    assert sleeps[-1] <= longest + 1e-12
+    assert sum(sleeps) == pytest.approx(0.1, abs=1e-5)
+    stats = dso.getPollStats()
+    assert stats['lastPolls'] == len(sleeps) + 1
+    assert stats['maxPolls'] >= stats['lastPolls']
+
+
+def test_poll_stats(dso):
+    before = dso.getPollStats()
+    dso.readData(500, triggerTimeout=1.0)
+    dso.readData(500, triggerTimeout=1.0)
+    stats = dso.getPollStats()
+    assert stats['captures'] == before['captures'] + 2
+    assert stats['polls'] >= before['polls'] + 2
+    assert 1 <= stats['lastPolls'] <= stats['maxPolls']
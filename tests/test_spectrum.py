@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+from DsoDecoder import DsoDecoder
+from DsoSpectrum import (
+    Averaging,
+    Spectrum,
+    Window,
+    formatFrequency,
+    frequencies,
+    plan,
+    toDb,
+)
+from PerytechDsoApi import (
+    Channel,
+    SampleRate,
+    VoltageDIV,
+    countsPerDiv,
+    sampleTimeDivider,
+    voltages,
+)
+
+
+def tone(size, cycles, amplitude, phase=0.0):
+    return amplitude * np.sin(2 * np.pi * cycles * np.arange(size) / size + phase)
+
+
+def test_enum_values():
+    assert [a.value for a in Averaging] == [0, 1, 2]
+
+
+@pytest.mark.parametrize('window', list(Window))
+def test_bin_centered_level(window):
+    # A sine of amplitude A is A / sqrt(2) V rms at its bin
+    size = 1024
+    power = plan(size, window).power(tone(size, 64, 2.0))
+    assert power[64] == pytest.approx(2.0, rel=1e-3)
+
+
+def test_flat_top_between_bins():
+    size = 1024
+    power = plan(size, Window.FlatTop).power(tone(size, 64.5, 1.0))
+    assert 10 * np.log10(power.max()) == pytest.approx(10 * np.log10(0.5), abs=0.05)
+
+
+def test_dc():
+    size = 256
+    power = plan(size, Window.Hann).power(np.full(size, 0.5))
+    assert power[0] == pytest.approx(0.25)
+
+
+def test_frequencies():
+    f = frequencies(1000, SampleRate.kS100)
+    assert len(f) == 501
+    assert f[-1] == pytest.approx(sampleTimeDivider[SampleRate.kS100] / 2)
+    assert frequencies(1000, SampleRate.kS100, 4)[-1] == pytest.approx(f[-1] / 4)
+
+
+def test_to_db():
+    assert toDb(np.array([1.0, 0.01]))[1] == pytest.approx(-20)
+    assert np.isfinite(toDb(np.zeros(1))).all()
+
+
+def test_format_frequency():
+    assert formatFrequency(1500) == "1.5 kHz"
+    assert formatFrequency(2e6) == "2 MHz"
+    assert formatFrequency(50) == "50 Hz"
+
+
+def capture(volts1, volts2=None):
+    decoder = DsoDecoder()
+    counts = np.stack([volts1, volts1 if volts2 is None else volts2]) * \
+        (countsPerDiv / voltages[VoltageDIV.V1]) + 0x80
+    return decoder.decodeCounts(counts.astype(np.float32), VoltageDIV.V1, VoltageDIV.V1)
+
+
+def test_update_levels():
+    size = 1024
+    spectra = Spectrum(Window.Hann).update(capture(tone(size, 100, 1.0)), SampleRate.kS100)
+    assert spectra.levels.shape == (2, size // 2 + 1)
+    assert np.argmax(spectra.levels[Channel.Ch1.value]) == 100
+    assert spectra.peaks is None
+    assert spectra.count == 1
+
+
+def test_linear_average():
+    size = 512
+    rng = np.random.default_rng(1)
+    spectrum = Spectrum(Window.Hann, Averaging.Linear, count=4)
+    for i in range(6):
+        spectra = spectrum.update(capture(rng.standard_normal(size)), SampleRate.kS100)
+    assert spectra.count == 4
+    assert len(spectrum.history) == 4
+
+
+def test_exponential_average_keeps_tone():
+    size = 512
+    spectrum = Spectrum(Window.Hann, Averaging.Exponential, count=8)
+    for i in range(20):
+        spectra = spectrum.update(capture(tone(size, 32, 1.0, phase=i)), SampleRate.kS100)
+    assert spectra.count == 8
+    assert spectra.levels[0, 32] == pytest.approx(10 * np.log10(0.5), abs=0.3)
+
+
+def test_peak_hold():
+    size = 256
+    spectrum = Spectrum(Window.Hann, peakHold=True)
+    spectrum.update(capture(tone(size, 10, 1.0)), SampleRate.kS100)
+    spectra = spectrum.update(capture(tone(size, 20, 1.0)), SampleRate.kS100)
+    assert spectra.peaks[0, 10] > spectra.levels[0, 10] + 20
+    assert spectra.peaks[0, 20] == pytest.approx(spectra.levels[0, 20])
+
+
+def test_reset_on_size_change():
+    spectrum = Spectrum(Window.Hann, Averaging.Linear, count=4)
+    spectrum.update(capture(tone(256, 10, 1.0)), SampleRate.kS100)
+    spectra = spectrum.update(capture(tone(512, 10, 1.0)), SampleRate.kS100)
+    assert spectra.count == 1
+
+
+def test_configure_resets():
+    spectrum = Spectrum(Window.Hann, Averaging.Linear, count=4)
+    spectrum.update(capture(tone(256, 10, 1.0)), SampleRate.kS100)
+    spectrum.configure(Window.Hann, Averaging.Linear, 4, False)
+    assert len(spectrum.history) == 1
+    spectrum.configure(Window.FlatTop, Averaging.Linear, 4, False)
+    assert len(spectrum.history) == 0
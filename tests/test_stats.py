@@ -0,0 +1,128 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import DsoStats
+from DsoStats import (
+    PipelineStats,
+    RollingHistogram,
+    captureStages,
+)
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(DsoStats.time, 'monotonic', clock)
+    return clock
+
+
+def test_capture_stages():
+    times = {'start': 1.0, 'arm': 1.5, 'stop': 3.0, 'read': 3.25, 'done': 4.0, 'trigger': None}
+    assert captureStages(times) == {'arm': 0.5, 'wait': 1.5, 'stop': 0.25, 'read': 0.75}
+    assert captureStages({'start': 1.0, 'arm': 2.0}) == {'arm': 1.0}
+    assert captureStages({}) == {}
+
+
+def test_histogram_empty():
+    assert RollingHistogram().summary() == {'count': 0}
+
+
+def test_histogram_percentiles():
+    histogram = RollingHistogram()
+    for value in range(1, 101):
+        histogram.add(value / 1000)
+    summary = histogram.summary()
+    assert summary['count'] == 100
+    assert summary['mean'] == pytest.approx(0.0505)
+    assert summary['p50'] == pytest.approx(np.percentile(np.arange(1, 101), 50) / 1000)
+    assert summary['p99'] == pytest.approx(np.percentile(np.arange(1, 101), 99) / 1000)
+    assert summary['max'] == pytest.approx(0.1)
+
+
+def test_histogram_window():
+    # Only the last size values count
+    histogram = RollingHistogram(4)
+    for value in (10.0, 10.0, 1.0, 2.0, 3.0, 4.0):
+        histogram.add(value)
+    summary = histogram.summary()
+    assert summary['count'] == 6
+    assert summary['max'] == 4.0
+    assert summary['mean'] == pytest.approx(2.5)
+
+
+def test_rates(clock):
+    stats = PipelineStats()
+    for i in range(11):
+        if i:
+            clock.now += 0.1
+        stats.frame(1000)
+    snapshot = stats.snapshot()
+    # 10 intervals of 0.1 s, the bytes of the first frame are before them
+    assert snapshot['fps'] == pytest.approx(10.0)
+    assert snapshot['MBps'] == pytest.approx(10 * 1000 / 1.0 / 1e6)
+    assert snapshot['total'] == {'frames': 11, 'bytes': 11000}
+    # The rates are up to now, they go down when the frames stop
+    clock.now += 0.5
+    assert stats.snapshot()['fps'] == pytest.approx(10 / 1.5)
+
+
+def test_rates_window(clock):
+    stats = PipelineStats()
+    stats.frame(1000)
+    clock.now += DsoStats.RATE_WINDOW + 1
+    assert stats.snapshot()['fps'] == 0.0
+    stats.frame(500)
+    clock.now += 0.5
+    stats.frame(500)
+    snapshot = stats.snapshot()
+    assert snapshot['fps'] == pytest.approx(2.0)
+    assert snapshot['MBps'] == pytest.approx(1000 / 1e6)
+    assert snapshot['total']['frames'] == 3
+
+
+def test_stages_and_lines():
+    stats = PipelineStats()
+    stats.addCapture({'start': 0.0, 'arm': 0.001, 'stop': 0.011, 'read': 0.012, 'done': 0.022})
+    stats.add('draw', 0.004)
+    snapshot = stats.snapshot()
+    assert set(snapshot['stages']) == {'arm', 'wait', 'stop', 'read', 'draw'}
+    assert snapshot['stages']['wait']['p50'] == pytest.approx(0.010)
+    lines = stats.lines()
+    assert lines[0].endswith('MB/s')
+    assert any(line.startswith('wait') and '10.00' in line for line in lines)
+    assert json.loads(stats.toJson())['stages']['draw']['count'] == 1
+
+
+def test_write_file(tmp_path):
+    stats = PipelineStats()
+    stats.add('draw', 0.004)
+    path = str(tmp_path / 'stats.json')
+    stats.writeFile(path)
+    with open(path) as f:
+        assert json.load(f)['stages']['draw']['count'] == 1
+    assert os.listdir(tmp_path) == ['stats.json']
+
+
+def test_write_file_error(tmp_path):
+    stats = PipelineStats()
+    with pytest.raises(OSError):
+        stats.writeFile(str(tmp_path / 'missing' / 'stats.json'))
+    # A directory in the way: the partial file is removed, nothing else
+    # changes
+    (tmp_path / 'stats.json').mkdir()
+    with pytest.raises(OSError):
+        stats.writeFile(str(tmp_path / 'stats.json'))
+    assert os.listdir(tmp_path) == ['stats.json']
+    assert (tmp_path / 'stats.json').is_dir()
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from DsoSync import (
+    align,
+    estimateSkew,
+)
+
+
+def noise(n, seed=1):
+    return np.random.default_rng(seed).standard_normal(n)
+
+
+def smooth(n, seed=1, width=8):
+    # Band limited noise, the correlation peak is several samples wide
+    return np.convolve(noise(n + width, seed), np.hanning(width), mode='valid')[:n]
+
+
+def delayed(signal, delay):
+    # signal delayed by a fraction of a sample, through the FFT
+    n = len(signal)
+    f = np.fft.rfftfreq(n)
+    return np.fft.irfft(np.fft.rfft(signal) * np.exp(-2j * np.pi * f * delay), n)
+
+
+def test_integer_lag():
+    ref = noise(2000)
+    lag, c = estimateSkew(ref, ref[17:1017])
+    assert lag == pytest.approx(17, abs=0.01)
+    assert c == pytest.approx(1.0, abs=0.01)
+    lag, c = estimateSkew(ref[17:1017], ref)
+    assert lag == pytest.approx(-17, abs=0.01)
+
+
+def test_fractional_lag():
+    ref = smooth(4096)
+    lag, c = estimateSkew(ref, delayed(ref, -2.3))
+    assert lag == pytest.approx(2.3, abs=0.1)
+
+
+def test_not_biased_to_around():
+    ref = smooth(2000)
+    # A broad peak at 10, its neighbours are closer to around
+    lag, c = estimateSkew(ref, ref[10:1010], around=0)
+    assert lag == pytest.approx(10, abs=0.01)
+    lag, c = estimateSkew(ref, ref[10:1010], around=30, maxLag=40)
+    assert lag == pytest.approx(10, abs=0.01)
+
+
+def test_periodic_nearest():
+    t = np.arange(2000)
+    ref = np.sin(2 * np.pi * t / 100) + 0.3 * np.sin(2 * np.pi * t / 25)
+    data = ref[3:1003]
+    lag, c = estimateSkew(ref, data, around=0, maxLag=60)
+    assert lag == pytest.approx(3, abs=0.05)
+    lag, c = estimateSkew(ref, data, around=200, maxLag=60)
+    assert lag == pytest.approx(203, abs=0.05)
+
+
+def test_align():
+    a = np.arange(10)
+    b = np.arange(3, 13)
+    merged, start = align([a, b], [0, 2.9])
+    assert start == 3
+    assert list(merged[0]) == list(merged[1]) == list(range(3, 10))
@@ -0,0 +1,135 @@
+import argparse
+
+import numpy as np
+import pytest
+
+from DsoTrigger import (
+    EdgeTrigger,
+    NthEdgeTrigger,
+    PatternTrigger,
+    PulseTrigger,
+    RuntTrigger,
+    SlopeTrigger,
+    WindowTrigger,
+    parseTrigger,
+)
+from PerytechDsoApi import (
+    Channel,
+    TriggerEdge,
+)
+
+
+def pulses(*spans, n=200, high=50, low=-50):
+    # Signed counts, high from start to end of every span
+    data = np.full(n, low, dtype=np.int16)
+    for start, end in spans:
+        data[start:end] = high
+    return data
+
+
+def none(n=200):
+    return np.zeros(n, dtype=np.int16)
+
+
+def test_edge():
+    ch1 = pulses((10, 20), (50, 60))
+    assert list(EdgeTrigger().find(ch1, none())) == [10, 50]
+    assert list(EdgeTrigger(edge=TriggerEdge.Falling).find(ch1, none())) == [20, 60]
+    assert list(EdgeTrigger(channel=Channel.Ch2).find(none(), ch1)) == [10, 50]
+
+
+def test_pulse_width():
+    ch1 = pulses((10, 15), (50, 70), (100, 140))
+    assert list(PulseTrigger(minWidth=10).find(ch1, none())) == [70, 140]
+    assert list(PulseTrigger(minWidth=10, maxWidth=30).find(ch1, none())) == [70]
+    assert list(PulseTrigger(positive=False, minWidth=30).find(ch1, none())) == [50, 100]
+
+
+def test_runt():
+    ch1 = pulses((10, 20), (50, 60), high=50)
+    ch1[50:60] = 5
+    assert list(RuntTrigger(low=-10, high=20).find(ch1, none())) == [60]
+
+
+def test_window():
+    ch1 = pulses((10, 20))
+    assert list(WindowTrigger(low=-60, high=10).find(ch1, none())) == [10]
+    assert list(WindowTrigger(low=-60, high=10, enter=True).find(ch1, none())) == [20]
+
+
+def test_slope():
+    ch1 = np.full(200, -50, dtype=np.int16)
+    # A fast rise at 10 and a slow one through 100..140
+    ch1[10:12] = [0, 50]
+    ch1[12:50] = 50
+    ch1[100:140] = np.linspace(-50, 50, 40).astype(np.int16)
+    ch1[140:] = 50
+    slow = SlopeTrigger(minTime=5).find(ch1, none())
+    fast = SlopeTrigger(maxTime=3).find(ch1, none())
+    assert len(slow) == 1 and 110 < slow[0] < 130
+    assert list(fast) == [11]
+    falling = SlopeTrigger(positive=False).find(ch1, none())
+    assert list(falling) == [50]
+
+
+def test_pattern():
+    ch1 = pulses((10, 40))
+    ch2 = pulses((30, 60))
+    assert list(PatternTrigger('H', 'H').find(ch1, ch2)) == [30]
+    assert list(PatternTrigger('H', 'L', minTime=5).find(ch1, ch2)) == [14]
+    assert list(PatternTrigger('x', 'h', minTime=10).find(ch1, ch2)) == [39]
+
+
+def test_pattern_states():
+    with pytest.raises(ValueError):
+        PatternTrigger('Q')
+    with pytest.raises(ValueError):
+        PatternTrigger('H', '')
+
+
+def test_nth_edge():
+    ch1 = pulses((60, 62), (64, 66), (68, 70), (150, 152), (154, 156), (158, 160))
+    assert list(NthEdgeTrigger(n=2).find(ch1, none())) == [64, 150, 158]
+    assert list(NthEdgeTrigger(n=3, idle=50).find(ch1, none())) == [68, 158]
+    # The idle time before the capture is not known
+    assert list(NthEdgeTrigger(n=1, idle=70).find(ch1, none())) == [150]
+
+
+def test_locate():
+    ch1 = pulses((30, 40), (80, 90), (130, 140))
+    data = np.empty(400, dtype=np.uint8)
+    data[0::2] = ch1 + 0x80
+    data[1::2] = 0x80
+    trigger = EdgeTrigger()
+    assert trigger.locate(data.tobytes(), 50, pre=20) == 30
+    assert trigger.locate(data.tobytes(), 50, pre=20, near=100) == 80
+    # No room for the samples after the event
+    assert trigger.locate(data.tobytes(), 190, pre=20) == 30
+    assert trigger.locate(data.tobytes(), 195, pre=20) is None
+
+
+def test_parse():
+    trigger = parseTrigger("pulse,channel=2,level=10,minWidth=20,positive=no")
+    assert isinstance(trigger, PulseTrigger)
+    assert trigger.channel == Channel.Ch2
+    assert (trigger.level, trigger.minWidth, trigger.positive) == (10, 20, False)
+    assert parseTrigger("edge,edge=falling").edge == TriggerEdge.Falling
+    assert parseTrigger("pattern,ch1=l,ch2=x").pattern == ('L', 'X')
+
+
+@pytest.mark.parametrize('spec', [
+    "nothing",
+    "pulse,levle=10",
+    "pulse,level=ten",
+    "edge,channel=3",
+    "edge,edge=up",
+    "pattern,ch1=Q",
+])
+def test_parse_errors(spec):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parseTrigger(spec)
+
+
+def test_parse_lists_parameters():
+    with pytest.raises(argparse.ArgumentTypeError, match="minWidth"):
+        parseTrigger("pulse,width=10")